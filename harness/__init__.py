@@ -0,0 +1,7 @@
+"""
+Tools for running the apps in this repo outside of AppDaemon.
+
+`harness.fake_hass` provides an in-process stand-in for `hass.Hass` driven by a
+simulated clock.  `harness.bench` uses it to benchmark the apps, and `harness.replay`
+to run them against recorded states.
+"""
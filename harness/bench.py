@@ -0,0 +1,244 @@
+"""
+Benchmarks for the apps in this repo, run against `harness.fake_hass`.
+
+Run from the repo root:
+
+```
+python -m harness.bench
+python -m harness.bench --entities 1000 --events 100000 --days 7
+python -m harness.bench --only state_monitor --trace-memory
+```
+
+`state_monitor` builds a house of battery sensors watched by one glob rule and
+pushes a storm of random state changes through it.  `percent_scheduler` runs a
+`PercentScheduler` for days of virtual time.  Each prints throughput, handler
+latency percentiles, timer counts and memory use.  Compare runs before and after a
+change to catch regressions.
+"""
+import argparse
+import random
+import sys
+import tempfile
+import tracemalloc
+from array import array
+from time import perf_counter
+from typing import Any, Dict, Optional
+
+from harness import fake_hass
+
+fake_hass.install()
+
+import percent_scheduler  # noqa: E402
+import state_monitor  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Not on Windows.
+    resource = None
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def latency_report(latencies: array) -> Dict[str, float]:
+    """p50, p99 and max of `latencies`, in microseconds."""
+    ordered = sorted(latencies)
+    return {
+        "p50_us": percentile(ordered, 0.50) * 1e6,
+        "p99_us": percentile(ordered, 0.99) * 1e6,
+        "max_us": (ordered[-1] if ordered else 0.0) * 1e6,
+    }
+
+
+def max_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def bench_state_monitor(
+    entities: int = 10_000,
+    events: int = 1_000_000,
+    fail_fraction: float = 0.05,
+    events_per_second: float = 200.0,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """
+    Push `events` random state changes for `entities` sensors through StateMonitor.
+
+    Each event sets a random sensor to a random battery level, which is below the
+    rule's threshold `fail_fraction` of the time.  Virtual time advances by
+    `1 / events_per_second` per event so that re-checks and notification windows
+    fire between events.  Latency is measured around each state change, so it
+    covers every listener it triggers.
+    """
+    rng = random.Random(seed)
+    journal_dir = tempfile.TemporaryDirectory()
+    home = fake_hass.SimHome()
+    names = [f"sensor.bench_{i}_battery" for i in range(entities)]
+    for name in names:
+        home.set_state(name, "80")
+
+    app = state_monitor.StateMonitor(
+        home,
+        args={
+            "entity_states": [
+                {
+                    "entity": "sensor.bench_*_battery",
+                    "it_is": ["gt", 20],
+                    "convert_with": "int",
+                }
+            ],
+            "failure_journal": f"{journal_dir.name}/failures.jsonl",
+        },
+        name="state_monitor",
+    )
+    started = perf_counter()
+    app.initialize()
+    init_seconds = perf_counter() - started
+
+    step = 1.0 / events_per_second
+    latencies = array("d")
+    set_state = home.set_state
+    run_until = home.run_until
+    randrange = rng.randrange
+    rand = rng.random
+
+    started = perf_counter()
+    for _ in range(events):
+        run_until(home.now + step)
+        value = str(randrange(0, 21) if rand() < fail_fraction else randrange(21, 101))
+        name = names[randrange(entities)]
+        t0 = perf_counter()
+        set_state(name, value)
+        latencies.append(perf_counter() - t0)
+    # Let outstanding re-checks and notification windows finish.
+    home.advance(3600)
+    elapsed = perf_counter() - started
+    journal_dir.cleanup()
+
+    return {
+        "entities": entities,
+        "events": events,
+        "init_seconds": init_seconds,
+        "seconds": elapsed,
+        "events_per_sec": events / elapsed if elapsed else 0.0,
+        **latency_report(latencies),
+        "timers_created": home.counters["timers_created"],
+        "timers_fired": home.counters["timers_fired"],
+        "peak_timers": home.peak_timers,
+        "service_calls": home.counters["service_calls"],
+        "current_failures": len(app.current_failures),
+        **{f"notify_{k}": v for k, v in app.notifier.counters.items()},
+    }
+
+
+def bench_percent_scheduler(
+    days: float = 30.0, percent: float = 0.25, min_on_seconds: float = 100.0
+) -> Dict[str, Any]:
+    """
+    Run a PercentScheduler for `days` of virtual time.
+
+    Reports how close the achieved duty cycle, measured from the turn on and turn
+    off service calls, is to `percent`.
+    """
+    home = fake_hass.SimHome()
+    device = "switch.bench_fan"
+    home.set_state(device, "off")
+    home.timer_latencies = array("d")
+
+    app = percent_scheduler.PercentScheduler(
+        home,
+        args={
+            "device": device,
+            "percent": percent,
+            "min_on_seconds": min_on_seconds,
+        },
+        name="percent_scheduler",
+    )
+    start = home.now
+    app.initialize()
+
+    started = perf_counter()
+    home.advance(days * 24 * 60 * 60)
+    elapsed = perf_counter() - started
+
+    on_seconds = 0.0
+    on_since = None
+    for when, service, data in home.service_calls:
+        if service.endswith("turn_on") and on_since is None:
+            on_since = when
+        elif service.endswith("turn_off") and on_since is not None:
+            on_seconds += when - on_since
+            on_since = None
+    if on_since is not None:
+        on_seconds += home.now - on_since
+    achieved = on_seconds / (home.now - start)
+
+    callbacks = len(home.timer_latencies)
+    return {
+        "virtual_days": days,
+        "seconds": elapsed,
+        "callbacks": callbacks,
+        "callbacks_per_sec": callbacks / elapsed if elapsed else 0.0,
+        **latency_report(home.timer_latencies),
+        "timers_created": home.counters["timers_created"],
+        "peak_timers": home.peak_timers,
+        "service_calls": home.counters["service_calls"],
+        "target_duty_cycle": percent,
+        "achieved_duty_cycle": achieved,
+    }
+
+
+def print_report(name: str, report: Dict[str, Any]) -> None:
+    print(name)
+    for key, value in report.items():
+        if isinstance(value, float):
+            value = f"{value:,.3f}"
+        elif isinstance(value, int):
+            value = f"{value:,}"
+        print(f"  {key:<24} {value}")
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--only", choices=["state_monitor", "percent_scheduler"])
+    parser.add_argument("--entities", type=int, default=10_000)
+    parser.add_argument("--events", type=int, default=1_000_000)
+    parser.add_argument("--fail-fraction", type=float, default=0.05)
+    parser.add_argument("--days", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Report peak traced allocations.  Slows everything down.",
+    )
+    args = parser.parse_args(argv)
+
+    benchmarks = {
+        "state_monitor": lambda: bench_state_monitor(
+            args.entities, args.events, args.fail_fraction, seed=args.seed
+        ),
+        "percent_scheduler": lambda: bench_percent_scheduler(args.days),
+    }
+    for name, bench in benchmarks.items():
+        if args.only and name != args.only:
+            continue
+        if args.trace_memory:
+            tracemalloc.start()
+        report = bench()
+        if args.trace_memory:
+            report["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        report["max_rss_mb"] = max_rss_mb()
+        print_report(name, report)
+
+
+if __name__ == "__main__":
+    main()
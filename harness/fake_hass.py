@@ -0,0 +1,596 @@
+"""
+An in-process stand-in for AppDaemon's `hass.Hass` with a simulated clock.
+
+Call `install()` before importing an app module so that the app's
+`import appdaemon.plugins.hass.hassapi as hass` picks up `FakeHass`.  Apps are then
+created against a `SimHome`, which holds the entity states, listeners and timers
+shared by every app in the simulation:
+
+```
+from harness import fake_hass
+
+fake_hass.install()
+import state_monitor
+
+home = fake_hass.SimHome()
+home.set_state("light.silver_lamp", "on")
+app = state_monitor.StateMonitor(home, args={})
+app.initialize()
+home.advance(60)
+```
+
+Nothing happens in real time.  Timers fire when `SimHome.advance()` moves the
+clock past them, in order, with the clock set to the time each one was due.
+
+Like AppDaemon, the API reads and returns naive datetimes in AppDaemon's time zone,
+`SimHome.time_zone`.  It is the system's local time zone unless given, so pass one
+that differs from the system's to catch apps mixing the two up.
+
+Callbacks that are coroutine functions run as tasks in `SimHome.loop`, as in
+AppDaemon 4, and while they run the `FakeHass` API returns awaitables.  Each is run
+to completion, along with any tasks it starts, before whatever fired it returns.
+Use `SimHome.run` for an app's coroutines that aren't callbacks, like `terminate`.
+"""
+import asyncio
+import contextvars
+import functools
+import heapq
+import itertools
+import sys
+import types
+from array import array
+from collections import Counter
+from datetime import datetime, timezone, tzinfo
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple, Union
+
+#: Start of simulated time, 2019-07-01 00:00:00 UTC.
+DEFAULT_START = 1561939200.0
+
+StateListener = Tuple[Callable, Optional[str], Mapping[str, Any]]
+
+#: Whether the code running is an app's coroutine, in which the API is awaited.
+_IN_COROUTINE: contextvars.ContextVar = contextvars.ContextVar(
+    "in_coroutine", default=False
+)
+
+
+class AttrDict(dict):
+    """A dict whose keys can also be read as attributes, like `Hass.entities`."""
+
+    def __getattr__(self, item):
+        try:
+            return self[item]
+        except KeyError:
+            raise AttributeError(item) from None
+
+
+class Timer:
+    __slots__ = ("when", "callback", "kwargs", "interval")
+
+    def __init__(
+        self,
+        when: float,
+        callback: Callable,
+        kwargs: Mapping[str, Any],
+        interval: Optional[float] = None,
+    ) -> None:
+        self.when = when
+        self.callback = callback
+        self.kwargs = kwargs
+        self.interval = interval
+
+
+class SimHome:
+    """
+    The simulated Home Assistant and AppDaemon scheduler that `FakeHass` apps run in.
+
+    `counters` tracks timers created, cancelled and fired, state changes, events and
+    service calls.  `service_calls` records every `call_service` as a
+    `(time, service, data)` tuple.
+
+    `time_zone` is AppDaemon's configured time zone, the system's when None.
+    """
+
+    def __init__(
+        self, start: float = DEFAULT_START, time_zone: Optional[tzinfo] = None
+    ) -> None:
+        self.now = start
+        self.time_zone = time_zone
+        self.states: Dict[str, Dict[str, Any]] = {}
+        self.service_calls: List[Tuple[float, str, Dict[str, Any]]] = []
+        self.counters: Counter = Counter()
+        self.peak_timers = 0
+        #: When set, called with `(app_name, msg, level)` for every log message.
+        self.log_sink: Optional[Callable[[str, str, str], None]] = None
+        #: When set to an `array("d")`, the wall clock seconds taken by each timer
+        #: callback are appended to it.
+        self.timer_latencies: Optional[array] = None
+
+        self._handles = itertools.count(1)
+        self._timers: Dict[int, Timer] = {}
+        self._queue: List[Tuple[float, int]] = []
+        # Keyed by entity_id, domain, or None for listeners on every entity.
+        self._state_listeners: Dict[Optional[str], Dict[int, StateListener]] = {}
+        self._state_listener_keys: Dict[int, Optional[str]] = {}
+        self._event_listeners: Dict[Optional[str], Dict[int, Tuple[Callable, Any]]] = {}
+        self._event_listener_keys: Dict[int, Optional[str]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # Callbacks
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """The event loop coroutine callbacks run in, made when first needed."""
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop
+
+    def invoke(self, callback: Callable, *args) -> None:
+        """
+        Call an app's callback the way AppDaemon would.
+
+        A sync callback runs right away with a sync API, even when it is fired from
+        inside a coroutine.  A coroutine function's coroutine is run as a task.
+        """
+        token = _IN_COROUTINE.set(False)
+        try:
+            result = callback(*args)
+        finally:
+            _IN_COROUTINE.reset(token)
+        if asyncio.iscoroutine(result):
+            self._start(result)
+
+    def run(self, coro: Awaitable) -> Any:
+        """Run an app's coroutine, and whatever it starts, to completion."""
+        return self._start(coro).result()
+
+    def _start(self, coro: Awaitable) -> asyncio.Future:
+        token = _IN_COROUTINE.set(True)
+        try:
+            task = asyncio.ensure_future(coro, loop=self.loop)
+        finally:
+            _IN_COROUTINE.reset(token)
+        # Fired from a coroutine the loop is already running, and will get to it.
+        if not self.loop.is_running():
+            self._drain()
+        return task
+
+    def _drain(self) -> None:
+        loop = self.loop
+        while True:
+            tasks = asyncio.all_tasks(loop)
+            if not tasks:
+                return
+            loop.run_until_complete(asyncio.gather(*tasks))
+
+    # Clock and timers
+
+    @property
+    def pending_timers(self) -> int:
+        return len(self._timers)
+
+    def schedule(
+        self,
+        when: float,
+        callback: Callable,
+        kwargs: Mapping[str, Any],
+        interval: Optional[float] = None,
+    ) -> int:
+        handle = next(self._handles)
+        self._timers[handle] = Timer(max(when, self.now), callback, kwargs, interval)
+        heapq.heappush(self._queue, (self._timers[handle].when, handle))
+        self.counters["timers_created"] += 1
+        if len(self._timers) > self.peak_timers:
+            self.peak_timers = len(self._timers)
+        return handle
+
+    def cancel(self, handle: int) -> None:
+        if self._timers.pop(handle, None) is not None:
+            self.counters["timers_cancelled"] += 1
+
+    def run_until(self, until: float) -> None:
+        """Fire every timer due up to `until`, then set the clock to `until`."""
+        queue = self._queue
+        while queue and queue[0][0] <= until:
+            when, handle = heapq.heappop(queue)
+            timer = self._timers.get(handle)
+            if timer is None or timer.when != when:
+                continue
+            self.now = when
+            if timer.interval:
+                timer.when = when + timer.interval
+                heapq.heappush(queue, (timer.when, handle))
+            else:
+                del self._timers[handle]
+            self.counters["timers_fired"] += 1
+            if self.timer_latencies is None:
+                self.invoke(timer.callback, dict(timer.kwargs))
+            else:
+                started = perf_counter()
+                self.invoke(timer.callback, dict(timer.kwargs))
+                self.timer_latencies.append(perf_counter() - started)
+        if until > self.now:
+            self.now = until
+
+    def advance(self, seconds: float) -> None:
+        self.run_until(self.now + seconds)
+
+    def local_time(self, ts: float, aware: bool = False) -> datetime:
+        """`ts` as a datetime in `time_zone`, naive unless `aware`."""
+        if self.time_zone is None:
+            when = datetime.fromtimestamp(ts)
+            return when.astimezone() if aware else when
+        when = datetime.fromtimestamp(ts, self.time_zone)
+        return when if aware else when.replace(tzinfo=None)
+
+    def timestamp(self, when: datetime) -> float:
+        """The timestamp of `when`, reading a naive datetime as in `time_zone`."""
+        if when.tzinfo is None and self.time_zone is not None:
+            when = when.replace(tzinfo=self.time_zone)
+        return when.timestamp()
+
+    def next_timer_at(self) -> Optional[float]:
+        while self._queue and self._queue[0][1] not in self._timers:
+            heapq.heappop(self._queue)
+        return self._queue[0][0] if self._queue else None
+
+    # States
+
+    def listen_state(
+        self,
+        callback: Callable,
+        entity: Optional[str],
+        attribute: Optional[str],
+        kwargs: Mapping[str, Any],
+    ) -> int:
+        handle = next(self._handles)
+        self._state_listeners.setdefault(entity, {})[handle] = (
+            callback,
+            attribute,
+            kwargs,
+        )
+        self._state_listener_keys[handle] = entity
+        return handle
+
+    def cancel_listen_state(self, handle: int) -> None:
+        key = self._state_listener_keys.pop(handle, None)
+        self._state_listeners.get(key, {}).pop(handle, None)
+
+    def set_state(
+        self,
+        entity_id: str,
+        state: Any,
+        attributes: Optional[Mapping[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Set the state of an entity and fire the listeners watching it.
+
+        When `attributes` is not given the entity keeps its current attributes.
+        """
+        old = self.states.get(entity_id)
+        if attributes is None:
+            attributes = old["attributes"] if old is not None else {}
+        now = datetime.fromtimestamp(self.now, timezone.utc).isoformat()
+        changed = old is None or old["state"] != state
+        new = {
+            "entity_id": entity_id,
+            "state": state,
+            "attributes": attributes,
+            "last_changed": now if changed else old["last_changed"],
+            "last_updated": now,
+        }
+        self.states[entity_id] = new
+        self.counters["state_changes"] += 1
+
+        listeners = self._state_listeners
+        for key in (entity_id, entity_id.partition(".")[0], None):
+            watching = listeners.get(key)
+            if watching:
+                for callback, attribute, kwargs in list(watching.values()):
+                    self._fire_state(callback, entity_id, attribute, old, new, kwargs)
+
+        if "state_changed" in self._event_listeners or None in self._event_listeners:
+            self.fire_event(
+                "state_changed",
+                {"entity_id": entity_id, "old_state": old, "new_state": new},
+            )
+        return new
+
+    def remove_state(self, entity_id: str) -> None:
+        """
+        Remove an entity and fire the listeners watching it.
+
+        As in Home Assistant, the listeners see the entity's new state as None.
+        Removing an entity that doesn't exist does nothing.
+        """
+        old = self.states.pop(entity_id, None)
+        if old is None:
+            return
+        self.counters["state_changes"] += 1
+
+        listeners = self._state_listeners
+        for key in (entity_id, entity_id.partition(".")[0], None):
+            watching = listeners.get(key)
+            if watching:
+                for callback, attribute, kwargs in list(watching.values()):
+                    self._fire_state(callback, entity_id, attribute, old, None, kwargs)
+
+        if "state_changed" in self._event_listeners or None in self._event_listeners:
+            self.fire_event(
+                "state_changed",
+                {"entity_id": entity_id, "old_state": old, "new_state": None},
+            )
+
+    def _fire_state(self, callback, entity_id, attribute, old, new, kwargs) -> None:
+        # Same filtering as AppDaemon: plain listeners only fire when the state
+        # changes, attribute listeners when that attribute changes, and "all"
+        # listeners on every update.
+        if attribute == "all":
+            self.invoke(callback, entity_id, attribute, old, new, kwargs)
+            return
+        if attribute is None:
+            attribute = "state"
+            old_val, new_val = old and old["state"], new and new["state"]
+        else:
+            old_val = old and old["attributes"].get(attribute)
+            new_val = new and new["attributes"].get(attribute)
+        if old is None or new is None or old_val != new_val:
+            self.invoke(callback, entity_id, attribute, old_val, new_val, kwargs)
+
+    # Events and services
+
+    def listen_event(
+        self, callback: Callable, event: Optional[str], kwargs: Mapping[str, Any]
+    ) -> int:
+        handle = next(self._handles)
+        self._event_listeners.setdefault(event, {})[handle] = (callback, kwargs)
+        self._event_listener_keys[handle] = event
+        return handle
+
+    def cancel_listen_event(self, handle: int) -> None:
+        key = self._event_listener_keys.pop(handle, None)
+        self._event_listeners.get(key, {}).pop(handle, None)
+
+    def fire_event(self, event: str, data: Mapping[str, Any]) -> None:
+        self.counters["events"] += 1
+        for key in (event, None):
+            for callback, kwargs in list(self._event_listeners.get(key, {}).values()):
+                self.invoke(callback, event, data, kwargs)
+
+    def call_service(self, service: str, data: Dict[str, Any]) -> None:
+        """
+        Record a service call.
+
+        `turn_on`, `turn_off` and `toggle` services also change the state of the
+        `entity_id` they are called with.
+        """
+        self.service_calls.append((self.now, service, data))
+        self.counters["service_calls"] += 1
+
+        action = service.partition("/")[2]
+        entity_id = data.get("entity_id")
+        if entity_id and action in ("turn_on", "turn_off", "toggle"):
+            if action == "toggle":
+                current = self.states.get(entity_id, {}).get("state")
+                action = "turn_off" if current == "on" else "turn_on"
+            self.set_state(entity_id, "on" if action == "turn_on" else "off")
+
+
+def sync_wrapper(method: Callable) -> Callable:
+    """
+    Like AppDaemon 4's decorator of the same name, makes `method` awaitable in apps'
+    coroutines.  Elsewhere it returns its result as usual.
+    """
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        result = method(*args, **kwargs)
+        if _IN_COROUTINE.get():
+            return _resolved(result)
+        return result
+
+    return wrapper
+
+
+async def _resolved(value: Any) -> Any:
+    return value
+
+
+class FakeHass:
+    """
+    Stands in for `appdaemon.plugins.hass.hassapi.Hass`.
+
+    Only the parts of the API used by the apps in this repo are provided.  Apps are
+    constructed with the `SimHome` they run in and their args, and `initialize()` is
+    then called by whoever set up the simulation.  As in AppDaemon 4, everything but
+    logging is awaited in coroutines, see `sync_wrapper`.
+    """
+
+    def __init__(
+        self,
+        home: SimHome,
+        args: Optional[Mapping[str, Any]] = None,
+        name: Optional[str] = None,
+    ) -> None:
+        self.home = home
+        self.args = dict(args or {})
+        self.name = name or type(self).__name__
+
+    def log(self, msg: str, level: str = "INFO", **kwargs) -> None:
+        self.home.counters[f"log_{level.lower()}"] += 1
+        if self.home.log_sink is not None:
+            self.home.log_sink(self.name, msg, level)
+
+    def error(self, msg: str, level: str = "WARNING", **kwargs) -> None:
+        self.log(msg, level)
+
+    # Time
+
+    @sync_wrapper
+    def get_now_ts(self) -> float:
+        return self.home.now
+
+    @sync_wrapper
+    def get_now(self) -> datetime:
+        return self.home.local_time(self.home.now, aware=True)
+
+    @sync_wrapper
+    def datetime(self, aware: bool = False) -> datetime:
+        return self.home.local_time(self.home.now, aware)
+
+    @sync_wrapper
+    def time(self):
+        return self.home.local_time(self.home.now).time()
+
+    @sync_wrapper
+    def date(self):
+        return self.home.local_time(self.home.now).date()
+
+    # Scheduler
+
+    @sync_wrapper
+    def run_in(self, callback: Callable, delay: float, **kwargs) -> int:
+        return self.home.schedule(self.home.now + float(delay), callback, kwargs)
+
+    @sync_wrapper
+    def run_at(self, callback: Callable, start: datetime, **kwargs) -> int:
+        return self.home.schedule(self.home.timestamp(start), callback, kwargs)
+
+    @sync_wrapper
+    def run_every(
+        self,
+        callback: Callable,
+        start: Union[datetime, str],
+        interval: float,
+        **kwargs,
+    ) -> int:
+        when = self.home.now if start == "now" else self.home.timestamp(start)
+        return self.home.schedule(when, callback, kwargs, interval=float(interval))
+
+    @sync_wrapper
+    def cancel_timer(self, handle: int) -> None:
+        self.home.cancel(handle)
+
+    @sync_wrapper
+    def timer_running(self, handle: int) -> bool:
+        return handle in self.home._timers
+
+    # State
+
+    @sync_wrapper
+    def listen_state(
+        self,
+        callback: Callable,
+        entity: Optional[str] = None,
+        attribute: Optional[str] = None,
+        **kwargs,
+    ) -> int:
+        return self.home.listen_state(callback, entity, attribute, kwargs)
+
+    @sync_wrapper
+    def cancel_listen_state(self, handle: int) -> None:
+        self.home.cancel_listen_state(handle)
+
+    @sync_wrapper
+    def get_state(
+        self,
+        entity_id: Optional[str] = None,
+        attribute: Optional[str] = None,
+        default: Any = None,
+        **kwargs,
+    ) -> Any:
+        states = self.home.states
+        if entity_id is None:
+            return dict(states)
+        if "." not in entity_id:
+            prefix = f"{entity_id}."
+            return {k: v for k, v in states.items() if k.startswith(prefix)}
+
+        state = states.get(entity_id)
+        if state is None:
+            return default
+        if attribute == "all":
+            return state
+        if attribute is None:
+            return state["state"]
+        if attribute in state:
+            return state[attribute]
+        return state["attributes"].get(attribute, default)
+
+    @sync_wrapper
+    def set_state(
+        self,
+        entity_id: str,
+        state: Any = None,
+        attributes: Optional[Mapping[str, Any]] = None,
+        **kwargs,
+    ) -> Dict[str, Any]:
+        return self.home.set_state(entity_id, state, attributes)
+
+    @property
+    def entities(self) -> AttrDict:
+        namespace = AttrDict()
+        for entity_id, state in self.home.states.items():
+            domain, _, name = entity_id.partition(".")
+            namespace.setdefault(domain, AttrDict())[name] = AttrDict(
+                state, attributes=AttrDict(state["attributes"])
+            )
+        return namespace
+
+    # Events and services
+
+    @sync_wrapper
+    def listen_event(self, callback: Callable, event: Optional[str] = None, **kwargs):
+        return self.home.listen_event(callback, event, kwargs)
+
+    @sync_wrapper
+    def cancel_listen_event(self, handle: int) -> None:
+        self.home.cancel_listen_event(handle)
+
+    @sync_wrapper
+    def fire_event(self, event: str, **kwargs) -> None:
+        self.home.fire_event(event, kwargs)
+
+    @sync_wrapper
+    def call_service(self, service: str, **kwargs) -> None:
+        self.home.call_service(service, kwargs)
+
+    @sync_wrapper
+    def turn_on(self, entity_id: str, **kwargs) -> None:
+        self.home.call_service(
+            "homeassistant/turn_on", dict(kwargs, entity_id=entity_id)
+        )
+
+    @sync_wrapper
+    def turn_off(self, entity_id: str, **kwargs) -> None:
+        self.home.call_service(
+            "homeassistant/turn_off", dict(kwargs, entity_id=entity_id)
+        )
+
+    @sync_wrapper
+    def toggle(self, entity_id: str, **kwargs) -> None:
+        self.home.call_service(
+            "homeassistant/toggle", dict(kwargs, entity_id=entity_id)
+        )
+
+
+def install() -> types.ModuleType:
+    """
+    Make `import appdaemon.plugins.hass.hassapi` import this module's `FakeHass`.
+
+    This must be called before the app modules are imported.  Any real AppDaemon
+    modules already in `sys.modules` are replaced.
+    """
+    names = ["appdaemon", "appdaemon.plugins", "appdaemon.plugins.hass"]
+    hassapi = types.ModuleType("appdaemon.plugins.hass.hassapi")
+    hassapi.Hass = FakeHass
+
+    parent = None
+    for name in names + [hassapi.__name__]:
+        module = hassapi if name == hassapi.__name__ else types.ModuleType(name)
+        sys.modules[name] = module
+        if parent is not None:
+            setattr(parent, name.rpartition(".")[2], module)
+        parent = module
+    return hassapi
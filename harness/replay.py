@@ -0,0 +1,384 @@
+"""
+Replays recorded entity states through the apps in this repo, in virtual time.
+
+Use it to try rule changes against real history before deploying them.  States can
+come from:
+
+- snapshots written by `state_monitor.write_state_to_file`.  The first is the
+  starting state and each later one replays as the changes since the one before.
+- the JSON lines written by `state_monitor.StateDeltaWriter`.
+- CSV history exported from Home Assistant's recorder, with `entity_id`, `state` and
+  `last_changed` columns.
+
+The apps come from an AppDaemon `apps.yaml`.  Run from the repo root:
+
+```
+python -m harness.replay --config apps.yaml --snapshot state.json \\
+    --deltas state_deltas.jsonl
+python -m harness.replay --config apps.yaml --app state_monitor --csv history.csv
+```
+
+The apps run against a `fake_hass.SimHome` whose clock follows the recorded
+timestamps, so re-checks, notification windows and scheduler timers fire when they
+would have.  Every service call the apps make, notifications included, is reported
+with the virtual time it was made at.
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import heapq
+import importlib
+import json
+import sys
+from datetime import datetime, timezone
+from operator import itemgetter
+from pathlib import Path
+from time import perf_counter
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from harness import fake_hass
+
+fake_hass.install()
+
+#: A recorded change: when, the entity_id, and its full state dict, or None when the
+#: entity was removed.
+Event = Tuple[float, str, Optional[Dict[str, Any]]]
+
+#: Args forced on every replayed app.  A replay starts from a clean slate and must
+#: not touch the live failure journal.
+REPLAY_ARGS: Mapping[str, Any] = {"failure_journal": ""}
+
+
+def parse_time(value: str) -> float:
+    """A timestamp for an ISO 8601 time as written by Home Assistant.  Naive is UTC."""
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    when = datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+
+def state_time(state: Mapping[str, Any], default: float = 0.0) -> float:
+    """When `state` was last updated, going by its `last_updated` or `last_changed`."""
+    value = state.get("last_updated") or state.get("last_changed")
+    return parse_time(value) if value else default
+
+
+# Sources
+
+
+def _open_text(path: Path):
+    if path.suffix == ".gz":
+        return gzip.open(str(path), "rt", newline="")
+    return path.open(newline="")
+
+
+def load_snapshot(path: Path) -> Dict[str, Dict[str, Any]]:
+    """Read a snapshot written by `state_monitor.write_state_to_file`."""
+    with _open_text(path) as f:
+        return json.load(f)
+
+
+def snapshot_time(states: Mapping[str, Mapping[str, Any]]) -> float:
+    """When `states` was taken, going by the latest update in it."""
+    return max((state_time(state) for state in states.values()), default=0.0)
+
+
+def read_snapshots(paths: Sequence[Path]) -> Iterator[Event]:
+    """
+    The changes between each of `paths` and the snapshot before it.
+
+    The first snapshot is only the starting point and yields nothing; pass it to
+    `Replay.run` as `initial`.  A changed entity's event is timed by its
+    `last_updated`, and a removed entity's by the snapshot it is missing from.
+    """
+    previous: Optional[Mapping[str, Mapping[str, Any]]] = None
+    for path in paths:
+        states = load_snapshot(path)
+        if previous is not None:
+            taken = snapshot_time(states)
+            changes: List[Event] = [
+                (state_time(state, taken), entity_id, state)
+                for entity_id, state in states.items()
+                if previous.get(entity_id) != state
+            ]
+            changes.extend(
+                (taken, entity_id, None)
+                for entity_id in previous
+                if entity_id not in states
+            )
+            changes.sort(key=itemgetter(0))
+            yield from changes
+        previous = states
+
+
+def read_deltas(path: Path) -> Iterator[Event]:
+    """
+    The changes in a `state_monitor.StateDeltaWriter` file.
+
+    Each change is timed by the entity's `last_updated` rather than by when it was
+    written, which can be up to a write interval later.
+    """
+    with _open_text(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            state = record["state"]
+            when = record["t"] if state is None else state_time(state, record["t"])
+            yield when, record["entity_id"], state
+
+
+def read_recorder_csv(path: Path) -> Iterator[Event]:
+    """
+    The changes in a CSV history export from Home Assistant's recorder.
+
+    The export has no attributes, so entities keep whatever attributes they had.
+    Exports are grouped by entity, so the whole file is read and sorted by time.
+    """
+    events: List[Event] = []
+    with _open_text(path) as f:
+        for row in csv.DictReader(f):
+            when = parse_time(row["last_changed"])
+            events.append(
+                (
+                    when,
+                    row["entity_id"],
+                    {
+                        "entity_id": row["entity_id"],
+                        "state": row["state"],
+                        "last_changed": row["last_changed"],
+                        "last_updated": row["last_changed"],
+                    },
+                )
+            )
+    events.sort(key=itemgetter(0))
+    return iter(events)
+
+
+def merge(*sources: Iterable[Event]) -> Iterator[Event]:
+    """Interleave time ordered `sources` into one time ordered stream."""
+    return heapq.merge(*sources, key=itemgetter(0))
+
+
+# Apps
+
+
+def load_apps(
+    config: Path, names: Optional[Sequence[str]] = None
+) -> List[Tuple[type, Dict[str, Any], str]]:
+    """
+    The `(class, args, name)` of each app in an AppDaemon `apps.yaml`.
+
+    `names` picks which apps to load, all of them by default.  Modules are imported
+    from the directory `config` is in as well as the usual places.
+    """
+    import yaml
+
+    with config.open() as f:
+        apps = yaml.safe_load(f) or {}
+
+    directory = str(config.resolve().parent)
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+
+    loaded = []
+    for name, args in apps.items():
+        if names and name not in names:
+            continue
+        if not isinstance(args, Mapping) or "module" not in args:
+            continue  # Global modules and other non-app sections.
+        module = importlib.import_module(args["module"])
+        loaded.append((getattr(module, args["class"]), dict(args), name))
+
+    missing = set(names or ()) - {name for _, _, name in loaded}
+    assert not missing, f"No apps named {', '.join(sorted(missing))} in {config}."
+    return loaded
+
+
+class Replay:
+    """
+    Runs apps against recorded states.
+
+    Add apps with `add_app` and then `run` the recorded events through them.  The
+    apps are initialized once the starting states are in place.
+    """
+
+    def __init__(self) -> None:
+        self.home = fake_hass.SimHome()
+        self.apps: List[fake_hass.FakeHass] = []
+
+    def add_app(
+        self, cls: type, args: Optional[Mapping[str, Any]] = None, name: str = ""
+    ) -> fake_hass.FakeHass:
+        app = cls(self.home, args={**(args or {}), **REPLAY_ARGS}, name=name or None)
+        self.apps.append(app)
+        return app
+
+    def run(
+        self,
+        events: Iterable[Event],
+        initial: Optional[Mapping[str, Mapping[str, Any]]] = None,
+        start: Optional[float] = None,
+        settle: float = 3600.0,
+    ) -> Dict[str, Any]:
+        """
+        Start the apps on `initial` and replay `events` through them.
+
+        Virtual time starts at `start`, by default when `initial` was taken or else
+        at the first event.  Events up to `start` set the starting states too.
+        After the last event time runs on for `settle` seconds so that pending
+        re-checks and notifications go out, and then the apps are terminated.
+
+        Returns a report of the run.  The service calls made are in
+        `home.service_calls`, see `actions`.
+        """
+        home = self.home
+        events = iter(events)
+        pending: Optional[Event] = None
+        if start is None:
+            if initial:
+                start = snapshot_time(initial)
+            else:
+                pending = next(events, None)
+                start = pending[0] if pending is not None else home.now
+        home.now = start
+
+        for entity_id, state in (initial or {}).items():
+            self._apply(entity_id, state)
+        if pending is not None:
+            self._apply(pending[1], pending[2])
+        # Whatever else happened by the start is part of the starting states.
+        for pending in events:
+            if pending[0] > start:
+                break
+            self._apply(pending[1], pending[2])
+        else:
+            pending = None
+
+        for app in self.apps:
+            app.initialize()
+
+        count = 0
+        set_state = home.set_state
+        remove_state = home.remove_state
+        run_until = home.run_until
+        started = perf_counter()
+        for when, entity_id, state in (
+            events if pending is None else _chain(pending, events)
+        ):
+            if when > home.now:
+                run_until(when)
+            if state is None:
+                remove_state(entity_id)
+            else:
+                set_state(entity_id, state["state"], state.get("attributes"))
+            count += 1
+        end = home.now
+        home.advance(settle)
+        for app in self.apps:
+            terminate = getattr(app, "terminate", None)
+            if terminate is not None:
+                result = terminate()
+                # `AsyncStateMonitor.terminate` is a coroutine.
+                if asyncio.iscoroutine(result):
+                    home.run(result)
+        elapsed = perf_counter() - started
+
+        return {
+            "events": count,
+            "virtual_start": _iso(start),
+            "virtual_end": _iso(end),
+            "seconds": elapsed,
+            "events_per_sec": count / elapsed if elapsed else 0.0,
+            "events_per_min": 60 * count / elapsed if elapsed else 0.0,
+            "timers_fired": home.counters["timers_fired"],
+            "service_calls": home.counters["service_calls"],
+            "notifications": len(self.actions("notify/")),
+        }
+
+    def actions(self, prefix: str = "") -> List[Tuple[float, str, Dict[str, Any]]]:
+        """The service calls made, optionally only those starting with `prefix`."""
+        return [c for c in self.home.service_calls if c[1].startswith(prefix)]
+
+    def _apply(self, entity_id: str, state: Optional[Mapping[str, Any]]) -> None:
+        if state is None:
+            self.home.remove_state(entity_id)
+        else:
+            self.home.set_state(entity_id, state["state"], state.get("attributes"))
+
+
+def _chain(first: Event, rest: Iterator[Event]) -> Iterator[Event]:
+    yield first
+    yield from rest
+
+
+def _iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def print_actions(actions: Iterable[Tuple[float, str, Mapping[str, Any]]]) -> None:
+    for when, service, data in actions:
+        if "message" in data:
+            print(f"{_iso(when)}  {service}  {data.get('title', '')}")
+            for line in str(data["message"]).splitlines():
+                print(f"    {line}")
+        else:
+            print(f"{_iso(when)}  {service}  {data.get('entity_id', '')}")
+
+
+def main(argv=None) -> None:
+    from harness.bench import print_report
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--config", type=Path, required=True, help="apps.yaml")
+    parser.add_argument(
+        "--app", action="append", help="Only replay this app.  Can be repeated."
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=Path,
+        action="append",
+        default=[],
+        help="A state snapshot, oldest first.  Can be repeated.",
+    )
+    parser.add_argument("--deltas", type=Path, action="append", default=[])
+    parser.add_argument("--csv", type=Path, action="append", default=[])
+    parser.add_argument("--settle", type=float, default=3600.0)
+    parser.add_argument(
+        "--all-actions",
+        action="store_true",
+        help="List every service call, not only notifications.",
+    )
+    args = parser.parse_args(argv)
+
+    replay = Replay()
+    for cls, app_args, name in load_apps(args.config, args.app):
+        replay.add_app(cls, app_args, name)
+
+    initial = load_snapshot(args.snapshot[0]) if args.snapshot else None
+    events = merge(
+        read_snapshots(args.snapshot),
+        *(read_deltas(path) for path in args.deltas),
+        *(read_recorder_csv(path) for path in args.csv),
+    )
+    report = replay.run(events, initial=initial, settle=args.settle)
+
+    print_actions(replay.actions("" if args.all_actions else "notify/"))
+    print_report("replay", report)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,22 @@ The configuration includes:
         will override `percent`.
     `min_on_seconds_state`: A hass state entity to get number of seconds the device will
         be on. If provided will override `percent`.
+    `schedule_mode`: `relative` (the default) schedules each on and off relative to
+        when the previous one ran, so callback latency adds up over time.  `absolute`
+        anchors every on and off to a fixed timeline so the duty cycle doesn't drift.
+    `duty_cycle_entity`: An optional hass entity to publish the achieved duty cycle
+        to, as a percentage.
+    `config_debounce_seconds`: How long `percent_state` and `min_on_seconds_state`
+        have to stay unchanged before a change is applied.  Defaults to 5.
+    `verify_interval`: How often, in seconds, to check that nobody else has switched
+        the device.  Defaults to 300.  Zero turns the check off.
+    `cost_curve`: An optional list of costs splitting the day into equal slots, e.g.
+        24 hourly electricity prices, or outside temperatures negated for a device
+        that should run when it's hot.  The device is still on for `percent` of the
+        day, but that time goes into the cheapest slots.  The plan is worked out
+        once a day, from midnight in AppDaemon's time zone.  Needs numpy and
+        `schedule_mode: relative`.  Without it the device cycles the same way all
+        day.
 
 For example, if we have a configuration like this:
 
@@ -26,13 +42,37 @@ then it will shut off for 300 seconds, then it will turn back on for 100 seconds
 and repeat for infinity.
 
 (100 seconds is 25% of 100 + 300 seconds)
+
+To run many devices from one app, use `MultiPercentScheduler` instead.
 """
-from typing import Any, ClassVar, Mapping, Optional, Tuple
+import heapq
+import math
+from datetime import datetime, timedelta, timezone, tzinfo
+from typing import (
+    Any,
+    Callable,
+    ClassVar,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 import appdaemon.plugins.hass.hassapi as hass
+import attr
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for `cost_curve`.
+    np = None
 
 SECONDS_PER_DAY = 24 * 60 * 60
 
+RELATIVE = "relative"
+ABSOLUTE = "absolute"
+
 
 def get_seconds_off_per_on_second(percent: float) -> float:
     on_seconds = percent * SECONDS_PER_DAY
@@ -47,17 +87,212 @@ def get_on_off_time(percent: float, min_on_seconds: float = 60) -> Tuple[float,
     )
 
 
+@attr.s(auto_attribs=True)
+class DutyCyclePlan:
+    """
+    How to cycle a device in each slot of one day, planned by `plan_duty_cycle`.
+
+    The day starting at `day_start`, which is `day_seconds` long, is split into
+    `len(fractions)` equal slots.  In slot `i` the device should be on for
+    `fractions[i]` of the time, by being on for `on_seconds[i]` and then off for
+    `off_seconds[i]`.  A slot with a fraction of 0 has an `on_seconds` of 0 and an
+    infinite `off_seconds`.
+    """
+
+    day_start: float
+    fractions: "np.ndarray"
+    on_seconds: "np.ndarray"
+    off_seconds: "np.ndarray"
+    day_seconds: float = SECONDS_PER_DAY
+
+    @property
+    def slot_seconds(self) -> float:
+        return self.day_seconds / len(self.fractions)
+
+    def covers(self, ts: float) -> bool:
+        return self.day_start <= ts < self.day_start + self.day_seconds
+
+    def slot_at(self, ts: float) -> int:
+        slot = int((ts - self.day_start) // self.slot_seconds)
+        return min(max(slot, 0), len(self.fractions) - 1)
+
+    def slot_end(self, slot: int) -> float:
+        return self.day_start + (slot + 1) * self.slot_seconds
+
+
+def day_of(now: datetime) -> Tuple[float, float]:
+    """
+    The timestamp of the midnight that starts the day `now` is in, and the length of
+    that day in seconds.
+
+    `now` is an aware datetime in the time zone the day is in.  A day that daylight
+    saving time starts or ends on is an hour shorter or longer than usual.
+    """
+    midnight = now.replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    start = _timestamp_in(now.tzinfo, midnight)
+    end = _timestamp_in(now.tzinfo, midnight + timedelta(days=1))
+    return start, end - start
+
+
+def _timestamp_in(tz: tzinfo, when: datetime) -> float:
+    # AppDaemon's pytz time zones have to localize a naive datetime rather than be
+    # attached to it.
+    localize = getattr(tz, "localize", None)
+    return (localize(when) if localize else when.replace(tzinfo=tz)).timestamp()
+
+
+def plan_duty_cycle(
+    costs: Sequence[float],
+    percent: float,
+    min_on_seconds: float,
+    day_start: float = 0.0,
+    day_seconds: float = SECONDS_PER_DAY,
+) -> DutyCyclePlan:
+    """
+    Plan a day that keeps a device on for `percent` of it, in the cheapest slots.
+
+    `costs` splits the day, `day_seconds` long, into equal slots, e.g. 24 hourly
+    electricity prices.  The on time the day needs is poured into the cheapest slots
+    first, filling each one completely before moving on to the next cheapest.  Slots
+    with the same cost share what is left over equally.
+    """
+    costs = np.asarray(costs, dtype=float)
+    slot_seconds = day_seconds / len(costs)
+    budget = percent * day_seconds
+
+    levels, slot_level, counts = np.unique(
+        costs, return_inverse=True, return_counts=True
+    )
+    capacity = counts * slot_seconds
+    filled_before = np.cumsum(capacity) - capacity
+    filled = np.clip(budget - filled_before, 0, capacity)
+    fractions = (filled / capacity)[slot_level]
+
+    on_seconds = np.where(fractions > 0, float(min_on_seconds), 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        off_seconds = np.where(
+            fractions > 0, on_seconds * (1 - fractions) / fractions, np.inf
+        )
+    return DutyCyclePlan(day_start, fractions, on_seconds, off_seconds, day_seconds)
+
+
+class DeviceShadow:
+    """
+    A local copy of the state of the devices an app switches.
+
+    The copy is kept up to date by state listeners, so switching a device that is
+    already in the state we want doesn't need a `get_state` round trip or a service
+    call.  Every `verify_interval` seconds the real states are fetched from HA and
+    any device that has been switched behind our back is switched back.
+    """
+
+    def __init__(self, app: hass.Hass, verify_interval: float = 300) -> None:
+        self.app = app
+        self.verify_interval = verify_interval
+        #: The last known state of each device.
+        self.states: Dict[str, Any] = {}
+        #: The state we last switched each device to.
+        self.desired: Dict[str, str] = {}
+        self._verify_timer: Optional[int] = None
+
+    def track(self, device: str) -> None:
+        self.states[device] = self.app.get_state(device)
+        self.app.listen_state(self.state_listener, device)
+        if self.verify_interval > 0 and self._verify_timer is None:
+            self._verify_timer = self.app.run_every(
+                self.verify,
+                self.app.datetime() + timedelta(seconds=self.verify_interval),
+                self.verify_interval,
+            )
+
+    def state_listener(self, entity, attribute, old, new, kwargs):
+        self.states[entity] = new
+
+    def switch(self, device: str, on: bool) -> bool:
+        """
+        Switch `device` on or off unless it already is.
+
+        Returns whether a service call was made.
+        """
+        state = "on" if on else "off"
+        self.desired[device] = state
+        if self.states.get(device) == state:
+            return False
+
+        self.app.log(f"Turning {device} {state}.", "DEBUG")
+        if on:
+            self.app.turn_on(device)
+        else:
+            self.app.turn_off(device)
+        # Assume it worked.  The listener or `verify` will tell us otherwise.
+        self.states[device] = state
+        return True
+
+    def verify(self, kwargs=None) -> None:
+        """Re-sync with HA and re-assert the desired state of every device."""
+        for device, desired in self.desired.items():
+            self.states[device] = self.app.get_state(device)
+            if self.states[device] != desired:
+                self.app.log(
+                    f"{device} is {self.states[device]} but should be {desired}. "
+                    f"Switching it back.",
+                    "WARNING",
+                )
+                self.switch(device, desired == "on")
+
+
 # noinspection PyAttributeOutsideInit
 class PercentScheduler(hass.Hass):
     PERCENT_STATE_KEY: ClassVar[str] = "percent_state"
     PERCENT_KEY: ClassVar[str] = "percent"
     MIN_ON_SECONDS_STATE_KEY: ClassVar[str] = "min_on_seconds_state"
     MIN_ON_SECONDS_KEY: ClassVar[str] = "min_on_seconds"
+    SCHEDULE_MODE_KEY: ClassVar[str] = "schedule_mode"
+    DUTY_CYCLE_ENTITY_KEY: ClassVar[str] = "duty_cycle_entity"
+    CONFIG_DEBOUNCE_KEY: ClassVar[str] = "config_debounce_seconds"
+    VERIFY_INTERVAL_KEY: ClassVar[str] = "verify_interval"
+    COST_CURVE_KEY: ClassVar[str] = "cost_curve"
+
+    #: Weight of the newest measurement in the moving average of callback lateness.
+    LATENESS_SMOOTHING: ClassVar[float] = 0.2
 
     def initialize(self):
-        self._timers = []
-        self.on_then_off()
-        turn_off_in, off_for = get_on_off_time(self.percent, self.min_on_seconds)
+        self._timers: List[int] = []
+        self.schedule_mode = self.args.get(self.SCHEDULE_MODE_KEY, RELATIVE)
+        assert self.schedule_mode in (
+            RELATIVE,
+            ABSOLUTE,
+        ), f"`{self.SCHEDULE_MODE_KEY}` must be `{RELATIVE}` or `{ABSOLUTE}`."
+
+        # For measuring the duty cycle we actually achieve.
+        self._duty_since = self.get_now_ts()
+        self._on_since: Optional[float] = None
+        self._on_seconds = 0.0
+        #: Moving average of how late, in seconds, absolute mode timers fire.
+        self.lateness = 0.0
+
+        # Config from HA entities is read once here and then kept up to date by
+        # `track_state`.
+        self._percent = self._read_percent()
+        self._min_on_seconds = self._read_min_on_seconds()
+        self._config_timer: Optional[int] = None
+        #: When the current on/off cycle started.
+        self._cycle_start = self.get_now_ts()
+
+        self._cost_curve = self._read_cost_curve()
+        assert (
+            self._cost_curve is None or self.schedule_mode == RELATIVE
+        ), f"`{self.COST_CURVE_KEY}` needs `{self.SCHEDULE_MODE_KEY}: {RELATIVE}`."
+        #: Today's plan, when there is a cost curve.
+        self._plan: Optional[DutyCyclePlan] = None
+
+        self.shadow = DeviceShadow(
+            self, float(self.args.get(self.VERIFY_INTERVAL_KEY, 300))
+        )
+        self.shadow.track(self.device)
+
+        self.start_schedule()
+        turn_off_in, off_for = self._on_off
         self.log(
             f"PercentScheduler running {self.device} for {self.percent * 100} "
             f"percent of the time.  It will be on for {turn_off_in} seconds and off "
@@ -84,46 +319,227 @@ class PercentScheduler(hass.Hass):
         min_on_seconds_entity = self.args.get(self.MIN_ON_SECONDS_STATE_KEY)
         self.log(f"{entity} changed from {old} to {new}")
         if (entity == percent_entity) or (entity == min_on_seconds_entity):
+            try:
+                value = float(new)
+            except (TypeError, ValueError):
+                self.log(f"Ignoring non-numeric config {new} from {entity}", "WARNING")
+                return
+
             self.log("hass changed config")
-            for handle in self._timers:
-                self.log("Canceling existing timer.")
-                self.cancel_timer(handle)
-            self.log("Rescheduling with new config.")
-            self.on_then_off()
+            if entity == percent_entity:
+                self._percent = value / 100
+            else:
+                self._min_on_seconds = value
 
-    @property
-    def percent(self):
+            # Moving a slider fires a burst of changes, so we wait for it to settle
+            # before rescheduling.
+            if self._config_timer is not None:
+                self.cancel_timer(self._config_timer)
+            self._config_timer = self.run_in(
+                self.apply_config, float(self.args.get(self.CONFIG_DEBOUNCE_KEY, 5))
+            )
+
+    def apply_config(self, kwargs):
+        """Reschedule for changed config, keeping our place in the current cycle."""
+        self._config_timer = None
+        self._plan = None
+        on_off = self.get_on_off_time()
+        if on_off == self._on_off:
+            return
+
+        for handle in self._timers:
+            self.log("Canceling existing timer.", "DEBUG")
+            self.cancel_timer(handle)
+        self.log("Rescheduling with new config.")
+        self._on_off = on_off
+        turn_off_in, off_for = on_off
+
+        # The current cycle keeps its start.  If the device is on it goes off once
+        # it has been on for the new on time, and it comes back on a new period
+        # after the cycle started.  Either can be due right away.
+        now = self.get_now_ts()
+        turn_off_at = self._cycle_start + turn_off_in
+        turn_on_at = self._cycle_start + turn_off_in + off_for
+        is_on = self._on_since is not None
+
+        if self.schedule_mode == ABSOLUTE:
+            # The new timeline starts with the current cycle, and comes on at the
+            # start of its first cycle that hasn't already begun.
+            period = turn_off_in + off_for
+            self._anchor = self._cycle_start
+            cycle = max(1, math.ceil((now - self._anchor) / period))
+            self._timers = []
+            if is_on and off_for > 0:
+                self._timers.append(self._schedule_edge(self.off_edge, turn_off_at))
+            self._timers.append(
+                self._schedule_edge(
+                    self.on_edge, self._anchor + cycle * period, cycle=cycle
+                )
+            )
+        else:
+            self._timers = [self.run_in(self.on_then_off, max(0, turn_on_at - now))]
+            if is_on:
+                self._timers.append(
+                    self.run_in(self.do_turn_off, max(0, turn_off_at - now))
+                )
+
+    def _read_percent(self) -> float:
         percent_entity = self.args.get(self.PERCENT_STATE_KEY)
         if percent_entity:
             return float(self.get_state(percent_entity)) / 100
         else:
             return float(self.args[self.PERCENT_KEY])
 
-    @property
-    def min_on_seconds(self):
+    def _read_min_on_seconds(self) -> float:
         min_on_seconds_entity = self.args.get(self.MIN_ON_SECONDS_STATE_KEY)
         if min_on_seconds_entity:
             return float(self.get_state(min_on_seconds_entity))
         else:
             return float(self.args[self.MIN_ON_SECONDS_KEY])
 
+    def _read_cost_curve(self) -> Optional["np.ndarray"]:
+        curve = self.args.get(self.COST_CURVE_KEY)
+        if curve is None:
+            return None
+        if np is None:
+            self.log(
+                f"`{self.COST_CURVE_KEY}` needs numpy, which isn't installed.  "
+                f"Cycling the same way all day instead.",
+                "WARNING",
+            )
+            return None
+        curve = np.asarray(curve, dtype=float)
+        assert (
+            curve.ndim == 1 and len(curve) > 0
+        ), f"`{self.COST_CURVE_KEY}` must be a list of numbers."
+        return curve
+
+    def get_plan(self) -> Optional[DutyCyclePlan]:
+        """Today's plan, worked out on the first call each day and then reused."""
+        if self._cost_curve is None:
+            return None
+        if self._plan is None or not self._plan.covers(self.get_now_ts()):
+            # Days start at midnight in AppDaemon's time zone.
+            day_start, day_seconds = day_of(self.datetime(aware=True))
+            self._plan = plan_duty_cycle(
+                self._cost_curve,
+                self.percent,
+                self.min_on_seconds,
+                day_start,
+                day_seconds,
+            )
+            self.log(
+                f"Planned {self.device} for the day: "
+                f"{[round(f, 3) for f in self._plan.fractions.tolist()]}",
+                "DEBUG",
+            )
+        return self._plan
+
+    @property
+    def percent(self):
+        return self._percent
+
+    @property
+    def min_on_seconds(self):
+        return self._min_on_seconds
+
     @property
     def device(self):
         return self.args["device"]
 
     def get_on_off_time(self):
+        plan = self.get_plan()
+        if plan is not None:
+            return self._planned_on_off(plan)
         turn_off_in, off_for = get_on_off_time(self.percent, self.min_on_seconds)
         return turn_off_in, off_for
 
-    def on_then_off(self, *args, **kwargs):
-        turn_off_in, off_for = get_on_off_time(self.percent, self.min_on_seconds)
+    @property
+    def achieved_duty_cycle(self) -> float:
+        """The fraction of the time, since we started, that we had the device on."""
+        now = self.get_now_ts()
+        on_seconds = self._on_seconds
+        if self._on_since is not None:
+            on_seconds += now - self._on_since
+        elapsed = now - self._duty_since
+        return on_seconds / elapsed if elapsed > 0 else 0.0
+
+    def start_schedule(self):
+        """(Re)start the on/off cycle, beginning with turning the device on now."""
+        # The on and off times only change when the config does, so they're worked
+        # out here rather than every cycle.
+        self._on_off = self.get_on_off_time()
+        if self.schedule_mode == ABSOLUTE:
+            self._anchor = self.get_now_ts()
+            self.on_edge({"cycle": 0, "target": self._anchor})
+        else:
+            self.on_then_off()
+
+    def switch_on(self):
+        self.shadow.switch(self.device, True)
+        if self._on_since is None:
+            self._on_since = self.get_now_ts()
+
+    def switch_off(self):
+        self.shadow.switch(self.device, False)
+        if self._on_since is not None:
+            self._on_seconds += self.get_now_ts() - self._on_since
+            self._on_since = None
+        self.publish_duty_cycle()
+
+    def publish_duty_cycle(self):
+        entity = self.args.get(self.DUTY_CYCLE_ENTITY_KEY)
+        if entity:
+            self.set_state(
+                entity,
+                state=round(self.achieved_duty_cycle * 100, 2),
+                attributes={
+                    "unit_of_measurement": "%",
+                    "target": round(self.percent * 100, 2),
+                    "lateness": round(self.lateness, 3),
+                },
+            )
+
+    def _planned_on_off(self, plan: DutyCyclePlan) -> Tuple[float, float]:
+        """The on and off times for a cycle starting now, following `plan`."""
+        now = self.get_now_ts()
+        slot = plan.slot_at(now)
+        turn_off_in = float(plan.on_seconds[slot])
+        off_for = float(plan.off_seconds[slot])
+
+        # Wake up when the slot ends if the next one is cycled differently, or if
+        # we'd otherwise stay off forever.
+        slot_end = plan.slot_end(slot)
+        last_slot = slot == len(plan.fractions) - 1
+        if now + turn_off_in + off_for > slot_end and (
+            last_slot
+            or math.isinf(off_for)
+            or plan.fractions[slot + 1] != plan.fractions[slot]
+        ):
+            off_for = max(0.0, slot_end - now - turn_off_in)
+        return turn_off_in, off_for
 
-        if self.get_state(self.device) != "on":
-            self.log(f"Turning {self.device} on.", "DEBUG")
-            self.turn_on(self.device)
+    def on_then_off(self, *args, **kwargs):
+        plan = self.get_plan()
+        if plan is not None:
+            self._on_off = self._planned_on_off(plan)
+        turn_off_in, off_for = self._on_off
+        self._cycle_start = self.get_now_ts()
 
-        self.log(f"Scheduling turn off of {self.device} " f"in {turn_off_in} seconds.")
-        self._timers = [self.run_in(self.do_turn_off, turn_off_in)]
+        if turn_off_in <= 0:
+            # The plan has the device off for this whole slot.
+            if self._on_since is not None:
+                self.switch_off()
+            self._timers = []
+        else:
+            self.switch_on()
+            self._timers = []
+            # With no off time the device just stays on into the next cycle.
+            if off_for > 0:
+                self.log(
+                    f"Scheduling turn off of {self.device} in {turn_off_in} seconds."
+                )
+                self._timers.append(self.run_in(self.do_turn_off, turn_off_in))
 
         self.log(
             f"Scheduling turn on of {self.device} "
@@ -132,4 +548,232 @@ class PercentScheduler(hass.Hass):
         self._timers.append(self.run_in(self.on_then_off, turn_off_in + off_for))
 
     def do_turn_off(self, *args, **kwargs):
-        self.turn_off(self.device)
+        self.switch_off()
+
+    # Absolute scheduling.  Cycle `n` turns the device on at
+    # `self._anchor + n * period` and off `on` seconds later.  Each edge is
+    # scheduled from that timeline rather than from when the previous callback
+    # ran, so lateness doesn't accumulate.  We also fire early by the average
+    # lateness we've measured so that edges land on time.
+
+    def _run_at_ts(self, callback: Callable, ts: float, **kwargs) -> int:
+        if ts <= self.get_now_ts():
+            return self.run_in(callback, 0, **kwargs)
+        # AppDaemon reads a naive datetime in its own time zone, which needn't be
+        # the system's.
+        return self.run_at(callback, datetime.fromtimestamp(ts, timezone.utc), **kwargs)
+
+    def _measure_lateness(self, target: Optional[float]) -> None:
+        if target is None:
+            return
+        late = max(0.0, self.get_now_ts() - target)
+        self.lateness += self.LATENESS_SMOOTHING * (late - self.lateness)
+
+    def _schedule_edge(self, callback: Callable, edge: float, **kwargs) -> int:
+        if edge <= self.get_now_ts():
+            # Catching up on an edge that is already due says nothing about how
+            # late timers fire, so it has no target to measure against.
+            return self.run_in(callback, 0, target=None, **kwargs)
+        # Don't fire so early that most of an on period is lost.
+        early = min(self.lateness, self._on_off[0] / 4)
+        target = edge - early
+        return self._run_at_ts(callback, target, target=target, **kwargs)
+
+    def on_edge(self, kwargs):
+        self._measure_lateness(kwargs["target"])
+        self.switch_on()
+
+        turn_off_in, off_for = self._on_off
+        period = turn_off_in + off_for
+        cycle = kwargs["cycle"]
+        # If we were so late that whole cycles went by, skip to the current one.
+        behind = math.floor((self.get_now_ts() - self._anchor) / period)
+        cycle = max(cycle, behind)
+        on_at = self._anchor + cycle * period
+        self._cycle_start = on_at
+
+        self._timers = []
+        # With no off time the device just stays on into the next cycle.
+        if off_for > 0:
+            self.log(
+                f"Scheduling turn off of {self.device} at {on_at + turn_off_in}.",
+                "DEBUG",
+            )
+            self._timers.append(self._schedule_edge(self.off_edge, on_at + turn_off_in))
+        self.log(f"Scheduling turn on of {self.device} at {on_at + period}.", "DEBUG")
+        self._timers.append(
+            self._schedule_edge(self.on_edge, on_at + period, cycle=cycle + 1)
+        )
+
+    def off_edge(self, kwargs):
+        self._measure_lateness(kwargs["target"])
+        self.switch_off()
+
+
+@attr.s(auto_attribs=True)
+class DeviceSchedule:
+    """
+    The on/off timeline of one device run by a `MultiPercentScheduler`.
+
+    Cycles start every `period` seconds from `anchor`.  The device is on for the first
+    `on_seconds` of each cycle.
+    """
+
+    device: str
+    percent: float
+    min_on_seconds: float
+    circuit: Optional[str] = None
+    anchor: float = 0.0
+
+    @property
+    def on_seconds(self) -> float:
+        return float(self.min_on_seconds)
+
+    @property
+    def period(self) -> float:
+        return sum(get_on_off_time(self.percent, self.min_on_seconds))
+
+    @property
+    def always_on(self) -> bool:
+        """Whether there is no off time, so that the device never goes off."""
+        return self.period <= self.on_seconds
+
+    def phase_at(self, now: float) -> Tuple[bool, float]:
+        """
+        Whether the device should be on at `now`, and when that next changes.
+        """
+        period = self.period
+        cycle_start = self.anchor + math.floor((now - self.anchor) / period) * period
+        if now < cycle_start + self.on_seconds:
+            return True, cycle_start + self.on_seconds
+        return False, cycle_start + period
+
+
+class MultiPercentScheduler(hass.Hass):
+    """
+    Runs many devices, each like a `PercentScheduler`, from one app and one timer.
+
+    The configuration is a `devices` list.  Each item has the `device`, `percent` and
+    `min_on_seconds` keys described at the top of this module, and an optional
+    `circuit`:
+
+    ```
+    devices:
+      - device: switch.basement_fan
+        percent: .25
+        min_on_seconds: 100
+        circuit: basement
+      - device: switch.sump_pump
+        percent: .1
+        min_on_seconds: 300
+        circuit: basement
+    ```
+
+    Every on and off edge of every device goes into a priority queue, and a single
+    timer is kept armed for the earliest one.  Edges come from each device's fixed
+    timeline, so, like `schedule_mode: absolute`, they don't drift.
+
+    The devices on a circuit have their cycles spread out, by `index / count` of
+    their period, so that they don't all come on at once.
+
+    `verify_interval` works as it does for `PercentScheduler`.
+    """
+
+    DEVICES_KEY: ClassVar[str] = "devices"
+    VERIFY_INTERVAL_KEY: ClassVar[str] = "verify_interval"
+
+    def initialize(self):
+        now = self.get_now_ts()
+        self.schedules: List[DeviceSchedule] = [
+            DeviceSchedule(
+                device=config["device"],
+                percent=float(config["percent"]),
+                min_on_seconds=float(config["min_on_seconds"]),
+                circuit=config.get("circuit"),
+                anchor=now,
+            )
+            for config in self.args[self.DEVICES_KEY]
+        ]
+        self.stagger()
+
+        self.shadow = DeviceShadow(
+            self, float(self.args.get(self.VERIFY_INTERVAL_KEY, 300))
+        )
+        for schedule in self.schedules:
+            self.shadow.track(schedule.device)
+
+        #: Pending edges as `(when, schedule index, turn on)`.
+        self._queue: List[Tuple[float, int, bool]] = []
+        self._timer: Optional[int] = None
+        self._timer_at: Optional[float] = None
+
+        for index, schedule in enumerate(self.schedules):
+            is_on, changes_at = schedule.phase_at(now)
+            self.log(
+                f"MultiPercentScheduler running {schedule.device} for "
+                f"{schedule.percent * 100} percent of the time, on for "
+                f"{schedule.on_seconds} seconds every {schedule.period} seconds, "
+                f"starting at {schedule.anchor}."
+            )
+            self.shadow.switch(schedule.device, is_on)
+            # An off edge would be followed by an on edge at the same time.
+            if not schedule.always_on:
+                heapq.heappush(self._queue, (changes_at, index, not is_on))
+        self._arm()
+
+    def stagger(self) -> None:
+        """Offset the timelines of devices sharing a circuit from each other."""
+        circuits: Dict[str, List[DeviceSchedule]] = {}
+        for schedule in self.schedules:
+            if schedule.circuit is not None:
+                circuits.setdefault(schedule.circuit, []).append(schedule)
+
+        for schedules in circuits.values():
+            for index, schedule in enumerate(schedules):
+                schedule.anchor += index / len(schedules) * schedule.period
+
+    def _arm(self) -> None:
+        if not self._queue:
+            return
+        when = self._queue[0][0]
+        if self._timer is not None:
+            if self._timer_at == when:
+                return
+            self.cancel_timer(self._timer)
+
+        now = self.get_now_ts()
+        if when <= now:
+            self._timer = self.run_in(self.tick, 0)
+        else:
+            # Aware, as AppDaemon reads a naive datetime in its own time zone.
+            self._timer = self.run_at(
+                self.tick, datetime.fromtimestamp(when, timezone.utc)
+            )
+        self._timer_at = when
+
+    def tick(self, kwargs) -> None:
+        """Timer callback that applies every edge that is due."""
+        self._timer = None
+        self._timer_at = None
+
+        now = self.get_now_ts()
+        queue = self._queue
+        while queue and queue[0][0] <= now:
+            when, index, turn_on = heapq.heappop(queue)
+            schedule = self.schedules[index]
+
+            # The next edge follows from this one's scheduled time, not from now.
+            if turn_on:
+                next_edge = when + schedule.on_seconds
+            else:
+                next_edge = when + schedule.period - schedule.on_seconds
+            is_on = turn_on
+            if next_edge <= now:
+                # If we were so late that the next edge went by too, skip to where
+                # the device should be now rather than replaying every missed edge.
+                period = schedule.period
+                schedule.anchor += math.floor((now - schedule.anchor) / period) * period
+                is_on, next_edge = schedule.phase_at(now)
+            self.shadow.switch(schedule.device, is_on)
+            heapq.heappush(queue, (next_edge, index, not is_on))
+        self._arm()
@@ -1,18 +1,72 @@
 import abc
+import asyncio
+import bisect
+import functools
+import gzip
+import hashlib
+import itertools
 import json
+import math
 import operator
-from datetime import datetime
+import os
+import random
+import zlib
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+from fnmatch import fnmatchcase
 from operator import attrgetter
 from pathlib import Path
-from typing import Any, Callable, MutableMapping, Optional, Tuple, Union
+from time import perf_counter
+from typing import (
+    Any,
+    Callable,
+    ClassVar,
+    Dict,
+    IO,
+    Iterable,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 import appdaemon.plugins.hass.hassapi as hass
 import attr
-from boltons.typeutils import make_sentinel
 
 CheckerReturnType = Tuple[bool, str]
 GetIsOkCallableType = Callable[["EntityState", Any, hass.Hass], CheckerReturnType]
 
+#: A mapping of entity_id to the full state dict of that entity, as returned by
+#: `hass.Hass.get_state()` when called without arguments.
+StateSnapshot = Mapping[str, Mapping[str, Any]]
+
+
+class Sentinel:
+    """A unique placeholder value.  It is falsy and shown by its name."""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __repr__(self) -> str:
+        return self.name
+
+    def __bool__(self) -> bool:
+        return False
+
+
+def to_entity_ids(value: Union[str, Iterable[str]]) -> Tuple[str, ...]:
+    """An entity_id, or an iterable of them, as a tuple of entity_ids."""
+    if isinstance(value, str):
+        return (value,)
+    return tuple(value)
+
 
 @attr.s(auto_attribs=True, cmp=False)
 class EntityState:
@@ -30,22 +84,271 @@ class EntityState:
     #: The number of seconds the entity has to be in a not ok state before notifying.
     fail_delay: int = 10
 
+    #: How many changes between ok and not ok within `flap_window` seconds mean the
+    #: entity is flapping.  No notifications are sent about a flapping entity until
+    #: it settles down.  Zero turns flap detection off.
+    flap_transitions: int = 0
+    flap_window: float = 300
+
+    #: Entities this one depends on, or just one entity_id.  While any `EntityState`
+    #: checking one of them is failing, no failure of this one is notified about.
+    #: See `RuleGraph`.
+    depends_on: Tuple[str, ...] = attr.ib(default=(), converter=to_entity_ids)
+
+    #: Tells this check apart in `key` from others of the same `entity_attr`.  Set
+    #: to the `rule_key` of the rule an `EntityState` is made from.
+    check_key: Optional[str] = None
+
     # internal use only
     id: Optional[int] = None
 
+    #: `entity_attr` pre-split into the keys used to walk an entity's state dict.
+    attr_path: Tuple[str, ...] = attr.ib(init=False, repr=False)
+
+    #: `is_ok_when` as a `ValueChecker`.
+    checker: "ValueChecker" = attr.ib(init=False, repr=False)
+
+    #: Whether the last check passed.  None before the first one.
+    last_ok: Optional[bool] = attr.ib(default=None, init=False, repr=False)
+
+    #: When the last `flap_transitions` changes between ok and not ok happened.
+    transitions: Optional["TransitionRing"] = attr.ib(
+        default=None, init=False, repr=False
+    )
+
+    #: Recent values, when `checker` is a `WindowChecker`.
+    history: Optional["ValueHistory"] = attr.ib(init=False, repr=False)
+
+    @attr_path.default
+    def _split_entity_attr(self) -> Tuple[str, ...]:
+        return tuple(self.entity_attr.split("."))
+
+    @checker.default
+    def _adapt_is_ok_when(self) -> "ValueChecker":
+        return as_value_checker(self.is_ok_when)
+
+    @history.default
+    def _make_history(self) -> Optional["ValueHistory"]:
+        if isinstance(self.checker, WindowChecker):
+            return self.checker.make_history()
+        return None
+
     @property
     def entity_accessor(self) -> str:
         return f"{self.entity}.{self.entity_attr}"
 
+    @property
+    def key(self) -> str:
+        """Identifies this `EntityState` across restarts, unlike `id`."""
+        if self.check_key is None:
+            return self.entity_accessor
+        return f"{self.entity_accessor}#{self.check_key}"
+
+    def read(self, entity_state: Optional[Mapping[str, Any]], default=None) -> Any:
+        """
+        Get the value this `EntityState` checks out of an entity's full state dict.
+
+        :param entity_state: The state of `self.entity` as returned by
+            `get_state(entity, attribute="all")` or as found in a `StateSnapshot`.
+        :param default: Returned when the entity or any key in `entity_attr` is
+            missing.
+        """
+        value = entity_state
+        for key in self.attr_path:
+            try:
+                value = value[key]
+            except (KeyError, TypeError):
+                return default
+        return value
+
     @property
     def is_setup(self) -> bool:
         return isinstance(self.id, int)
 
+    def observe(self, is_ok: bool, now: float) -> None:
+        """Record the result of a check done at `now`."""
+        if self.flap_transitions > 0 and self.last_ok is not None:
+            if is_ok != self.last_ok:
+                if self.transitions is None:
+                    self.transitions = TransitionRing(self.flap_transitions)
+                self.transitions.append(now)
+        self.last_ok = is_ok
+
+    @property
+    def flapping_until(self) -> float:
+        """When the entity stops counting as flapping, if it doesn't change again."""
+        if self.transitions is None:
+            return -math.inf
+        return self.transitions.oldest + self.flap_window
+
+    def is_flapping(self, now: float) -> bool:
+        return now < self.flapping_until
+
+    @property
+    def last_transition_at(self) -> float:
+        """When the last transition was, if flapping was ever tracked."""
+        if self.transitions is None:
+            return -math.inf
+        return self.transitions.newest
+
+
+class TransitionRing:
+    """A fixed size ring buffer of the times of the most recent transitions."""
+
+    __slots__ = ("times", "index")
+
+    def __init__(self, size: int) -> None:
+        self.times = array("d", [-math.inf]) * size
+        #: Where the next transition goes, which is also where the oldest one is.
+        self.index = 0
+
+    def append(self, ts: float) -> None:
+        self.times[self.index] = ts
+        self.index = (self.index + 1) % len(self.times)
+
+    @property
+    def oldest(self) -> float:
+        return self.times[self.index]
+
+    @property
+    def newest(self) -> float:
+        return self.times[self.index - 1]
+
+
+class RuleGraph:
+    """
+    The dependencies between `EntityState`s, as a DAG.
+
+    An `EntityState` depends on the entities in its `depends_on`, which means on the
+    `EntityState`s checking them.  `StateMonitor` doesn't notify about an
+    `EntityState` failing while one it depends on is failing too, because that is
+    most likely the root cause.  When the checks of an entity change, only the
+    `EntityState`s downstream of it are re-evaluated, upstream first.
+    """
+
+    def __init__(self, entity_states_by_entity: Mapping[str, List[EntityState]]):
+        """
+        :param entity_states_by_entity: The `EntityState`s checking each entity.  It
+            is read, not copied, so it can keep growing.
+        """
+        self.entity_states_by_entity = entity_states_by_entity
+        #: The `EntityState`s that depend on each entity.
+        self.dependents: Dict[str, List[EntityState]] = {}
+        self._ranks: Dict[int, int] = {}
+
+    def add(self, es: EntityState) -> None:
+        for entity in es.depends_on:
+            self.dependents.setdefault(entity, []).append(es)
+        # Adding an `EntityState` can push everything downstream of it further down.
+        self._ranks.clear()
+
+    def rank(self, es: EntityState, _visiting: Optional[Set[int]] = None) -> int:
+        """How many `EntityState`s deep `es` is.  Upstream ones rank lower."""
+        rank = self._ranks.get(es.id)
+        if rank is not None:
+            return rank
+
+        visiting = set() if _visiting is None else _visiting
+        assert es.id not in visiting, f"{es.entity_accessor} is in a dependency cycle."
+        visiting.add(es.id)
+        rank = 0
+        for entity in es.depends_on:
+            for upstream in self.entity_states_by_entity.get(entity, ()):
+                rank = max(rank, self.rank(upstream, visiting) + 1)
+        visiting.discard(es.id)
+
+        self._ranks[es.id] = rank
+        return rank
+
+    def downstream(self, entity: str) -> List[EntityState]:
+        """Every `EntityState` that depends on `entity`, directly or not, in order."""
+        seen: Dict[int, EntityState] = {}
+        pending = [entity]
+        while pending:
+            for es in self.dependents.get(pending.pop(), ()):
+                if es.id not in seen:
+                    seen[es.id] = es
+                    pending.append(es.entity)
+        return sorted(seen.values(), key=lambda es: (self.rank(es), es.id))
+
+    def failing_upstream(self, es: EntityState) -> Optional[EntityState]:
+        """An `EntityState` that `es` depends on whose last check failed, if any."""
+        for entity in es.depends_on:
+            for upstream in self.entity_states_by_entity.get(entity, ()):
+                if upstream.last_ok is False:
+                    return upstream
+        return None
+
+
+class ValueChecker(abc.ABC):
+    """
+    Stateless checkers used to validate some attribute of the state of an entity.
+
+    Implementing classes must override `check()`, which takes the actual value and
+    returns whether it is ok.  Checkers must not store anything about the values
+    they check.  That way one instance can be shared by many `EntityState`s and can be
+    called again while it is already running.
+
+    The message describing a check is only built, by `render()`, when it is needed
+    for a notification.
+
+    Instances are also callables with the signature of `GetIsOkCallableType`, so a
+    `ValueChecker` can be used anywhere a `Checker` could be.
+    """
+
+    __slots__ = ("fail_msg", "ok_msg")
+
+    def __init__(self, fail_msg: str = None, ok_msg: str = None) -> None:
+        """
+        :param fail_msg: Provide your own "static" failure message.  You can create
+            more dynamic messages by overriding `render()`.
+        :param ok_msg: Provide your own "static" ok message.
+        """
+        self.fail_msg = fail_msg
+        self.ok_msg = ok_msg
+
+    @abc.abstractmethod
+    def check(self, value: Any) -> bool:
+        """
+        Whether `value` passes the check or not.
+        """
+        ...
+
+    def check_entity(self, es: "EntityState", value: Any, ha: hass.Hass) -> bool:
+        """
+        Whether the value of an entity passes the check.
+
+        This is what `StateMonitor` calls.  Override it instead of `check()` if a
+        checker needs to know which entity it is checking.
+        """
+        return self.check(value)
+
+    def render(self, es: "EntityState", value: Any, is_ok: bool, ha: hass.Hass) -> str:
+        """Get the message describing the result of a check."""
+        if is_ok:
+            return (
+                self.ok_msg
+                or f"{es.entity} passed check with a current value of `{value}`."
+            )
+        return (
+            self.fail_msg
+            or f"{es.entity} failed check with a current value of `{value}`."
+        )
 
-class Checker(abc.ABC):
+    def __call__(
+        self, es: "EntityState", actual_val: Any, ha: hass.Hass
+    ) -> CheckerReturnType:
+        is_ok = self.check_entity(es, actual_val, ha)
+        return is_ok, self.render(es, actual_val, is_ok, ha)
+
+
+class Checker(ValueChecker):
     """
     Checker instances are used to validate some attribute of the state of an entity.
 
+    This is the original, stateful, checker API and is kept so that existing checkers
+    keep working.  New checkers should subclass `ValueChecker` instead.
+
     Instances of this class are callables that take the arguments as shown on the
     `__call__` method.
 
@@ -67,7 +370,7 @@ class Checker(abc.ABC):
 
     """
 
-    NOT_CALLED = make_sentinel("NOT_CALLED", "NOT_CALLED")
+    NOT_CALLED = Sentinel("NOT_CALLED")
 
     def __init__(
         self, *expected_values, fail_msg: str = None, ok_msg: str = None
@@ -86,6 +389,7 @@ class Checker(abc.ABC):
         :param ok_msg: Provide your own "static" ok message.  You can create
             more dynamic messages by overriding `get_ok_msg()`.
         """
+        super().__init__(fail_msg=fail_msg, ok_msg=ok_msg)
         self.expected_values = expected_values
         self.static_fail_msg = fail_msg
         self.static_ok_msg = ok_msg
@@ -133,6 +437,24 @@ class Checker(abc.ABC):
         """
         return self.get_ok_msg() if is_ok else self.get_fail_msg()
 
+    # The methods below adapt the stateful API to the `ValueChecker` one.
+
+    def check(self, value: Any) -> bool:
+        self.actual_val = value
+        return self.get_is_ok()
+
+    def check_entity(self, es: "EntityState", value: Any, ha: hass.Hass) -> bool:
+        self.es = es
+        self.actual_val = value
+        self.ha = ha
+        return self.get_is_ok()
+
+    def render(self, es: "EntityState", value: Any, is_ok: bool, ha: hass.Hass) -> str:
+        self.es = es
+        self.actual_val = value
+        self.ha = ha
+        return self.get_msg(is_ok)
+
     def __call__(self, es: "EntityState", actual_val: str, ha: hass.Hass):
         self.es = es
         self.actual_val = actual_val
@@ -143,12 +465,101 @@ class Checker(abc.ABC):
         return is_ok, self.get_msg(is_ok)
 
 
-class it_is(Checker):
+class CallableChecker(ValueChecker):
+    """
+    Adapts a plain `GetIsOkCallableType` callable to the `ValueChecker` API.
+
+    The callable returns its message along with its result, so it is called again
+    when the message is rendered.
+    """
+
+    __slots__ = ("func",)
+
+    def __init__(self, func: GetIsOkCallableType) -> None:
+        super().__init__()
+        self.func = func
+
+    def check(self, value: Any) -> bool:
+        raise TypeError(f"{self.func!r} needs an entity to check a value.")
+
+    def check_entity(self, es: "EntityState", value: Any, ha: hass.Hass) -> bool:
+        return self.func(es, value, ha)[0]
+
+    def render(self, es: "EntityState", value: Any, is_ok: bool, ha: hass.Hass) -> str:
+        return self.func(es, value, ha)[1]
+
+
+def as_value_checker(is_ok_when: GetIsOkCallableType) -> ValueChecker:
+    """Get a `ValueChecker` for anything usable as `EntityState.is_ok_when`."""
+    if isinstance(is_ok_when, ValueChecker):
+        return is_ok_when
+    return CallableChecker(is_ok_when)
+
+
+class BuiltinChecker(ValueChecker):
+    """
+    Base class of the checkers provided here, which can be subclassed with either API.
+
+    These checkers used to be `Checker`s, so subclasses of them may override
+    `get_is_ok()`, `get_fail_msg()`, `get_ok_msg()` or `get_msg()` and read
+    `self.es`, `self.actual_val` and `self.ha`.  Such a subclass is checked through
+    `Checker`'s stateful adapter instead, and its `get_is_ok()` can call the super
+    class's to do the built in check.  Like any `Checker`, an instance of it can't
+    be shared.
+    """
+
+    __slots__ = ()
+
+    #: Overriding any of these makes a subclass use the old API.
+    LEGACY_METHODS: ClassVar[Tuple[str, ...]] = (
+        "get_is_ok",
+        "get_fail_msg",
+        "get_ok_msg",
+        "get_msg",
+    )
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        if any(name in cls.__dict__ for name in cls.LEGACY_METHODS) and not getattr(
+            cls, "_builtin_check_entity", None
+        ):
+            # What `get_is_ok()` does by default, before it's replaced below.  The
+            # built in checkers' `check_entity()` doesn't call `check()`.
+            cls._builtin_check_entity = cls.check_entity
+            for name in ("check", "check_entity", "render", "__call__"):
+                setattr(cls, name, Checker.__dict__[name])
+            cls.es = cls.actual_val = cls.ha = Checker.NOT_CALLED
+
+    # The old API, for subclasses.  `es`, `actual_val` and `ha` are set before
+    # these are called.
+
+    def get_is_ok(self) -> bool:
+        return self._builtin_check_entity(self.es, self.actual_val, self.ha)
+
+    def get_fail_msg(self) -> str:
+        return ValueChecker.render(self, self.es, self.actual_val, False, self.ha)
+
+    def get_ok_msg(self) -> str:
+        return ValueChecker.render(self, self.es, self.actual_val, True, self.ha)
+
+    def get_msg(self, is_ok: bool) -> str:
+        return self.get_ok_msg() if is_ok else self.get_fail_msg()
+
+
+class it_is(BuiltinChecker):
     """Checker that asserts that a value is equal to an expected value."""
 
-    # noinspection PyMissingConstructor
+    __slots__ = ("operation", "converter", "expected_val", "hysteresis", "direction")
+
+    #: The comparisons `hysteresis` works with.
+    ORDERING: ClassVar[Tuple[str, ...]] = ("lt", "le", "gt", "ge")
+
     def __init__(
-        self, comparison: str, to: Any, convert_with: Callable[[Any], Any] = None
+        self,
+        comparison: str,
+        to: Any,
+        convert_with: Callable[[Any], Any] = None,
+        hysteresis: float = 0,
     ) -> None:
         """
         Creates a callable that compares an expected value to an actual value.
@@ -160,305 +571,2753 @@ class it_is(Checker):
             `lt` for a less-than comparison
         :param convert_with: An optional callable that takes the actual value and
             converts it to another value before comparison to the expected value.
+        :param hysteresis: How far past `to` a value has to go to change an entity
+            from ok to not ok or back.  For example, with `gt` 30 and a hysteresis of
+            2 an ok entity fails at 28 and only passes again above 32.  Only works
+            with the `lt`, `le`, `gt` and `ge` comparisons.
         """
-        assert comparison in dir(
-            operator
+        super().__init__()
+        operation = getattr(operator, comparison, None)
+        assert callable(
+            operation
         ), f"`{comparison}` must be name of a function in the `operator` module."
 
-        if convert_with is None:
-            convert_with = lambda x: x
-
-        assert callable(
+        assert convert_with is None or callable(
             convert_with
         ), "Converter must be a callable that takes a value and returns a value."
 
-        self.operation = getattr(operator, comparison)
+        assert (
+            not hysteresis or comparison in self.ORDERING
+        ), f"`hysteresis` only works with {', '.join(self.ORDERING)}."
+
+        self.operation = operation
         self.converter = convert_with
         self.expected_val = to
+        self.hysteresis = hysteresis
+        #: Which way from `expected_val` values pass, for `hysteresis`.
+        self.direction = -1 if comparison in ("lt", "le") else 1
 
-    def get_is_ok(self) -> bool:
+    def check(self, value: Any) -> bool:
+        return self._compare(value, self.expected_val)
+
+    def check_entity(self, es: "EntityState", value: Any, ha: hass.Hass) -> bool:
+        if not self.hysteresis or es.last_ok is None:
+            return self._compare(value, self.expected_val)
+
+        # Whichever way the entity is now, the threshold moves away from the value
+        # so that it has to go further to change sides.
+        shift = self.direction * self.hysteresis
         try:
-            converted = self.converter(self.actual_val)
-        except ValueError:
-            converted = self.actual_val
+            expected = (
+                self.expected_val - shift if es.last_ok else self.expected_val + shift
+            )
+        except TypeError:
+            return False
+        return self._compare(value, expected)
+
+    def _compare(self, value: Any, expected: Any) -> bool:
+        converted = value
+        if self.converter is not None:
+            try:
+                converted = self.converter(value)
+            except (TypeError, ValueError):
+                pass
 
         try:
-            return self.operation(converted, self.expected_val)
+            return self.operation(converted, expected)
         except TypeError:
             return False
 
 
-class it_is_one_of(Checker):
+class it_is_one_of(BuiltinChecker):
     """Checker that compares the actual value to a list of acceptable values."""
 
-    def get_is_ok(self) -> bool:
-        return self.actual_val in self.expected_values
+    __slots__ = ("expected_values", "_members")
+
+    def __init__(
+        self, *expected_values, fail_msg: str = None, ok_msg: str = None
+    ) -> None:
+        super().__init__(fail_msg=fail_msg, ok_msg=ok_msg)
+        self.expected_values = expected_values
+        try:
+            self._members = frozenset(expected_values)
+        except TypeError:
+            # Unhashable expected values can only be searched for.
+            self._members = None
 
+    def contains(self, value: Any) -> bool:
+        if self._members is not None:
+            try:
+                return value in self._members
+            except TypeError:
+                pass
+        return value in self.expected_values
 
-class it_is_not_one_of(Checker):
+    def check(self, value: Any) -> bool:
+        return self.contains(value)
+
+    def check_entity(self, es: "EntityState", value: Any, ha: hass.Hass) -> bool:
+        return self.contains(value)
+
+
+class it_is_not_one_of(it_is_one_of):
     """Checks that the actual value is not one of a list of unacceptable values."""
 
-    def get_is_ok(self) -> bool:
-        return self.actual_val not in self.expected_values
+    __slots__ = ()
+
+    def check(self, value: Any) -> bool:
+        return not self.contains(value)
+
+    def check_entity(self, es: "EntityState", value: Any, ha: hass.Hass) -> bool:
+        return not self.contains(value)
 
 
 it_is_not = it_is_not_one_of
 
-ENTITY_STATES = [
-    # Nest cams
-    EntityState(
-        entity="binary_sensor.front_door_camera_online", is_ok_when=it_is("eq", to="on")
-    ),
-    EntityState(entity="camera.front_door", is_ok_when=it_is("eq", to="recording")),
-    EntityState(
-        entity="binary_sensor.garage_camera_online", is_ok_when=it_is("eq", to="on")
-    ),
-    # Xiaomi flood sensor (water heater)
-    EntityState(
-        entity="sensor.xiaomi_flood_sensor_1_linkquality",
-        is_ok_when=it_is("gt", 30, convert_with=lambda x: int(float(x))),
-    ),
-    EntityState(
-        entity="sensor.xiaomi_flood_sensor_1_voltage",
-        is_ok_when=it_is("ge", 3, convert_with=lambda x: int(float(x))),
-    ),
-    EntityState(
-        entity="sensor.xiaomi_flood_sensor_1_battery",
-        is_ok_when=it_is("gt", 20, convert_with=lambda x: int(float(x))),
-    ),
-    # WeMo switch (Morgan's bedside)
-    EntityState(
-        entity="light.morgans_bedside_lamp", is_ok_when=it_is_one_of("off", "on")
-    ),
-    # Zooz/Innovelli zwave switch (Morgan's flower lights)
-    EntityState(
-        entity="switch.zooz_unknown_type2400_id2400_switch",
-        is_ok_when=it_is_one_of("off", "on"),
-    ),
-    EntityState(
-        entity="water_heater.heat_pump_water_heater_gen_4",
-        is_ok_when=it_is_not("unavailable"),
-    ),
-    # Xiaomi Click button (Dustin's bedside)
-    EntityState(
-        entity="sensor.xiaomi_click_1_battery",
-        is_ok_when=it_is("gt", 20, convert_with=lambda x: int(float(x))),
-    ),
-    EntityState(
-        entity="sensor.xiaomi_click_1_linkquality",
-        is_ok_when=it_is("gt", 30, convert_with=lambda x: int(float(x))),
-    ),
-    EntityState(
-        entity="sensor.xiaomi_click_1_voltage",
-        is_ok_when=it_is("ge", 3, convert_with=lambda x: int(float(x))),
-    ),
-    EntityState(
-        entity="cover.garage_door_opener",
-        is_ok_when=it_is_one_of("open", "closed", "closing", "opening"),
-    ),
-    EntityState(entity="light.honeywell_hall", is_ok_when=it_is_one_of("on", "off")),
-    # silver lamp entities
-    EntityState(entity="light.silver_lamp", is_ok_when=it_is_one_of("on", "off")),
-    EntityState(
-        entity="light.silver_lamp_bulb_1_light", is_ok_when=it_is_one_of("on", "off")
-    ),
-    EntityState(
-        entity="light.silver_lamp_bulb_2_light", is_ok_when=it_is_one_of("on", "off")
-    ),
-    EntityState(
-        entity="lock.schlage_allegion_be469_touchscreen_deadbolt_locked",
-        is_ok_when=it_is_one_of("locked", "unlocked"),
-    ),
-]
-
-# Set up the ids for all the entity states
-for index_, es_ in enumerate(ENTITY_STATES):
-    es_.id = index_
 
+class ValueHistory:
+    """
+    The numeric values an entity has had recently, for `WindowChecker`s.
+
+    Covers the `window` seconds up to the time it was last `advance`d to, which is
+    when the entity is checked.  Each value counts for as long as the entity had it
+    within the window, and the value from before the window counts from the start of
+    it, so a value that hasn't changed in hours still fills the whole window.  Memory
+    is bounded by `capacity`: the values and their timestamps live in fixed size
+    arrays used as ring buffers, and when they are full the oldest value goes even if
+    it is still in the window.
+
+    The time weighted sum of the values is kept up to date as they come and go, so
+    `mean()` is O(1).  The values are also kept in order in a treap whose nodes are
+    the ring buffer slots and which knows how long each subtree of values lasted,
+    which makes `min()`, `max()`, `percentile()` and every update O(log n).
+    """
 
-class StateMonitor(hass.Hass):
-    NOT_FOUND = make_sentinel("NOT_FOUND", "NOT_FOUND")
+    __slots__ = (
+        "window",
+        "times",
+        "values",
+        "weights",
+        "start",
+        "count",
+        "area",
+        "root",
+        "left",
+        "right",
+        "priorities",
+        "subtotals",
+    )
+
+    def __init__(self, window: float, capacity: int = 1024) -> None:
+        self.window = window
+        self.times = array("d", [0.0]) * capacity
+        self.values = array("d", [0.0]) * capacity
+        #: How many seconds of the window each value lasted.
+        self.weights = array("d", [0.0]) * capacity
+        #: Ring buffer index of the oldest value.
+        self.start = 0
+        self.count = 0
+        #: The sum of each value times its weight.
+        self.area = 0.0
+
+        # The treap, with -1 for no node.
+        self.root = -1
+        self.left = array("l", [-1]) * capacity
+        self.right = array("l", [-1]) * capacity
+        self.priorities = array("d", [0.0]) * capacity
+        #: The total weight of the subtree under each node.
+        self.subtotals = array("d", [0.0]) * capacity
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, ts: float, value: Any) -> None:
+        """Add the value an entity changed to at `ts`.  Non-numbers are skipped."""
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        if math.isnan(value):
+            return
 
-    # noinspection PyAttributeOutsideInit
-    def initialize(self):
-        self.current_failures: MutableMapping[int, datetime] = {}
-        self.scheduled_re_checks: MutableMapping[int, int] = {}
+        capacity = len(self.values)
+        if self.count:
+            last = self._slot(self.count - 1)
+            ts = max(ts, self.times[last])
+            self._reweight(last, ts - self.times[last])
+        if self.count == capacity:
+            self._drop_oldest()
+        end = self._slot(self.count)
+        self.times[end] = ts
+        self.values[end] = value
+        self.weights[end] = 0.0
+        self.count += 1
+        self._insert(end)
+        self.advance(ts)
+
+    def advance(self, now: float) -> None:
+        """Move the window on to end at `now`."""
+        if not self.count:
+            return
+        times = self.times
+        cutoff = now - self.window
+        # Only the value from before the window is kept, as it lasts into it.
+        while self.count > 1 and times[self._slot(1)] <= cutoff:
+            self._drop_oldest()
+
+        last = self._slot(self.count - 1)
+        self._reweight(last, max(0.0, now - max(times[last], cutoff)))
+        if self.count > 1:
+            first = self.start
+            self._reweight(first, times[self._slot(1)] - max(times[first], cutoff))
+        else:
+            # Don't let rounding errors pile up.
+            self.subtotals[last] = self.weights[last]
+            self.area = self.values[last] * self.weights[last]
 
-        for es in ENTITY_STATES:
-            assert es.is_setup, "EntityStates have not yet been initialized."
+    def mean(self) -> float:
+        total = self.subtotals[self.root]
+        if total <= 0:
+            return self.latest()
+        return self.area / total
 
-            self.log(f"Doing startup check and registering listener for {es.entity}.")
+    def min(self) -> float:
+        """The lowest value in the window, the current one included."""
+        return min(self.percentile(0), self.latest())
 
-            # When appdaemon is initializing this app we check all states and alert
-            # on them instead of waiting for a state change (which might be a long
-            # time or never if the device is already in the failed state).
-            self.do_entity_check(es)
+    def max(self) -> float:
+        """The highest value in the window, the current one included."""
+        return max(self.percentile(100), self.latest())
 
-            # ... and then we register a state listener
-            self.listen_state(self.state_listener, es.entity, es=es)
+    def percentile(self, q: float) -> float:
+        """
+        The `q`th percentile, from 0 to 100, by time: the lowest value that the
+        entity was at or below for at least `q` percent of the window.  Values that
+        lasted no time at all don't count.
+        """
+        left, right, weights, subtotals = (
+            self.left,
+            self.right,
+            self.weights,
+            self.subtotals,
+        )
+        node = self.root
+        total = subtotals[node]
+        if total <= 0:
+            return self.latest()
+        # Slack for the rounding errors in the subtotals, which would otherwise
+        # leave the target just past the last value.
+        target = q / 100 * total - total * 1e-9
+        found = node
+        while node >= 0:
+            below = left[node]
+            if below >= 0 and subtotals[below] > 0 and subtotals[below] >= target:
+                node = below
+                continue
+            if below >= 0:
+                target -= subtotals[below]
+            if weights[node] > 0:
+                found = node
+                if weights[node] >= target:
+                    break
+            target -= weights[node]
+            node = right[node]
+        return self.values[found]
+
+    def latest(self) -> float:
+        return self.values[self._slot(self.count - 1)]
+
+    def latest_at(self) -> float:
+        """When the entity changed to the latest value."""
+        return self.times[self._slot(self.count - 1)]
+
+    def _slot(self, index: int) -> int:
+        """The ring buffer index of the `index`th oldest value."""
+        return (self.start + index) % len(self.values)
+
+    def _drop_oldest(self) -> None:
+        self._remove(self.start)
+        self.area -= self.values[self.start] * self.weights[self.start]
+        self.start = self._slot(1)
+        self.count -= 1
+
+    # The treap is ordered by value and then by slot.  Weights and the area are
+    # updated by the difference, which is only as far off as `advance` corrects.
+
+    def _insert(self, slot: int) -> None:
+        values, subtotals, priorities = self.values, self.subtotals, self.priorities
+        weight = self.weights[slot]
+        priority = priorities[slot] = random.random()
+        key = (values[slot], slot)
+        # Down to where `slot` goes by priority, and split what is there around it.
+        parent, node, is_left = -1, self.root, False
+        while node >= 0 and priorities[node] > priority:
+            subtotals[node] += weight
+            parent = node
+            is_left = key < (values[node], node)
+            node = self.left[node] if is_left else self.right[node]
+        self.left[slot], self.right[slot] = self._split(node, values[slot], slot)
+        self._update(slot)
+        self._link(parent, is_left, slot)
+        self.area += values[slot] * weight
+
+    def _remove(self, slot: int) -> None:
+        values, subtotals = self.values, self.subtotals
+        weight = self.weights[slot]
+        key = (values[slot], slot)
+        parent, node, is_left = -1, self.root, False
+        while node != slot:
+            subtotals[node] -= weight
+            parent = node
+            is_left = key < (values[node], node)
+            node = self.left[node] if is_left else self.right[node]
+        self._link(parent, is_left, self._merge(self.left[slot], self.right[slot]))
+
+    def _link(self, parent: int, is_left: bool, node: int) -> None:
+        if parent < 0:
+            self.root = node
+        elif is_left:
+            self.left[parent] = node
+        else:
+            self.right[parent] = node
 
-    def state_listener(self, entity, attribute, old, new, kwargs):
-        es: EntityState = kwargs.get("es", None)
-        if not es:
-            self.log("State listener fired without an attached EntityState", "ERROR")
+    def _reweight(self, slot: int, weight: float) -> None:
+        delta = weight - self.weights[slot]
+        if not delta:
             return
+        self.weights[slot] = weight
+        self.area += self.values[slot] * delta
+        values, subtotals, left, right = (
+            self.values,
+            self.subtotals,
+            self.left,
+            self.right,
+        )
+        value = values[slot]
+        node = self.root
+        while node != slot:
+            subtotals[node] += delta
+            other = values[node]
+            if value < other or (value == other and slot < node):
+                node = left[node]
+            else:
+                node = right[node]
+        subtotals[slot] += delta
+
+    def _split(self, node: int, value: float, slot: float) -> Tuple[int, int]:
+        """Split the subtree at `node` into the nodes before `(value, slot)` and not."""
+        if node < 0:
+            return -1, -1
+        if (self.values[node], node) < (value, slot):
+            before, after = self._split(self.right[node], value, slot)
+            self.right[node] = before
+            self._update(node)
+            return node, after
+        before, after = self._split(self.left[node], value, slot)
+        self.left[node] = after
+        self._update(node)
+        return before, node
+
+    def _merge(self, before: int, after: int) -> int:
+        """Join two subtrees, all of whose nodes in `before` come first."""
+        if before < 0:
+            return after
+        if after < 0:
+            return before
+        if self.priorities[before] > self.priorities[after]:
+            self.right[before] = self._merge(self.right[before], after)
+            self._update(before)
+            return before
+        self.left[after] = self._merge(before, self.left[after])
+        self._update(after)
+        return after
+
+    def _update(self, node: int) -> None:
+        total = self.weights[node]
+        if self.left[node] >= 0:
+            total += self.subtotals[self.left[node]]
+        if self.right[node] >= 0:
+            total += self.subtotals[self.right[node]]
+        self.subtotals[node] = total
+
+
+class WindowChecker(ValueChecker):
+    """
+    Base for checkers that compare an aggregate of an entity's recent values.
+
+    Each `EntityState` with one of these checkers keeps a `ValueHistory` of the
+    last `window` seconds of its values, which `StateMonitor` adds to on every state
+    change and moves on to the time of every check.  Values are weighted by how long
+    they lasted, and the entity is re-checked as its window moves on, see
+    `StateMonitor.follow_window`.  Implementing classes override `aggregate()`.
+    Before there is any history the current value is checked on its own.
+    """
 
-        self.do_entity_check(es)
+    __slots__ = ("window", "capacity", "operation", "expected_val")
 
-    def do_entity_check(self, es: EntityState) -> None:
-        """ Checks entity state.
+    #: Describes the aggregate in messages.
+    name: ClassVar[str] = "aggregate"
 
-        This is called by our registered state listener.  However, this function does
-        not actually do any actions or notifications.  The reason for this is that to
-        avoid spurious notifications and actions, this method actually schedule a
-        re-check of the entity's state in a few seconds.  This re-check is where
-        notifications and actions are fired.
+    def __init__(
+        self,
+        window: float,
+        comparison: str,
+        to: float,
+        capacity: int = 1024,
+        fail_msg: str = None,
+        ok_msg: str = None,
+    ) -> None:
         """
-        self.log(f"Checking state of {es.entity_accessor}", "DEBUG")
-        is_ok, msg = self.is_ok(es)
+        :param window: How many seconds of history to aggregate.
+        :param comparison: As for `it_is`, the name of a function in the `operator`
+            module used to compare the aggregate to `to`.
+        :param to: The value the aggregate is compared to.
+        :param capacity: The most values to keep.
+        """
+        super().__init__(fail_msg, ok_msg)
+        operation = getattr(operator, comparison, None)
+        assert callable(
+            operation
+        ), f"`{comparison}` must be name of a function in the `operator` module."
 
-        if is_ok and self.is_currently_failed(es):
-            # This is something that was not-ok but then came back into compliance.
-            self.log(
-                f"{es.entity_accessor} failed but came back. Removing from "
-                f"current failures.  (msg: {msg})."
-            )
-            self.do_ok_notify(es, msg)
-            # Don't need to track it anymore.
-            self.pop_failed(es)
-            # In case the entity goes compliant and then not compliant again before
-            # the re-check happens we need to make sure there are no scheduled
-            # re-checks any time an entity transitions to an OK state.
-            self.unschedule_re_check(es)
+        self.window = float(window)
+        self.capacity = int(capacity)
+        self.operation = operation
+        self.expected_val = to
 
-        elif is_ok:
-            # This entity is fine, no need to do anything!
-            self.log(f"{es.entity_accessor} is fine.", "DEBUG")
+    def make_history(self) -> ValueHistory:
+        return ValueHistory(self.window, self.capacity)
 
-        elif self.is_currently_failed(es):
-            # The state of a currently failed entity has changed from one failed
-            # state to another failed state, so update action/notification
-            self.do_fail_notify(es, msg)
+    @abc.abstractmethod
+    def aggregate(self, history: ValueHistory) -> float:
+        """
+        The aggregate of the values in `history`, which is never empty.
+        """
+        ...
 
-        else:
-            # Entity just became non-compliant, so schedule a re-check of its state
-            # in a few seconds.  ("few seconds" means however many seconds is in
-            # `es.fail_delay`.)
-            self.log(
-                f"{es.entity_accessor} in fail state. Scheduling recheck in "
-                f"{es.fail_delay} seconds.",
-                "INFO",
-            )
-            self.schedule_re_check(es)
+    def _aggregate_for(self, es: "EntityState", value: Any) -> Any:
+        if es.history:
+            return self.aggregate(es.history)
+        return value
+
+    def check(self, value: Any) -> bool:
+        try:
+            return self.operation(float(value), self.expected_val)
+        except (TypeError, ValueError):
+            return False
 
-    def schedule_re_check(self, es: EntityState):
-        self.scheduled_re_checks[es.id] = self.run_in(
-            self.re_check, es.fail_delay, es=es
+    def check_entity(self, es: "EntityState", value: Any, ha: hass.Hass) -> bool:
+        return self.check(self._aggregate_for(es, value))
+
+    def render(self, es: "EntityState", value: Any, is_ok: bool, ha: hass.Hass) -> str:
+        if is_ok and self.ok_msg:
+            return self.ok_msg
+        if not is_ok and self.fail_msg:
+            return self.fail_msg
+        aggregate = self._aggregate_for(es, value)
+        if isinstance(aggregate, float):
+            aggregate = round(aggregate, 2)
+        return (
+            f"{es.entity} {'passed' if is_ok else 'failed'} check with a {self.name} "
+            f"of `{aggregate}` over the last {self.window:g} seconds."
         )
 
-    def unschedule_re_check(self, es: EntityState):
-        if es.id in self.scheduled_re_checks:
-            self.cancel_timer(self.scheduled_re_checks.pop(es.id))
 
-    def is_ok(self, es: EntityState) -> Tuple[bool, str]:
-        """
-        Checks if an entity is ok.
+class mean_is(WindowChecker):
+    """Checks the mean of an entity's values over a window."""
 
-        Returns a tuple.  First element is a bool where True means everything is
-        fine, and False means OH NOES.  Second element of the tuple is a message
-        describing the state.
-        """
-        value = get_nested_attr(
-            self.entities, es.entity_accessor, default=StateMonitor.NOT_FOUND
-        )
+    __slots__ = ()
+    name = "mean"
 
-        # Guard against mis-configuration of EntityStates or when entities have
-        # disappeared from HA for some reason.
-        if value == StateMonitor.NOT_FOUND:
-            err = f"Cannot find `{es.entity_accessor}`"
-            self.log(err, "ERROR")
-            return False, err
+    def aggregate(self, history: ValueHistory) -> float:
+        return history.mean()
 
-        # The signature for `EntityState.is_ok_when` is the signature of the
-        # `Checker.__call__` and `Checker`'s descendents.
-        return es.is_ok_when(es, value, self)
 
-    def re_check(self, kwargs) -> None:
-        """Do actions/notifications on failed entity state.
+class min_is(WindowChecker):
+    """Checks the lowest of an entity's values over a window."""
 
-        This simple method is the whole point of this class...notifications and
-        actions on non-compliant entity states.
+    __slots__ = ()
+    name = "minimum"
 
-        See `do_entity_check` for more info.
-        """
-        es = kwargs["es"]
+    def aggregate(self, history: ValueHistory) -> float:
+        return history.min()
 
-        # Don't need to track the handle for the timer that fires this method any
-        # longer...because that timer is how this method was run, so our handle to
-        # the timer is invalid anyway.
-        self.scheduled_re_checks.pop(es.id)
-        is_ok, msg = self.is_ok(es)
 
-        if is_ok:
-            self.log(f"{es.entity_accessor} was temporarily in a fail state.", "DEBUG")
-        else:
-            self.add_failed(es)
-            self.do_fail_notify(es, msg)
+class max_is(WindowChecker):
+    """Checks the highest of an entity's values over a window."""
 
-    def do_fail_notify(self, es: EntityState, msg):
-        self.log(msg, "WARNING")
-        self.call_service(
-            "notify/main_html", title="Abnormal State", message=msg, data={"tag": es.id}
-        )
+    __slots__ = ()
+    name = "maximum"
 
-    def do_ok_notify(self, es: EntityState, msg):
-        self.log(msg, "INFO")
-        failed_time = datetime.now() - self.get_failed(es)
-        self.call_service(
-            "notify/main_html",
-            title="Re-Enter Normal State",
-            message=f"{msg} (Failed for: {failed_time})",
-            data={"tag": es.id},
-        )
+    def aggregate(self, history: ValueHistory) -> float:
+        return history.max()
 
-    def add_failed(self, es: EntityState) -> None:
-        if not self.is_currently_failed(es):
-            self.current_failures[es.id] = datetime.now()
 
-    def is_currently_failed(self, es: EntityState) -> bool:
-        return es.id in self.current_failures
+class percentile_is(WindowChecker):
+    """Checks a percentile of an entity's values over a window."""
 
-    def get_failed(self, es: EntityState) -> datetime:
-        return self.current_failures[es.id]
+    __slots__ = ("q",)
 
-    def pop_failed(self, es: EntityState) -> datetime:
-        return self.current_failures.pop(es.id)
+    def __init__(
+        self, window: float, q: float, comparison: str, to: float, **kwargs
+    ) -> None:
+        """
+        :param q: The percentile, from 0 to 100.
 
+        The other parameters are as for `WindowChecker`.
+        """
+        super().__init__(window, comparison, to, **kwargs)
+        assert 0 <= q <= 100, "Percentiles go from 0 to 100."
+        self.q = q
 
-DEFAULT = make_sentinel("DEFAULT", "DEFAULT")
+    @property
+    def name(self) -> str:
+        return f"p{self.q:g}"
 
+    def aggregate(self, history: ValueHistory) -> float:
+        return history.percentile(self.q)
 
-def get_nested_attr(obj, attribute: str, default=DEFAULT):
-    """
-    Get a named attribute from an object.
 
-    `get_nested_attr(x, 'a.b.c.d')` is equivalent to `x.a.b.c.d`.
+def to_int(value: Any) -> int:
+    """Converter for numeric states like `"21.0"`."""
+    return int(float(value))
 
-    When a default argument is given, it is returned when any attribute in the chain
-    doesn't exist; without it, an exception is raised when a missing attribute is
-    encountered.
-    """
-    getter = attrgetter(attribute)
-    try:
-        return getter(obj)
-    except AttributeError:
-        if default != DEFAULT:
-            return default
-        else:
-            raise
 
+#: Converters that can be referred to by name in rule configuration.
+CONVERTERS: Mapping[str, Callable[[Any], Any]] = {
+    "int": to_int,
+    "float": float,
+    "str": str,
+}
+
+#: Checkers that can be referred to by name in rule configuration.
+CHECKERS: Mapping[str, Callable[..., ValueChecker]] = {
+    "it_is": it_is,
+    "it_is_one_of": it_is_one_of,
+    "it_is_not_one_of": it_is_not_one_of,
+    "it_is_not": it_is_not,
+    "mean_is": mean_is,
+    "min_is": min_is,
+    "max_is": max_is,
+    "percentile_is": percentile_is,
+}
 
-def write_state_to_file(h: hass.Hass):
-    p: Path = Path(__file__).resolve().parent / "state.json"
-    with p.open("w") as f:
-        json.dump(h.get_state(), f, indent=4, sort_keys=True)
+
+@attr.s(auto_attribs=True)
+class EntityRule:
+    """
+    A compiled rule that produces `EntityState`s for the entities it matches.
+
+    `pattern` is either an entity_id or a glob like `sensor.*_battery`.  Every
+    `EntityState` made from a rule shares the rule's checker, which is built once
+    when the rule is compiled.
+    """
+
+    pattern: str
+    checker: GetIsOkCallableType
+    entity_attr: str = "state"
+    fail_delay: int = 10
+    flap_transitions: int = 0
+    flap_window: float = 300
+    depends_on: Tuple[str, ...] = ()
+    #: The `rule_key` of the configuration the rule was compiled from.  Empty for a
+    #: rule made in code, whose `EntityState`s are keyed by `entity_attr` alone.
+    key: str = ""
+
+    @property
+    def is_glob(self) -> bool:
+        return any(c in self.pattern for c in "*?[")
+
+    def matches(self, entity: str) -> bool:
+        if self.is_glob:
+            return fnmatchcase(entity, self.pattern)
+        return entity == self.pattern
+
+    def make_entity_state(self, entity: str) -> EntityState:
+        return EntityState(
+            entity=entity,
+            is_ok_when=self.checker,
+            entity_attr=self.entity_attr,
+            fail_delay=self.fail_delay,
+            flap_transitions=self.flap_transitions,
+            flap_window=self.flap_window,
+            depends_on=self.depends_on,
+            check_key=self.key or None,
+        )
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> "EntityRule":
+        """
+        Compile a rule from its configuration.
+
+        The configuration is a mapping with an `entity` key and exactly one key naming
+        a checker from `CHECKERS`.  The checker's value is the list of its positional
+        arguments, a mapping of its keyword arguments, or a single argument.  For
+        example, in YAML:
+
+        ```
+        - entity: sensor.*_battery
+          it_is: [gt, 20]
+          convert_with: int
+          fail_delay: 60
+        - entity: light.silver_lamp
+          it_is_one_of: ["on", "off"]
+        - entity: sensor.*_battery
+          mean_is: [3600, ge, 20]
+        - entity: sensor.*_linkquality
+          percentile_is: {window: 86400, q: 10, comparison: ge, to: 30}
+        - entity: sensor.*_linkquality
+          it_is: [gt, 30]
+          convert_with: int
+          hysteresis: 5
+          flap_transitions: 6
+          flap_window: 600
+        - entity: camera.front_door
+          it_is: [eq, recording]
+          depends_on: binary_sensor.front_door_camera_online
+        - entity: binary_sensor.front_door_camera_online
+          it_is: [eq, "on"]
+        ```
+
+        Note that `on` and `off` must be quoted in YAML or they are read as booleans.
+        `convert_with` names a converter in `CONVERTERS`.  It and `hysteresis` are
+        only valid with `it_is`.  `flap_transitions`, `flap_window` and `depends_on`,
+        an entity_id or a list of them, are described in `EntityState`.
+        """
+        key = rule_key(config)
+        config = dict(config)
+        pattern = config.pop("entity")
+        entity_attr = config.pop("entity_attr", "state")
+        fail_delay = int(config.pop("fail_delay", 10))
+        converter_name = config.pop("convert_with", None)
+        hysteresis = config.pop("hysteresis", None)
+        flap_transitions = int(config.pop("flap_transitions", 0))
+        flap_window = float(config.pop("flap_window", 300))
+        depends_on = to_entity_ids(config.pop("depends_on", ()))
+
+        assert len(config) == 1 and set(config) <= set(CHECKERS), (
+            f"Rule for `{pattern}` must have exactly one of "
+            f"{', '.join(CHECKERS)} but has {', '.join(config) or 'none'}."
+        )
+        checker_name, checker_args = config.popitem()
+
+        kwargs = {}
+        if isinstance(checker_args, Mapping):
+            kwargs, checker_args = dict(checker_args), ()
+        elif isinstance(checker_args, str) or not isinstance(checker_args, Sequence):
+            checker_args = (checker_args,)
+
+        if converter_name is not None:
+            assert (
+                converter_name in CONVERTERS
+            ), f"`convert_with` must be one of {', '.join(CONVERTERS)}."
+            kwargs["convert_with"] = CONVERTERS[converter_name]
+        if hysteresis is not None:
+            kwargs["hysteresis"] = float(hysteresis)
+
+        return cls(
+            pattern=pattern,
+            checker=CHECKERS[checker_name](*checker_args, **kwargs),
+            entity_attr=entity_attr,
+            fail_delay=fail_delay,
+            flap_transitions=flap_transitions,
+            flap_window=flap_window,
+            depends_on=depends_on,
+            key=key,
+        )
+
+
+def rule_key(config: Mapping[str, Any]) -> str:
+    """A hash of a rule's configuration that only changes when the rule does."""
+    canonical = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+
+#: Compiled rules by `rule_key`.  Reloading an app only compiles its changed rules.
+_COMPILED_RULES: Dict[str, EntityRule] = {}
+
+#: The `rule_key`s of the rules each app, by name, was last configured with.
+_RULE_KEYS_IN_USE: Dict[str, Set[str]] = {}
+
+
+def load_entity_rules(
+    args: Mapping[str, Any], app_name: Optional[str] = None
+) -> List[EntityRule]:
+    """
+    Compile the rules configured in an app's args.
+
+    Rules come from the `entity_states` arg, a list of rule configurations as
+    described in `EntityRule.from_config`, and from the YAML file named by the
+    `entity_states_file` arg, which holds a list in the same format.  A relative path
+    is relative to this module's directory.
+
+    Rules are compiled once per distinct configuration and shared after that.  Given
+    `app_name`, the compiled rules that no app uses any more since this one's
+    configuration changed are dropped.
+    """
+    configs = list(args.get("entity_states") or [])
+
+    rules_file = args.get("entity_states_file")
+    if rules_file:
+        import yaml
+
+        path = Path(__file__).resolve().parent / rules_file
+        with path.open() as f:
+            configs.extend(yaml.safe_load(f) or [])
+
+    rules = []
+    for config in configs:
+        key = rule_key(config)
+        rule = _COMPILED_RULES.get(key)
+        if rule is None:
+            rule = _COMPILED_RULES[key] = EntityRule.from_config(config)
+        rules.append(rule)
+
+    if app_name is not None:
+        _RULE_KEYS_IN_USE[app_name] = {rule.key for rule in rules}
+        in_use = set().union(*_RULE_KEYS_IN_USE.values())
+        for key in _COMPILED_RULES.keys() - in_use:
+            del _COMPILED_RULES[key]
+    return rules
+
+
+@functools.lru_cache(maxsize=None)
+def default_entity_rules() -> Tuple[EntityRule, ...]:
+    """
+    The rules checked when none are configured, each for a single entity.
+
+    Compiled the first time an app asks for them rather than on every import.  Only
+    the rules and their checkers are shared, see `default_entity_states()`.
+    """
+    return (
+        # Nest cams
+        EntityRule("binary_sensor.front_door_camera_online", it_is("eq", to="on")),
+        EntityRule("camera.front_door", it_is("eq", to="recording")),
+        EntityRule("binary_sensor.garage_camera_online", it_is("eq", to="on")),
+        # Xiaomi flood sensor (water heater)
+        EntityRule(
+            "sensor.xiaomi_flood_sensor_1_linkquality",
+            it_is("gt", 30, convert_with=to_int),
+        ),
+        EntityRule(
+            "sensor.xiaomi_flood_sensor_1_voltage", it_is("ge", 3, convert_with=to_int)
+        ),
+        EntityRule(
+            "sensor.xiaomi_flood_sensor_1_battery", it_is("gt", 20, convert_with=to_int)
+        ),
+        # WeMo switch (Morgan's bedside)
+        EntityRule("light.morgans_bedside_lamp", it_is_one_of("off", "on")),
+        # Zooz/Innovelli zwave switch (Morgan's flower lights)
+        EntityRule(
+            "switch.zooz_unknown_type2400_id2400_switch", it_is_one_of("off", "on")
+        ),
+        EntityRule(
+            "water_heater.heat_pump_water_heater_gen_4", it_is_not("unavailable")
+        ),
+        # Xiaomi Click button (Dustin's bedside)
+        EntityRule(
+            "sensor.xiaomi_click_1_battery", it_is("gt", 20, convert_with=to_int)
+        ),
+        EntityRule(
+            "sensor.xiaomi_click_1_linkquality", it_is("gt", 30, convert_with=to_int)
+        ),
+        EntityRule(
+            "sensor.xiaomi_click_1_voltage", it_is("ge", 3, convert_with=to_int)
+        ),
+        EntityRule(
+            "cover.garage_door_opener",
+            it_is_one_of("open", "closed", "closing", "opening"),
+        ),
+        EntityRule("light.honeywell_hall", it_is_one_of("on", "off")),
+        # silver lamp entities
+        EntityRule("light.silver_lamp", it_is_one_of("on", "off")),
+        EntityRule("light.silver_lamp_bulb_1_light", it_is_one_of("on", "off")),
+        EntityRule("light.silver_lamp_bulb_2_light", it_is_one_of("on", "off")),
+        EntityRule(
+            "lock.schlage_allegion_be469_touchscreen_deadbolt_locked",
+            it_is_one_of("locked", "unlocked"),
+        ),
+    )
+
+
+def default_entity_states() -> List[EntityState]:
+    """
+    New `EntityState`s, with their ids, for the `default_entity_rules()`.
+
+    Each app gets its own, so nothing about what an entity has been doing is shared
+    between apps or carried over when an app is reloaded.
+    """
+    entity_states = [
+        rule.make_entity_state(rule.pattern) for rule in default_entity_rules()
+    ]
+    for index, es in enumerate(entity_states):
+        es.id = index
+    return entity_states
+
+
+@attr.s(auto_attribs=True, slots=True)
+class CheckResult:
+    """
+    The result of checking an `EntityState`.
+
+    The message describing the result is only rendered when `msg` is accessed.
+    """
+
+    es: EntityState
+    value: Any
+    is_ok: bool
+    ha: hass.Hass
+    #: Set instead of rendering a message when the value couldn't be checked.
+    error: Optional[str] = None
+
+    @property
+    def msg(self) -> str:
+        if self.error is not None:
+            return self.error
+        return self.es.checker.render(self.es, self.value, self.is_ok, self.ha)
+
+
+@attr.s(auto_attribs=True, slots=True)
+class TokenBucket:
+    """
+    A token bucket rate limiter.
+
+    Holds up to `capacity` tokens and gains `rate` tokens per second.  Each allowed
+    event costs one token.
+    """
+
+    #: Slack for rounding errors in refilling, so that waiting `wait_time()` is
+    #: always long enough.
+    EPSILON: ClassVar[float] = 1e-9
+
+    rate: float
+    capacity: float
+    tokens: float = attr.ib()
+    updated: Optional[float] = None
+
+    @tokens.default
+    def _start_full(self) -> float:
+        return self.capacity
+
+    def _refill(self, now: float) -> None:
+        if self.updated is not None:
+            elapsed = max(0.0, now - self.updated)
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def consume(self, now: float) -> bool:
+        """Take a token if one is available.  Returns whether one was taken."""
+        self._refill(now)
+        if self.tokens >= 1 - self.EPSILON:
+            self.tokens = max(0.0, self.tokens - 1)
+            return True
+        return False
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token will be available."""
+        self._refill(now)
+        if self.tokens >= 1 - self.EPSILON:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+@attr.s(auto_attribs=True, slots=True)
+class Notification:
+    title: str
+    message: str
+    tag: Any
+
+
+@attr.s(auto_attribs=True, slots=True)
+class CheckActions:
+    """
+    What checking entities decided should happen, for a `StateMonitor` to carry out.
+
+    Deciding needs nothing from AppDaemon but the time and the states, so
+    `StateMonitor` and `AsyncStateMonitor` share it and only carry out the actions
+    their own way.
+    """
+
+    #: Notifications to submit.
+    notifications: List[Notification] = attr.Factory(list)
+    #: `EntityState`s to check next, like the ones depending on a changed entity.
+    #: These only notify about news: a failure that was already notified isn't
+    #: notified again.
+    checks: List[EntityState] = attr.Factory(list)
+    #: Whether re-checks were scheduled, so the re-check timer may need arming.
+    re_checks_scheduled: bool = False
+
+    def notify(self, title: str, message: str, tag: Any) -> None:
+        self.notifications.append(Notification(title, message, tag))
+
+
+class NotifyPipeline:
+    """
+    Batches and rate limits the notifications sent by an app.
+
+    Notifications submitted within `window` seconds of each other are sent as one
+    `call_service` call.  A notification with the same tag as one that is already
+    pending replaces it, so only the latest news about an entity is sent.  When more
+    than one notification is pending they are merged into a single digest.
+
+    Two token buckets limit the traffic.  Each tag has its own bucket, and the
+    notification for a tag that is out of tokens is held, and keeps being replaced by
+    newer ones, until the tag has a token.  That way the latest news about an entity
+    is always sent in the end.  The global bucket limits how often we call the notify
+    service.  When it is out of tokens the pending notifications are held, and keep
+    merging, until a token is available.
+
+    `counters` tracks how many notifications were `submitted`, `deduplicated` (replaced
+    by a newer notification with the same tag), `held` back by the per-tag limit when
+    others were sent, `merged` into a digest, and how many service calls were `sent`.
+
+    A rate of zero or less turns the corresponding limit off.
+    """
+
+    def __init__(
+        self,
+        app: hass.Hass,
+        service: str = "notify/main_html",
+        window: float = 5.0,
+        tag_rate: float = 1 / 60,
+        tag_burst: float = 5,
+        global_rate: float = 1 / 5,
+        global_burst: float = 5,
+    ) -> None:
+        self.app = app
+        self.service = service
+        self.window = window
+        self.tag_rate = tag_rate
+        self.tag_burst = tag_burst
+
+        self.pending: Dict[Any, Notification] = {}
+        self.counters: Counter = Counter()
+        self._tag_buckets: Dict[Any, TokenBucket] = {}
+        self._global_bucket: Optional[TokenBucket] = None
+        if global_rate > 0:
+            self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._timer: Optional[int] = None
+        #: When `_timer` fires.
+        self._timer_at = math.inf
+
+    def _now(self) -> float:
+        return self.app.get_now_ts()
+
+    def _accept(self, title: str, message: str, tag: Any) -> None:
+        """Queue a notification, replacing any pending one with the same tag."""
+        self.counters["submitted"] += 1
+
+        if tag not in self._tag_buckets and self.tag_rate > 0:
+            self._tag_buckets[tag] = TokenBucket(self.tag_rate, self.tag_burst)
+
+        if tag in self.pending:
+            self.counters["deduplicated"] += 1
+        self.pending[tag] = Notification(title, message, tag)
+
+    def _flush_delay(self, now: float) -> Optional[float]:
+        """
+        How long to wait before flushing after a submit, or None to leave the timer.
+
+        A timer already due within the window is left alone, and one held back
+        further by the rate limits is brought forward for the new notification.
+        """
+        if self.window <= 0:
+            return 0.0
+        if self._timer is None or self._timer_at > now + self.window:
+            return self.window
+        return None
+
+    def _take(
+        self, now: float, force: bool = False
+    ) -> Tuple[Optional[Dict[str, Any]], float]:
+        """
+        Take what can be sent as the kwargs for one notify service call.
+
+        Returns the kwargs, or None when nothing can be sent now, and how many
+        seconds to wait before trying to send what is still pending, or 0 when
+        nothing is.  `force` takes everything and ignores the limits.
+        """
+        if not self.pending:
+            return None, 0.0
+
+        ready = []
+        wait = math.inf
+        for tag in self.pending:
+            bucket = self._tag_buckets.get(tag)
+            tag_wait = 0.0 if bucket is None or force else bucket.wait_time(now)
+            if tag_wait <= 0:
+                ready.append(tag)
+            else:
+                wait = min(wait, tag_wait)
+        if not ready:
+            return None, wait
+
+        limit = self._global_bucket
+        if limit is not None and not limit.consume(now) and not force:
+            return None, limit.wait_time(now)
+
+        notifications = []
+        for tag in ready:
+            bucket = self._tag_buckets.get(tag)
+            if bucket is not None:
+                bucket.consume(now)
+            notifications.append(self.pending.pop(tag))
+        self.counters["sent"] += 1
+        if self.pending:
+            self.counters["held"] += len(self.pending)
+        else:
+            wait = 0.0
+
+        if len(notifications) == 1:
+            n = notifications[0]
+            return (
+                {"title": n.title, "message": n.message, "data": {"tag": n.tag}},
+                wait,
+            )
+
+        self.counters["merged"] += len(notifications)
+        return (
+            {
+                "title": f"{len(notifications)} State Changes",
+                "message": "\n".join(f"{n.title}: {n.message}" for n in notifications),
+            },
+            wait,
+        )
+
+    def submit(self, title: str, message: str, tag: Any) -> None:
+        self._accept(title, message, tag)
+
+        now = self._now()
+        delay = self._flush_delay(now)
+        if delay == 0:
+            self.flush()
+        elif delay is not None:
+            self._set_timer(now, delay)
+
+    def flush(self, kwargs=None, force: bool = False) -> None:
+        """
+        Send everything pending that the limits allow.  Also the timer callback.
+
+        `force` sends everything, whatever the limits say.
+        """
+        if self._timer is not None and kwargs is None:
+            self.app.cancel_timer(self._timer)
+        self._timer = None
+        self._timer_at = math.inf
+
+        now = self._now()
+        service_kwargs, wait = self._take(now, force)
+        if service_kwargs is not None:
+            self.app.call_service(self.service, **service_kwargs)
+        if wait > 0:
+            self._set_timer(now, wait)
+
+    def _set_timer(self, now: float, delay: float) -> None:
+        if self._timer is not None:
+            self.app.cancel_timer(self._timer)
+        self._timer = self.app.run_in(self.flush, delay)
+        self._timer_at = now + delay
+
+
+class AsyncNotifyPipeline(NotifyPipeline):
+    """
+    A `NotifyPipeline` whose methods are coroutines, for `AsyncStateMonitor`.
+
+    Sending doesn't hold up the caller.  Each notify service call runs as its own
+    task, at most `max_concurrency` of them at once, and is given up on after
+    `timeout` seconds.  Besides the `NotifyPipeline` counters, `counters` tracks
+    service calls that `timed_out` and ones that `failed`.
+    """
+
+    def __init__(
+        self,
+        app: hass.Hass,
+        service: str = "notify/main_html",
+        window: float = 5.0,
+        tag_rate: float = 1 / 60,
+        tag_burst: float = 5,
+        global_rate: float = 1 / 5,
+        global_burst: float = 5,
+        max_concurrency: int = 4,
+        timeout: float = 10.0,
+    ) -> None:
+        super().__init__(
+            app, service, window, tag_rate, tag_burst, global_rate, global_burst
+        )
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        # Created on first use, in the event loop it guards.
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._sending: Set[asyncio.Future] = set()
+
+    async def submit(self, title: str, message: str, tag: Any) -> None:
+        self._accept(title, message, tag)
+
+        now = await self.app.get_now_ts()
+        delay = self._flush_delay(now)
+        if delay == 0:
+            await self.flush()
+        elif delay is not None:
+            await self._set_timer(now, delay)
+
+    async def flush(self, kwargs=None, force: bool = False) -> None:
+        """Send everything pending that the limits allow.  Also the timer callback."""
+        if self._timer is not None and kwargs is None:
+            await self.app.cancel_timer(self._timer)
+        self._timer = None
+        self._timer_at = math.inf
+
+        now = await self.app.get_now_ts()
+        service_kwargs, wait = self._take(now, force)
+        if service_kwargs is not None:
+            sending = asyncio.ensure_future(self._send(service_kwargs))
+            self._sending.add(sending)
+            sending.add_done_callback(self._sending.discard)
+        if wait > 0:
+            await self._set_timer(now, wait)
+
+    async def _set_timer(self, now: float, delay: float) -> None:
+        if self._timer is not None:
+            await self.app.cancel_timer(self._timer)
+        self._timer = await self.app.run_in(self.flush, delay)
+        self._timer_at = now + delay
+
+    async def _send(self, service_kwargs: Dict[str, Any]) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self._semaphore:
+            try:
+                await asyncio.wait_for(
+                    self.app.call_service(self.service, **service_kwargs),
+                    self.timeout,
+                )
+            except asyncio.TimeoutError:
+                self.counters["timed_out"] += 1
+                self.app.log(
+                    f"{self.service} didn't answer within {self.timeout} seconds.",
+                    "WARNING",
+                )
+            except Exception as e:
+                self.counters["failed"] += 1
+                self.app.log(f"{self.service} failed: {e!r}", "ERROR")
+
+    async def drain(self) -> None:
+        """Wait for the service calls already started to finish."""
+        if self._sending:
+            await asyncio.wait(list(self._sending))
+
+
+#: The event sharded `StateMonitor`s hand their notifications to a `NotifyAggregator`
+#: with.
+NOTIFY_EVENT = "state_monitor_notify"
+
+
+def notifier_args(args: Mapping[str, Any]) -> Dict[str, Any]:
+    """The `NotifyPipeline` arguments configured in an app's args."""
+    return dict(
+        service=args.get("notify_service", "notify/main_html"),
+        window=float(args.get("notify_window", 5)),
+        tag_rate=float(args.get("notify_entity_rate", 1 / 60)),
+        tag_burst=float(args.get("notify_entity_burst", 5)),
+        global_rate=float(args.get("notify_global_rate", 1 / 5)),
+        global_burst=float(args.get("notify_global_burst", 5)),
+    )
+
+
+class EventNotifier:
+    """
+    Hands notifications to a `NotifyAggregator` instead of sending them.
+
+    Used by sharded `StateMonitor`s.  Each notification is fired as an `event` and
+    the aggregator batches and rate limits the notifications of every shard together,
+    so a shard is never held up by the notify service.  AppDaemon events go through
+    Home Assistant, so the shards and the aggregator can be in different AppDaemon
+    processes.
+
+    Tags are prefixed with the shard's index so that they stay distinct.
+    """
+
+    def __init__(self, app: hass.Hass, event: str = NOTIFY_EVENT, shard: int = 0):
+        self.app = app
+        self.event = event
+        self.shard = shard
+        self.counters: Counter = Counter()
+
+    def submit(self, title: str, message: str, tag: Any) -> None:
+        self.counters["submitted"] += 1
+        self.app.fire_event(
+            self.event, title=title, message=message, tag=f"{self.shard}/{tag}"
+        )
+
+    def flush(self, kwargs=None, force: bool = False) -> None:
+        """Nothing is held back, so there is nothing to flush."""
+
+
+class AsyncEventNotifier(EventNotifier):
+    """An `EventNotifier` whose methods are coroutines, for `AsyncStateMonitor`."""
+
+    async def submit(self, title: str, message: str, tag: Any) -> None:
+        self.counters["submitted"] += 1
+        await self.app.fire_event(
+            self.event, title=title, message=message, tag=f"{self.shard}/{tag}"
+        )
+
+    async def flush(self, kwargs=None, force: bool = False) -> None:
+        pass
+
+    async def drain(self) -> None:
+        pass
+
+
+class NotifyAggregator(hass.Hass):
+    """
+    Sends the notifications of sharded `StateMonitor`s through one `NotifyPipeline`.
+
+    Run one of these alongside the shards.  It takes the `notify_*` args described
+    for `StateMonitor`, and `notify_event` if the shards use a different event than
+    `NOTIFY_EVENT`.
+    """
+
+    # noinspection PyAttributeOutsideInit
+    def initialize(self):
+        self.notifier = NotifyPipeline(self, **notifier_args(self.args))
+        self.listen_event(
+            self.notify_listener, self.args.get("notify_event", NOTIFY_EVENT)
+        )
+
+    def notify_listener(self, event_name, data, kwargs):
+        self.notifier.submit(data["title"], data["message"], data["tag"])
+
+    def terminate(self):
+        self.notifier.flush(force=True)
+
+
+def shard_of(key: str, shard_count: int) -> int:
+    """Which of `shard_count` shards `key` belongs to.  The same everywhere, always."""
+    return zlib.crc32(key.encode()) % shard_count
+
+
+class FailureJournal:
+    """
+    An append-only, JSON lines, on-disk record of which entities are failing.
+
+    Every failure and recovery appends one line, so recording one costs the same no
+    matter how many entities are failing.  When the file holds many more lines than
+    there are current failures it is compacted.  The current failures are written to
+    a temporary file which then replaces the journal.
+
+    Failures are keyed by `EntityState.key` because ids aren't stable across
+    restarts.
+
+    The journal is only a convenience.  Errors reading or writing it are logged and
+    otherwise ignored, so that they never get in the way of a notification.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        compact_after: int = 1000,
+        log: Optional[Callable[[str, str], None]] = None,
+    ) -> None:
+        """
+        :param path: Where the journal lives.
+        :param compact_after: Don't compact until the journal has this many lines.
+        :param log: Called with a message and a level when the journal can't be
+            read or written, like `hass.Hass.log`.
+        """
+        self.path = path
+        self.compact_after = compact_after
+        self.log = log
+        self.failures: Dict[str, datetime] = {}
+        self._lines = 0
+
+    def load(self) -> Dict[str, datetime]:
+        """Read the journal and return the failures it records."""
+        self.failures = {}
+        self._lines = 0
+        try:
+            with self.path.open() as f:
+                for line in f:
+                    # A bad line is skipped.  Most likely it was cut short by a
+                    # crash.  Compacting drops it.
+                    self._lines += 1
+                    try:
+                        self._replay(json.loads(line))
+                    except (KeyError, TypeError, ValueError):
+                        continue
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self._error("read", e)
+        return dict(self.failures)
+
+    def _replay(self, record: Mapping[str, Any]) -> None:
+        if record["op"] == "fail":
+            self.failures[record["key"]] = datetime.fromisoformat(record["since"])
+        else:
+            self.failures.pop(record["key"], None)
+
+    def record_failed(self, key: str, since: datetime) -> None:
+        self.failures[key] = since
+        self._append({"op": "fail", "key": key, "since": since.isoformat()})
+
+    def record_ok(self, key: str) -> None:
+        if self.failures.pop(key, None) is not None:
+            self._append({"op": "ok", "key": key})
+
+    def _append(self, record: Mapping[str, Any]) -> None:
+        try:
+            with self.path.open("a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            self._error("write", e)
+            return
+        self._lines += 1
+
+        if self._lines >= self.compact_after and self._lines > 2 * len(self.failures):
+            self.compact()
+
+    def compact(self) -> None:
+        """Rewrite the journal with just the current failures."""
+        tmp = self.path.with_name(f".{self.path.name}.tmp")
+        try:
+            with tmp.open("w") as f:
+                for key, since in self.failures.items():
+                    f.write(
+                        json.dumps(
+                            {"op": "fail", "key": key, "since": since.isoformat()}
+                        )
+                        + "\n"
+                    )
+            os.replace(str(tmp), str(self.path))
+        except OSError as e:
+            self._error("compact", e)
+            return
+        self._lines = len(self.failures)
+
+    def _error(self, doing: str, error: OSError) -> None:
+        if self.log is not None:
+            self.log(
+                f"Couldn't {doing} the failure journal {self.path}: {error}", "WARNING"
+            )
+
+
+#: Upper bounds, in seconds, of the buckets `Histogram` counts observations in.
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    math.inf,
+)
+
+
+class Histogram:
+    """Counts latencies, in seconds, into the fixed `LATENCY_BUCKETS`."""
+
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self) -> None:
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def prometheus_lines(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else repr(bound)
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum!r}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+def _prometheus_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+class HotPathMetrics:
+    """
+    Timing and counters for the hot paths of a `StateMonitor`.
+
+    `instrument()` replaces the monitor's `do_entity_check`, `is_ok`, `re_check` and
+    `call_service` methods, on that instance only, with timed wrappers.  A monitor
+    that isn't instrumented runs its methods unwrapped, so the metrics cost nothing
+    when they are turned off.
+
+    `publish()` sets a HA sensor whose state is the number of current failures and
+    whose attributes hold the rest of the metrics.  When a `prometheus_file` is
+    given the metrics are also written to it in the Prometheus text format.
+    """
+
+    TIMED_METHODS: ClassVar[Tuple[str, ...]] = ("do_entity_check", "is_ok", "re_check")
+
+    def __init__(
+        self,
+        app: "StateMonitor",
+        entity: str = "sensor.state_monitor",
+        prometheus_file: Optional[str] = None,
+    ) -> None:
+        self.app = app
+        self.entity = entity
+        self.prometheus_file = prometheus_file
+
+        self.histograms: Dict[str, Histogram] = {}
+        #: `do_entity_check` latencies per entity_id.
+        self.entity_histograms: Dict[str, Histogram] = {}
+        self.service_calls: Counter = Counter()
+        self.service_errors: Counter = Counter()
+        #: Whether the last write of `prometheus_file` failed, so that a lasting
+        #: problem is only logged once.
+        self._prometheus_failing = False
+
+    def instrument(self) -> None:
+        app = self.app
+        for name in self.TIMED_METHODS:
+            setattr(app, name, self._timed(name, getattr(app, name)))
+        app.call_service = self._counted_call_service(app.call_service)
+
+    def _timed(self, name: str, func: Callable) -> Callable:
+        histogram = self.histograms[name] = Histogram()
+        entity_histograms = (
+            self.entity_histograms if name == "do_entity_check" else None
+        )
+
+        def timed(es: EntityState, *args, **kwargs):
+            started = perf_counter()
+            try:
+                return func(es, *args, **kwargs)
+            finally:
+                elapsed = perf_counter() - started
+                histogram.observe(elapsed)
+                if entity_histograms is not None:
+                    per_entity = entity_histograms.get(es.entity)
+                    if per_entity is None:
+                        per_entity = entity_histograms[es.entity] = Histogram()
+                    per_entity.observe(elapsed)
+
+        return timed
+
+    def _counted_call_service(self, func: Callable) -> Callable:
+        histogram = self.histograms["call_service"] = Histogram()
+
+        def call_service(service: str, **kwargs):
+            self.service_calls[service] += 1
+            started = perf_counter()
+            try:
+                return func(service, **kwargs)
+            except Exception:
+                self.service_errors[service] += 1
+                raise
+            finally:
+                histogram.observe(perf_counter() - started)
+
+        return call_service
+
+    @property
+    def notify_error_rate(self) -> float:
+        calls = sum(v for k, v in self.service_calls.items() if k.startswith("notify"))
+        errors = sum(
+            v for k, v in self.service_errors.items() if k.startswith("notify")
+        )
+        return errors / calls if calls else 0.0
+
+    def gauges(self) -> Dict[str, float]:
+        app = self.app
+        return {
+            "monitored_entities": len(app.entity_states),
+            "current_failures": len(app.current_failures),
+            "pending_re_checks": len(app.scheduled_re_checks),
+            "notify_error_rate": self.notify_error_rate,
+        }
+
+    def attributes(self, slowest: int = 10) -> Dict[str, Any]:
+        """The metrics as HA state attributes."""
+        attributes: Dict[str, Any] = dict(self.gauges())
+        for name, histogram in self.histograms.items():
+            attributes[f"{name}_count"] = histogram.count
+            attributes[f"{name}_mean_ms"] = round(histogram.mean * 1000, 3)
+        attributes["notify"] = dict(self.app.notifier.counters)
+        attributes["slowest_entities_ms"] = {
+            entity: round(h.mean * 1000, 3)
+            for entity, h in sorted(
+                self.entity_histograms.items(), key=lambda i: i[1].mean, reverse=True
+            )[:slowest]
+        }
+        return attributes
+
+    def prometheus_text(self) -> str:
+        lines = []
+        for name, value in self.gauges().items():
+            lines.append(f"# TYPE state_monitor_{name} gauge")
+            lines.append(f"state_monitor_{name} {value!r}")
+
+        lines.append("# TYPE state_monitor_seconds histogram")
+        for name, histogram in self.histograms.items():
+            lines.extend(
+                histogram.prometheus_lines("state_monitor_seconds", f'op="{name}"')
+            )
+
+        lines.append("# TYPE state_monitor_entity_check_seconds histogram")
+        for entity, histogram in self.entity_histograms.items():
+            lines.extend(
+                histogram.prometheus_lines(
+                    "state_monitor_entity_check_seconds",
+                    f'entity="{_prometheus_label(entity)}"',
+                )
+            )
+
+        for metric, label, counts in (
+            ("service_calls_total", "service", self.service_calls),
+            ("service_errors_total", "service", self.service_errors),
+            ("notifications_total", "result", self.app.notifier.counters),
+        ):
+            lines.append(f"# TYPE state_monitor_{metric} counter")
+            for key, count in counts.items():
+                value = _prometheus_label(key)
+                lines.append(f'state_monitor_{metric}{{{label}="{value}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def publish(self, kwargs=None) -> None:
+        """Publish the metrics.  Also the timer callback for periodic publishing."""
+        self.app.set_state(
+            self.entity,
+            state=len(self.app.current_failures),
+            attributes=self.attributes(),
+        )
+        if self.prometheus_file:
+            path = Path(self.prometheus_file)
+            tmp = path.with_name(f".{path.name}.tmp")
+            try:
+                tmp.write_text(self.prometheus_text())
+                os.replace(str(tmp), str(path))
+            except OSError as e:
+                # Like the failure journal, metrics that can't be written mustn't
+                # get in the way of monitoring.
+                if not self._prometheus_failing:
+                    self.app.log(
+                        f"Couldn't write the metrics to {path}: {e}", "WARNING"
+                    )
+                self._prometheus_failing = True
+            else:
+                self._prometheus_failing = False
+
+
+#: An `EntityState` handed over to the next instance of an app, whether it was
+#: settled, and when it failed if it is failing.
+RetainedEntityState = Tuple[EntityState, bool, Optional[datetime]]
+
+#: What each `StateMonitor` app, by name, was monitoring when it was terminated.
+#: AppDaemon makes a new instance of an app when its configuration changes.
+_RETAINED: Dict[str, Dict[Tuple[str, str], RetainedEntityState]] = {}
+
+
+class StateMonitor(hass.Hass):
+    NOT_FOUND = Sentinel("NOT_FOUND")
+
+    #: Width, in seconds, of the buckets re-checks are grouped into.  Re-checks due
+    #: within the same bucket are done together by one timer callback.  Can be
+    #: overridden with the `re_check_resolution` arg.
+    RE_CHECK_RESOLUTION: ClassVar[float] = 1.0
+
+    #: When at least this many re-checks are due at once they are checked against a
+    #: single `StateSnapshot` instead of fetching each entity's state.
+    RE_CHECK_SNAPSHOT_THRESHOLD: ClassVar[int] = 10
+
+    #: An entity with a windowed check is re-checked this many times per window
+    #: while the window still holds earlier values, since its aggregate moves on
+    #: without the entity changing.
+    WINDOW_RE_CHECKS: ClassVar[int] = 10
+
+    # noinspection PyAttributeOutsideInit
+    def initialize(self):
+        # The entities can be split between `shard_count` instances of this app, each
+        # with its own `shard_index`, from 0.  Shards hand their notifications to a
+        # `NotifyAggregator`.
+        self.shard_count = int(self.args.get("shard_count", 1))
+        self.shard_index = int(self.args.get("shard_index", 0))
+        assert (
+            0 <= self.shard_index < self.shard_count
+        ), "`shard_index` must be from 0 to `shard_count` - 1."
+
+        self.current_failures: MutableMapping[int, datetime] = {}
+        #: Maps `EntityState.id` to the bucket its re-check is scheduled in.
+        self.scheduled_re_checks: MutableMapping[int, int] = {}
+        #: Maps a bucket to the `EntityState`s, keyed by id, due for a re-check in it.
+        self.re_check_buckets: MutableMapping[
+            int, MutableMapping[int, EntityState]
+        ] = {}
+        self.re_check_resolution = float(
+            self.args.get("re_check_resolution", self.RE_CHECK_RESOLUTION)
+        )
+        self._re_check_timer: Optional[int] = None
+        self._re_check_timer_bucket: Optional[int] = None
+
+        self.notifier = self.make_notifier()
+
+        self.entity_states: List[EntityState] = []
+        #: Routes state changes to the `EntityState`s watching each entity.
+        self._entity_states_by_entity: Dict[str, List[EntityState]] = {}
+        self.rule_graph = RuleGraph(self._entity_states_by_entity)
+
+        # Failures from before a restart are picked back up by `add_entity_state`.
+        self.journal: Optional[FailureJournal] = None
+        self._restored_failures: Dict[str, datetime] = {}
+        journal_path = self.args.get("failure_journal", "state_monitor_failures.jsonl")
+        if journal_path:
+            journal_path = Path(__file__).resolve().parent / journal_path
+            if self.shard_count > 1:
+                journal_path = journal_path.with_name(
+                    f"{journal_path.stem}.{self.shard_index}{journal_path.suffix}"
+                )
+            self.journal = FailureJournal(journal_path, log=self.log)
+            self._restored_failures = self.journal.load()
+
+        # Metrics are off unless asked for, and then wrap our hot path methods.
+        self.metrics: Optional[HotPathMetrics] = None
+        if self.args.get("metrics"):
+            metrics_entity = "sensor.state_monitor"
+            if self.shard_count > 1:
+                metrics_entity += f"_{self.shard_index}"
+            self.metrics = HotPathMetrics(
+                self,
+                entity=self.args.get("metrics_entity", metrics_entity),
+                prometheus_file=self.args.get("metrics_prometheus_file"),
+            )
+            self.metrics.instrument()
+            interval = float(self.args.get("metrics_interval", 60))
+            self.run_every(
+                self.metrics.publish,
+                self.datetime() + timedelta(seconds=interval),
+                interval,
+            )
+
+        # Rules configured in args replace `default_entity_states()`.
+        self.rules = load_entity_rules(self.args, self.name)
+        defaults = [] if self.rules else default_entity_states()
+        self._entity_state_ids = itertools.count(len(defaults))
+        #: (rule index, entity) pairs that already have an `EntityState`.
+        self._expanded_rules: Set[Tuple[int, str]] = set()
+        #: The `EntityState`s made from rules, by rule key and entity.
+        self._rule_entity_states: Dict[Tuple[str, str], EntityState] = {}
+        # When the app is being reloaded, what the previous instance handed over.
+        self._retained = _RETAINED.pop(self.name, {})
+
+        # One snapshot of every entity serves the whole startup pass, and the
+        # entities are only checked once they've all been added.
+        snapshot = self.get_snapshot()
+        #: `(EntityState, snapshot)` pairs waiting for their startup check.
+        self._startup_batch: Optional[List[Tuple[EntityState, StateSnapshot]]] = []
+
+        if self.rules:
+            self.expand_rules(snapshot, snapshot)
+        else:
+            for es in defaults:
+                assert es.is_setup, "EntityStates have not yet been initialized."
+                if self.owns(es.entity, es.depends_on):
+                    self.add_entity_state(es, snapshot)
+
+        # Whatever was handed over for rules that have since changed is dropped.
+        self._retained.clear()
+
+        # Fail fast on dependency cycles.
+        for es in self.entity_states:
+            self.rule_graph.rank(es)
+
+        # New entities can show up at any time and glob rules should cover them.
+        self._watch_new_entities = any(rule.is_glob for rule in self.rules)
+
+        # One listener for every entity, instead of one per `EntityState`.
+        self.listen_state(self.state_dispatcher, attribute="all")
+
+        self.finish_startup()
+
+        # Anything restored that we no longer monitor is forgotten.
+        for key in self._restored_failures:
+            self.journal.record_ok(key)
+        self._restored_failures.clear()
+
+    def make_notifier(self) -> Union[NotifyPipeline, EventNotifier]:
+        if self.shard_count > 1:
+            return EventNotifier(
+                self, self.args.get("notify_event", NOTIFY_EVENT), self.shard_index
+            )
+        return NotifyPipeline(self, **self.notifier_args())
+
+    def notifier_args(self) -> Dict[str, Any]:
+        return notifier_args(self.args)
+
+    def owns(self, entity: str, depends_on: Sequence[str] = ()) -> bool:
+        """
+        Whether this shard monitors `entity`.
+
+        Entities are sharded by the root of their first dependency, so that a chain
+        of dependencies is monitored by one shard.  Further dependencies can be in
+        other shards, and then don't suppress anything.
+        """
+        if self.shard_count == 1:
+            return True
+
+        key = entity
+        seen = {entity}
+        while depends_on and depends_on[0] not in seen:
+            key = depends_on[0]
+            seen.add(key)
+            depends_on = next(
+                (r.depends_on for r in self.rules if r.depends_on and r.matches(key)),
+                (),
+            )
+        return shard_of(key, self.shard_count) == self.shard_index
+
+    def add_entity_state(
+        self, es: EntityState, snapshot: Optional[StateSnapshot] = None
+    ) -> None:
+        """Start monitoring `es`."""
+        if not es.is_setup:
+            es.id = next(self._entity_state_ids)
+        self.entity_states.append(es)
+
+        # If it was failing before a restart we already notified about it and the
+        # startup check only has to notice if it has since recovered.
+        restored = self._restored_failures.pop(es.key, None)
+        if restored is not None:
+            self.current_failures[es.id] = restored
+
+        self.log(
+            f"Doing startup check and routing state changes for {es.entity}.", "DEBUG"
+        )
+
+        # When appdaemon is initializing this app we check all states and alert
+        # on them instead of waiting for a state change (which might be a long
+        # time or never if the device is already in the failed state).
+        self.startup_check(es, snapshot, renotify=restored is None)
+
+        # ... and then we have `state_dispatcher` send it state changes.
+        self._entity_states_by_entity.setdefault(es.entity, []).append(es)
+        self.rule_graph.add(es)
+
+    def add_rule_entity_state(
+        self, rule: EntityRule, entity: str, snapshot: Optional[StateSnapshot] = None
+    ) -> None:
+        """
+        Start monitoring `entity` with `rule`.
+
+        When the app is reloaded, the `EntityState` of an unchanged rule carries on
+        from the previous instance with its history.  One that was settled, ok or
+        failed and notified about, is routed without a startup check.
+        """
+        key = (rule.key, entity)
+        es, settled, failed_at = self._retained.pop(key, (None, False, None))
+        self._rule_entity_states[key] = es = es or rule.make_entity_state(entity)
+        if not settled:
+            es.id = None
+            self.add_entity_state(es, snapshot)
+            return
+
+        es.id = next(self._entity_state_ids)
+        self.entity_states.append(es)
+        # The journal still has the failure and it is still current.
+        self._restored_failures.pop(es.key, None)
+        if failed_at is not None:
+            self.current_failures[es.id] = failed_at
+        self._entity_states_by_entity.setdefault(es.entity, []).append(es)
+        self.rule_graph.add(es)
+
+    def retain_entity_states(self) -> None:
+        """Hand the `EntityState`s made from rules over to this app's next instance."""
+        _RETAINED[self.name] = {
+            key: (
+                es,
+                es.id in self.current_failures
+                or (es.last_ok is True and es.id not in self.scheduled_re_checks),
+                self.current_failures.get(es.id),
+            )
+            for key, es in self._rule_entity_states.items()
+        }
+
+    def startup_check(
+        self, es: EntityState, snapshot: Optional[StateSnapshot], renotify: bool
+    ) -> None:
+        """
+        During `initialize` queue `es` for `finish_startup`, otherwise check it now.
+        """
+        if self._startup_batch is not None and snapshot is not None:
+            self._startup_batch.append((es, snapshot))
+        else:
+            actions = CheckActions()
+            self.do_entity_check(es, snapshot, renotify, actions=actions)
+            self.carry_out(actions)
+
+    def triage_startup(
+        self, batch: Sequence[Tuple[EntityState, StateSnapshot]], now: float
+    ) -> Tuple[List[str], List[str], List[EntityState]]:
+        """
+        Check everything queued by `add_entity_state` during startup in one pass.
+
+        Updates the current failures and returns the messages about entities that
+        are failing and ones that have recovered since a restart, and the entities
+        that need a re-check.  An entity that has been failing for at least its
+        `fail_delay`, going by `changed_at`, is failed right away instead of being
+        re-checked.  Entities we already notified about before a restart and
+        that are still failing aren't reported again, and neither are ones that
+        depend on something failing.
+        """
+        # Everything is checked before anything is reported so that dependencies
+        # are known.
+        results = []
+        for es, snapshot in batch:
+            result = self.is_ok(es, snapshot, now)
+            es.observe(result.is_ok, now)
+            results.append((es, snapshot, result))
+
+        failed: List[str] = []
+        recovered: List[str] = []
+        re_checks: List[EntityState] = []
+        for es, snapshot, result in results:
+            if result.is_ok:
+                if self.is_currently_failed(es):
+                    failed_time = datetime.fromtimestamp(now) - self.pop_failed(es)
+                    recovered.append(f"{result.msg} (Failed for: {failed_time})")
+            elif self.is_currently_failed(es):
+                pass
+            elif self.rule_graph.failing_upstream(es) is not None:
+                # Re-checked if and when what it depends on recovers.
+                pass
+            elif (
+                now - changed_at(snapshot.get(es.entity), now, es.entity_attr)
+                >= es.fail_delay
+            ):
+                self.add_failed(es, now)
+                failed.append(result.msg)
+            else:
+                re_checks.append(es)
+
+        self.log(
+            f"Checked {len(batch)} entities at startup: {len(failed)} failing, "
+            f"{len(recovered)} recovered and {len(re_checks)} to re-check."
+        )
+        return failed, recovered, re_checks
+
+    @staticmethod
+    def startup_digests(
+        failed: List[str], recovered: List[str]
+    ) -> List[Tuple[str, str, str]]:
+        """The `(title, message, tag)` of the notifications summing up startup."""
+        digests = []
+        if failed:
+            digests.append(
+                (f"{len(failed)} Startup Failures", "\n".join(failed), "startup_failed")
+            )
+        if recovered:
+            digests.append(
+                (
+                    f"{len(recovered)} Recovered Since Restart",
+                    "\n".join(recovered),
+                    "startup_recovered",
+                )
+            )
+        return digests
+
+    def startup_actions(
+        self, batch: Sequence[Tuple[EntityState, StateSnapshot]], now: float
+    ) -> CheckActions:
+        """Triage `batch`, schedule its re-checks and sum it up in notifications."""
+        failed, recovered, re_checks = self.triage_startup(batch, now)
+        actions = CheckActions(re_checks_scheduled=bool(re_checks))
+        for es in re_checks:
+            self._bucket_re_check(es, now)
+        for title, message, tag in self.startup_digests(failed, recovered):
+            self.log(f"{title}:\n{message}", "WARNING")
+            actions.notify(title, message, tag)
+        return actions
+
+    def finish_startup(self) -> None:
+        """Check, re-check and notify about the entities queued during startup."""
+        batch, self._startup_batch = self._startup_batch, None
+        self.carry_out(self.startup_actions(batch, self.get_now_ts()))
+
+    def expand_rules(
+        self, entities: Iterable[str], snapshot: Optional[StateSnapshot] = None
+    ) -> None:
+        """
+        Add an `EntityState` for every rule matching each of `entities`.
+
+        Entities a rule has already been expanded for are skipped.  Non-glob rules
+        are always added, even when their entity does not exist, so that a missing
+        entity is reported.
+        """
+        entities = list(entities)
+        for index, rule in enumerate(self.rules):
+            matches = (
+                [e for e in entities if rule.matches(e)]
+                if rule.is_glob
+                else [rule.pattern]
+            )
+            for entity in matches:
+                if (index, entity) in self._expanded_rules:
+                    continue
+                self._expanded_rules.add((index, entity))
+                if self.owns(entity, rule.depends_on):
+                    self.add_rule_entity_state(rule, entity, snapshot)
+
+    def state_dispatcher(self, entity, attribute, old, new, kwargs):
+        """
+        The one state listener for the whole namespace.
+
+        Each change goes to the `EntityState`s watching its entity, see
+        `route_change`.
+        """
+        actions = CheckActions()
+        self.route_change(entity, old, new, actions)
+        self.carry_out(actions)
+
+        # An entity that didn't exist before has no old state.  Any `EntityState`s
+        # this adds do their own startup check.
+        if old is None and new is not None and self._watch_new_entities:
+            self.expand_rules([entity], {entity: new})
+
+    def state_listener(self, entity, attribute, old, new, kwargs):
+        """A listener for a single `EntityState`, passed as the `es` kwarg."""
+        es: EntityState = kwargs.get("es", None)
+        if not es:
+            self.log("State listener fired without an attached EntityState", "ERROR")
+            return
+
+        return self.do_entity_check(es)
+
+    def route_change(
+        self,
+        entity: str,
+        old: Optional[Mapping[str, Any]],
+        new: Optional[Mapping[str, Any]],
+        actions: CheckActions,
+        now: Optional[float] = None,
+    ) -> None:
+        """
+        Check the `EntityState`s watching `entity` after it changed from `old` to `new`.
+
+        Those whose checked value didn't change, like when only some other attribute
+        did, are skipped.  `old` and `new` are full state dicts, so `new` also serves
+        as the snapshot to check against.
+        """
+        entity_states = self._entity_states_by_entity.get(entity)
+        if not entity_states:
+            return
+
+        snapshot = {entity: new}
+        not_found = StateMonitor.NOT_FOUND
+        flipped = False
+        for es in entity_states:
+            value = es.read(new, not_found)
+            if es.read(old, not_found) != value:
+                if es.history is not None:
+                    now = self._now(now)
+                    es.history.add(now, value)
+                was_ok = es.last_ok
+                self.do_entity_check(es, snapshot, now=now, actions=actions)
+                flipped = flipped or es.last_ok != was_ok
+
+        # Whatever depends on this entity may have to be notified about now, or not
+        # any more.
+        if flipped and entity in self.rule_graph.dependents:
+            actions.checks.extend(self.rule_graph.downstream(entity))
+
+    def do_entity_check(
+        self,
+        es: EntityState,
+        snapshot: Optional[StateSnapshot] = None,
+        renotify: bool = True,
+        now: Optional[float] = None,
+        actions: Optional[CheckActions] = None,
+    ) -> Any:
+        """ Checks entity state.
+
+        This is called by our registered state listener.  However, this function does
+        not actually do any actions or notifications.  The reason for this is that to
+        avoid spurious notifications and actions, this method actually schedule a
+        re-check of the entity's state in a few seconds.  This re-check is where
+        notifications and actions are fired.
+
+        What is to be done is added to `actions` rather than done here, see
+        `carry_out`.  Without `actions` it is carried out right away, see
+        `carry_out_now`.
+
+        :param snapshot: An optional `StateSnapshot` to check against.  When not
+            provided, just the state of `es.entity` is fetched.
+        :param renotify: Whether to notify again about an entity that is already
+            failed and still is.
+        :param now: The current timestamp, when the caller has it.
+        """
+        if actions is None:
+            return self.carry_out_now(
+                lambda actions, snapshot, now: self.do_entity_check(
+                    es, snapshot, renotify, now, actions
+                ),
+                [es],
+                snapshot,
+                now,
+            )
+
+        self.log(f"Checking state of {es.entity_accessor}", "DEBUG")
+        result = self.is_ok(es, snapshot, now)
+        is_ok = result.is_ok
+
+        if self.track_flapping(es, is_ok, now):
+            # Rather than notifying, or scheduling and unscheduling re-checks, for
+            # every flap, a single re-check once it settles down catches up.
+            if es.id not in self.scheduled_re_checks:
+                self.log(f"{es.entity_accessor} is flapping.", "INFO")
+                self._bucket_re_check(es, self._now(now), at=es.flapping_until)
+                actions.re_checks_scheduled = True
+            return
+
+        if is_ok and self.is_currently_failed(es):
+            # This is something that was not-ok but then came back into compliance.
+            msg = result.msg
+            self.log(
+                f"{es.entity_accessor} failed but came back. Removing from "
+                f"current failures.  (msg: {msg})."
+            )
+            actions.notify(*self.ok_notification(es, msg, self._now(now)))
+            # Don't need to track it anymore.
+            self.pop_failed(es)
+            # In case the entity goes compliant and then not compliant again before
+            # the re-check happens we need to make sure there are no scheduled
+            # re-checks any time an entity transitions to an OK state.
+            self.unschedule_re_check(es)
+
+        elif is_ok:
+            # This entity is fine, no need to do anything!
+            self.log(f"{es.entity_accessor} is fine.", "DEBUG")
+
+        elif self.is_currently_failed(es):
+            # The state of a currently failed entity has changed from one failed
+            # state to another failed state, so update action/notification
+            if renotify and not self.is_suppressed(es):
+                actions.notify(*self.fail_notification(es, result.msg))
+
+        else:
+            # Entity just became non-compliant, so schedule a re-check of its state
+            # in a few seconds.  ("few seconds" means however many seconds is in
+            # `es.fail_delay`.)
+            self.log(
+                f"{es.entity_accessor} in fail state. Scheduling recheck in "
+                f"{es.fail_delay} seconds.",
+                "INFO",
+            )
+            self._bucket_re_check(es, self._now(now))
+            actions.re_checks_scheduled = True
+
+        if es.history is not None:
+            self.follow_window(es, actions, now)
+
+    def follow_window(
+        self, es: EntityState, actions: CheckActions, now: Optional[float] = None
+    ) -> None:
+        """
+        Keep re-checking `es` while its window holds values from before its latest.
+
+        Does nothing when a re-check is already scheduled.  The last re-check is
+        when the window is all the latest value.
+        """
+        history = es.history
+        if len(history) < 2 or es.id in self.scheduled_re_checks:
+            return
+        now = self._now(now)
+        step = max(history.window / self.WINDOW_RE_CHECKS, self.re_check_resolution)
+        at = min(history.latest_at() + history.window, now + step)
+        self._bucket_re_check(es, now, at=at)
+        actions.re_checks_scheduled = True
+
+    def carry_out(self, actions: CheckActions) -> None:
+        """Do the checks, notifications and re-check scheduling `actions` call for."""
+        for es in actions.checks:
+            self.do_entity_check(es, renotify=False, actions=actions)
+        for notification in actions.notifications:
+            self.notifier.submit(
+                notification.title, notification.message, notification.tag
+            )
+        if actions.re_checks_scheduled:
+            self._arm_re_check_tick()
+
+    def carry_out_now(
+        self,
+        decide: Callable[[CheckActions, Optional[StateSnapshot], float], None],
+        entity_states: Sequence[EntityState] = (),
+        snapshot: Optional[StateSnapshot] = None,
+        now: Optional[float] = None,
+    ) -> Any:
+        """
+        Carry out what `decide(actions, snapshot, now)` adds to `actions` right away.
+
+        This backs the methods that can be called without a `CheckActions`.  In an
+        `AsyncStateMonitor` it returns a coroutine to await, which also fetches the
+        states of `entity_states` when `snapshot` is missing.
+        """
+        actions = CheckActions()
+        decide(actions, snapshot, self._now(now))
+        return self.carry_out(actions)
+
+    def _now(self, now: Optional[float]) -> float:
+        """`now`, or the time from AppDaemon when the caller didn't have it."""
+        return self.get_now_ts() if now is None else now
+
+    def _bucket_re_check(
+        self, es: EntityState, now: float, at: Optional[float] = None
+    ) -> None:
+        """
+        Schedule a re-check of `es` in `es.fail_delay` seconds, or `at` a timestamp.
+
+        Rather than a timer per entity, the re-check goes into the bucket containing
+        its deadline and a single timer is kept armed for the earliest bucket, see
+        `_arm_re_check_tick`.  The deadline is rounded up so that no entity is
+        re-checked early.
+        """
+        self.unschedule_re_check(es)
+
+        deadline = now + es.fail_delay if at is None else at
+        bucket = math.ceil(deadline / self.re_check_resolution)
+        self.scheduled_re_checks[es.id] = bucket
+        self.re_check_buckets.setdefault(bucket, {})[es.id] = es
+
+    def schedule_re_check(self, es: EntityState, at: Optional[float] = None) -> Any:
+        """Schedule a re-check of `es`, like `_bucket_re_check`, and arm the timer."""
+
+        def decide(actions: CheckActions, snapshot, now: float) -> None:
+            self._bucket_re_check(es, now, at)
+            actions.re_checks_scheduled = True
+
+        return self.carry_out_now(decide)
+
+    def unschedule_re_check(self, es: EntityState):
+        bucket = self.scheduled_re_checks.pop(es.id, None)
+        if bucket is None:
+            return
+
+        due = self.re_check_buckets.get(bucket, {})
+        due.pop(es.id, None)
+        if not due:
+            self.re_check_buckets.pop(bucket, None)
+
+    def _re_check_bucket_to_arm(self) -> Optional[int]:
+        """The earliest pending bucket, if the re-check timer isn't armed for it."""
+        if not self.re_check_buckets:
+            return None
+        next_bucket = min(self.re_check_buckets)
+        if (
+            self._re_check_timer is not None
+            and self._re_check_timer_bucket <= next_bucket
+        ):
+            return None
+        return next_bucket
+
+    def _arm_re_check_tick(self) -> None:
+        """Make sure the re-check timer will fire for the earliest pending bucket."""
+        bucket = self._re_check_bucket_to_arm()
+        if bucket is None:
+            return
+
+        if self._re_check_timer is not None:
+            self.cancel_timer(self._re_check_timer)
+        delay = max(0.0, bucket * self.re_check_resolution - self.get_now_ts())
+        self._re_check_timer = self.run_in(self.re_check_tick, delay)
+        self._re_check_timer_bucket = bucket
+
+    def re_check_tick(self, kwargs) -> None:
+        """Timer callback that re-checks every entity whose bucket is due."""
+        self._re_check_timer = None
+        self._re_check_timer_bucket = None
+
+        actions = CheckActions(re_checks_scheduled=True)
+        try:
+            now = self.get_now_ts()
+            due = self._pop_due_re_checks(now)
+            snapshot = None
+            if len(due) >= self.RE_CHECK_SNAPSHOT_THRESHOLD:
+                snapshot = self.get_snapshot()
+            self.re_check_all(due, actions, snapshot, now)
+        finally:
+            # Re-arms the timer even if something went wrong.
+            self.carry_out(actions)
+
+    def re_check_all(
+        self,
+        due: Sequence[EntityState],
+        actions: CheckActions,
+        snapshot: Optional[StateSnapshot],
+        now: float,
+    ) -> None:
+        """
+        `re_check` each of `due`.
+
+        An entity whose re-check raises is logged and skipped, so it can't hold up
+        the others in its bucket or the buckets after it.
+        """
+        for es in due:
+            try:
+                self.re_check(es, snapshot, now, actions)
+            except Exception as e:
+                self.log(f"Re-checking {es.entity_accessor} failed: {e!r}", "ERROR")
+
+    def _pop_due_re_checks(self, now: float) -> List[EntityState]:
+        due: List[EntityState] = []
+        for bucket in sorted(self.re_check_buckets):
+            if bucket * self.re_check_resolution > now:
+                break
+            due.extend(self.re_check_buckets.pop(bucket).values())
+
+        for es in due:
+            del self.scheduled_re_checks[es.id]
+        return due
+
+    def get_snapshot(self) -> StateSnapshot:
+        """Fetch the state of every entity in one call."""
+        return self.get_state() or {}
+
+    def is_ok(
+        self,
+        es: EntityState,
+        snapshot: Optional[StateSnapshot] = None,
+        now: Optional[float] = None,
+    ) -> CheckResult:
+        """
+        Checks if an entity is ok.
+
+        Returns a `CheckResult`.  Its `is_ok` is True when everything is fine, and
+        False means OH NOES.  Its `msg` describes the state.
+
+        :param snapshot: An optional `StateSnapshot` to look the entity up in instead
+            of fetching its state from HA.
+        :param now: The current timestamp, when the caller has it.  Windowed checks
+            cover the time up to it.
+        """
+        if snapshot is None:
+            entity_state = self.get_state(es.entity, attribute="all")
+        else:
+            entity_state = snapshot.get(es.entity)
+        value = es.read(entity_state, default=StateMonitor.NOT_FOUND)
+
+        history = es.history
+        if history is not None:
+            now = self._now(now)
+            if not history:
+                # The value has been the same since it last changed.
+                history.add(changed_at(entity_state, now, es.entity_attr), value)
+            history.advance(now)
+
+        # Guard against mis-configuration of EntityStates or when entities have
+        # disappeared from HA for some reason.
+        if value is StateMonitor.NOT_FOUND:
+            err = f"Cannot find `{es.entity_accessor}`"
+            self.log(err, "ERROR")
+            return CheckResult(es, value, False, self, error=err)
+
+        return CheckResult(es, value, es.checker.check_entity(es, value, self), self)
+
+    def check_many(
+        self,
+        entity_states: Iterable[EntityState],
+        snapshot: Optional[StateSnapshot] = None,
+    ) -> List[CheckResult]:
+        """
+        Check many entities against a single `StateSnapshot`.
+
+        Returns a list of `CheckResult`s in the same order as `entity_states`.  No
+        notifications or re-checks are done.
+
+        :param snapshot: The snapshot to check against.  If not provided, one is
+            fetched.
+        """
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        return [self.is_ok(es, snapshot) for es in entity_states]
+
+    def re_check(
+        self,
+        es: EntityState,
+        snapshot: Optional[StateSnapshot] = None,
+        now: Optional[float] = None,
+        actions: Optional[CheckActions] = None,
+    ) -> Any:
+        """Do actions/notifications on failed entity state.
+
+        This simple method is the whole point of this class...notifications and
+        actions on non-compliant entity states.
+
+        See `do_entity_check` for more info.  This is called by `re_check_tick`, which
+        has already removed `es` from `scheduled_re_checks`.
+        """
+        if actions is None:
+            return self.carry_out_now(
+                lambda actions, snapshot, now: self.re_check(
+                    es, snapshot, now, actions
+                ),
+                [es],
+                snapshot,
+                now,
+            )
+
+        result = self.is_ok(es, snapshot, now)
+
+        if self.track_flapping(es, result.is_ok, now):
+            self._bucket_re_check(es, self._now(now), at=es.flapping_until)
+            actions.re_checks_scheduled = True
+        elif result.is_ok and self.is_currently_failed(es):
+            # It failed, flapped, and settled down ok.
+            actions.notify(*self.ok_notification(es, result.msg, self._now(now)))
+            self.pop_failed(es)
+        elif result.is_ok:
+            self.log(f"{es.entity_accessor} was temporarily in a fail state.", "DEBUG")
+        elif not self.is_currently_failed(es) and not self.is_suppressed(es):
+            now = self._now(now)
+            due_at = es.last_transition_at + es.fail_delay
+            if now < due_at:
+                # It settled down failing, but hasn't been failing for `fail_delay`.
+                self._bucket_re_check(es, now, at=due_at)
+                actions.re_checks_scheduled = True
+            else:
+                self.add_failed(es, now)
+                actions.notify(*self.fail_notification(es, result.msg))
+
+        if es.history is not None:
+            self.follow_window(es, actions, now)
+
+    def is_suppressed(self, es: EntityState) -> bool:
+        """Whether `es` depends on something failing, which is reported instead."""
+        upstream = self.rule_graph.failing_upstream(es)
+        if upstream is None:
+            return False
+        self.log(
+            f"Not reporting {es.entity_accessor} because "
+            f"{upstream.entity_accessor}, which it depends on, is failing.",
+            "INFO",
+        )
+        return True
+
+    def track_flapping(
+        self, es: EntityState, is_ok: bool, now: Optional[float] = None
+    ) -> bool:
+        """Record the result of checking `es`.  Returns whether it is flapping."""
+        if not es.flap_transitions:
+            es.last_ok = is_ok
+            return False
+        now = self._now(now)
+        es.observe(is_ok, now)
+        return es.is_flapping(now)
+
+    def terminate(self):
+        # Don't lose notifications still waiting on the batching window or held back
+        # by the rate limits.
+        self.notifier.flush(force=True)
+        self.retain_entity_states()
+
+    def fail_notification(self, es: EntityState, msg) -> Tuple[str, str, Any]:
+        """The `(title, message, tag)` of the notification that `es` failed."""
+        self.log(msg, "WARNING")
+        return "Abnormal State", msg, es.id
+
+    def ok_notification(self, es: EntityState, msg, now: float) -> Tuple[str, str, Any]:
+        """The `(title, message, tag)` of the notification that `es` recovered."""
+        self.log(msg, "INFO")
+        failed_time = datetime.fromtimestamp(now) - self.get_failed(es)
+        return "Re-Enter Normal State", f"{msg} (Failed for: {failed_time})", es.id
+
+    def do_fail_notify(self, es: EntityState, msg) -> Any:
+        return self.carry_out_now(
+            lambda actions, snapshot, now: actions.notify(
+                *self.fail_notification(es, msg)
+            )
+        )
+
+    def do_ok_notify(self, es: EntityState, msg) -> Any:
+        return self.carry_out_now(
+            lambda actions, snapshot, now: actions.notify(
+                *self.ok_notification(es, msg, now)
+            )
+        )
+
+    def add_failed(self, es: EntityState, now: float) -> None:
+        if not self.is_currently_failed(es):
+            self.current_failures[es.id] = datetime.fromtimestamp(now)
+            if self.journal is not None:
+                self.journal.record_failed(es.key, self.current_failures[es.id])
+
+    def is_currently_failed(self, es: EntityState) -> bool:
+        return es.id in self.current_failures
+
+    def get_failed(self, es: EntityState) -> datetime:
+        return self.current_failures[es.id]
+
+    def pop_failed(self, es: EntityState) -> datetime:
+        if self.journal is not None:
+            self.journal.record_ok(es.key)
+        return self.current_failures.pop(es.id)
+
+
+class AsyncStateMonitor(StateMonitor):
+    """
+    A `StateMonitor` whose callbacks run in AppDaemon's event loop.
+
+    `StateMonitor`'s callbacks each take up an AppDaemon worker thread, and its
+    notifications block that thread for the whole notify service call.  Here the
+    callbacks are coroutines instead, and notifications are sent by an
+    `AsyncNotifyPipeline`, so a slow notify platform doesn't tie up threads other
+    apps need.  Needs AppDaemon 4.
+
+    What to do about each check is decided by the same methods as in
+    `StateMonitor`, with the states and the time fetched up front.  Only carrying
+    out the resulting `CheckActions`, and fetching, awaits AppDaemon.
+
+    On top of the `StateMonitor` args, `notify_concurrency` (default 4) limits how
+    many notify service calls run at once and `notify_timeout` (default 10) is how
+    many seconds each one gets.  The `metrics` arg isn't supported.
+
+    `initialize` still runs in a worker thread.  `finish_startup`, and the checks of
+    entities that show up later, are run from the event loop right after.
+    """
+
+    notifier: Union[AsyncNotifyPipeline, AsyncEventNotifier]
+
+    # noinspection PyAttributeOutsideInit
+    def initialize(self):
+        assert not self.args.get("metrics"), "AsyncStateMonitor doesn't do `metrics`."
+        self._startup_checks: List[Tuple[EntityState, StateSnapshot, bool]] = []
+        super().initialize()
+
+    def make_notifier(self) -> Union[AsyncNotifyPipeline, AsyncEventNotifier]:
+        if self.shard_count > 1:
+            return AsyncEventNotifier(
+                self, self.args.get("notify_event", NOTIFY_EVENT), self.shard_index
+            )
+        return AsyncNotifyPipeline(
+            self,
+            **self.notifier_args(),
+            max_concurrency=int(self.args.get("notify_concurrency", 4)),
+            timeout=float(self.args.get("notify_timeout", 10)),
+        )
+
+    def startup_check(
+        self, es: EntityState, snapshot: Optional[StateSnapshot], renotify: bool
+    ) -> None:
+        if self._startup_batch is not None and snapshot is not None:
+            self._startup_batch.append((es, snapshot))
+        else:
+            self._startup_checks.append((es, snapshot, renotify))
+
+    def finish_startup(self) -> None:
+        self.run_in(self.run_startup_checks, 0)
+
+    async def run_startup_checks(self, kwargs=None) -> None:
+        now = await self.get_now_ts()
+        if self._startup_batch is not None:
+            batch, self._startup_batch = self._startup_batch, None
+            await self.carry_out(self.startup_actions(batch, now))
+
+        checks, self._startup_checks = self._startup_checks, []
+        actions = CheckActions()
+        for es, snapshot, renotify in checks:
+            if snapshot is None:
+                snapshot = await self._snapshot_of([es])
+            self.do_entity_check(es, snapshot, renotify, now, actions)
+        await self.carry_out(actions)
+
+    async def state_dispatcher(self, entity, attribute, old, new, kwargs):
+        """`StateMonitor.state_dispatcher`, in the event loop."""
+        if entity in self._entity_states_by_entity:
+            actions = CheckActions()
+            self.route_change(entity, old, new, actions, await self.get_now_ts())
+            await self.carry_out(actions)
+
+        if old is None and new is not None and self._watch_new_entities:
+            self.expand_rules([entity], {entity: new})
+            await self.run_startup_checks()
+
+    async def _snapshot_of(self, entity_states: Sequence[EntityState]) -> StateSnapshot:
+        """A `StateSnapshot` with at least the entities of `entity_states` in it."""
+        if len(entity_states) >= self.RE_CHECK_SNAPSHOT_THRESHOLD:
+            return await self.get_state() or {}
+        return {
+            es.entity: await self.get_state(es.entity, attribute="all")
+            for es in entity_states
+        }
+
+    async def state_listener(self, entity, attribute, old, new, kwargs):
+        """`StateMonitor.state_listener`, in the event loop."""
+        es: EntityState = kwargs.get("es", None)
+        if not es:
+            self.log("State listener fired without an attached EntityState", "ERROR")
+            return
+
+        await self.do_entity_check(es)
+
+    async def carry_out_now(
+        self,
+        decide: Callable[[CheckActions, Optional[StateSnapshot], float], None],
+        entity_states: Sequence[EntityState] = (),
+        snapshot: Optional[StateSnapshot] = None,
+        now: Optional[float] = None,
+    ) -> None:
+        if now is None:
+            now = await self.get_now_ts()
+        if snapshot is None and entity_states:
+            snapshot = await self._snapshot_of(entity_states)
+        actions = CheckActions()
+        decide(actions, snapshot, now)
+        await self.carry_out(actions)
+
+    async def carry_out(self, actions: CheckActions) -> None:
+        if actions.checks:
+            now = await self.get_now_ts()
+            snapshot = await self._snapshot_of(actions.checks)
+            for es in actions.checks:
+                self.do_entity_check(es, snapshot, False, now, actions)
+        for notification in actions.notifications:
+            await self.notifier.submit(
+                notification.title, notification.message, notification.tag
+            )
+        if actions.re_checks_scheduled:
+            await self._arm_re_check_tick()
+
+    async def _arm_re_check_tick(self) -> None:
+        bucket = self._re_check_bucket_to_arm()
+        if bucket is None:
+            return
+
+        if self._re_check_timer is not None:
+            await self.cancel_timer(self._re_check_timer)
+        now = await self.get_now_ts()
+        delay = max(0.0, bucket * self.re_check_resolution - now)
+        self._re_check_timer = await self.run_in(self.re_check_tick, delay)
+        self._re_check_timer_bucket = bucket
+
+    async def re_check_tick(self, kwargs) -> None:
+        self._re_check_timer = None
+        self._re_check_timer_bucket = None
+
+        actions = CheckActions(re_checks_scheduled=True)
+        try:
+            now = await self.get_now_ts()
+            due = self._pop_due_re_checks(now)
+            self.re_check_all(due, actions, await self._snapshot_of(due), now)
+        finally:
+            await self.carry_out(actions)
+
+    async def terminate(self):
+        await self.notifier.flush(force=True)
+        await self.notifier.drain()
+        self.retain_entity_states()
+
+
+def changed_at(
+    entity_state: Optional[Mapping[str, Any]], default: float, entity_attr="state"
+) -> float:
+    """
+    When the `entity_attr` of an entity last changed, as a timestamp, or may have.
+
+    HA only keeps track of when the state itself last changed, in `last_changed`.
+    Anything else may have changed as late as `last_updated`, when any of the entity
+    did.
+
+    :param entity_state: The entity's full state dict.
+    :param default: Returned when the entity doesn't say or can't be parsed.
+    :param entity_attr: As for `EntityState`.
+    """
+    key = "last_changed" if entity_attr == "state" else "last_updated"
+    try:
+        return datetime.fromisoformat(entity_state[key]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return default
+
+
+DEFAULT = Sentinel("DEFAULT")
+
+
+def get_nested_attr(obj, attribute: str, default=DEFAULT):
+    """
+    Get a named attribute from an object.
+
+    `get_nested_attr(x, 'a.b.c.d')` is equivalent to `x.a.b.c.d`.
+
+    When a default argument is given, it is returned when any attribute in the chain
+    doesn't exist; without it, an exception is raised when a missing attribute is
+    encountered.
+    """
+    getter = attrgetter(attribute)
+    try:
+        return getter(obj)
+    except AttributeError:
+        if default != DEFAULT:
+            return default
+        else:
+            raise
+
+
+class SnapshotWriter:
+    """
+    Writes a `StateSnapshot` to a JSON file.
+
+    Entities are encoded and written one at a time, so the whole document is never
+    held in memory as a string.  The file is written to a temporary file which then
+    replaces `path`, so readers never see a half written snapshot.
+
+    A `path` ending in `.gz` is gzipped.  With `indent=None` the output is compact,
+    without any whitespace.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        indent: Optional[int] = None,
+        sort_keys: bool = False,
+        compress: Optional[bool] = None,
+    ) -> None:
+        self.path = path
+        self.indent = indent
+        self.sort_keys = sort_keys
+        self.compress = path.suffix == ".gz" if compress is None else compress
+
+    def _open(self, path: Path, mode: str) -> IO[str]:
+        if self.compress:
+            return gzip.open(str(path), mode + "t")
+        return path.open(mode)
+
+    def write(self, states: StateSnapshot) -> None:
+        tmp = self.path.with_name(f".{self.path.name}.tmp")
+        try:
+            with self._open(tmp, "w") as f:
+                self._stream(states, f)
+            os.replace(str(tmp), str(self.path))
+        except BaseException:
+            # Don't leave a half written snapshot lying around.
+            try:
+                tmp.unlink()
+            except OSError:
+                pass
+            raise
+
+    def _stream(self, states: StateSnapshot, f: IO[str]) -> None:
+        entity_ids = sorted(states) if self.sort_keys else list(states)
+        if not entity_ids:
+            f.write("{}")
+            return
+
+        if self.indent is None:
+            opening, separator, closing, key_separator = "{", ",", "}", ":"
+            nested_indent = ""
+            separators = (",", ":")
+        else:
+            # Matches the output of `json.dump(..., indent=indent)`.
+            nested_indent = " " * self.indent
+            opening, separator, closing = (
+                "{\n" + nested_indent,
+                ",\n" + nested_indent,
+                "\n}",
+            )
+            key_separator = ": "
+            separators = None
+
+        f.write(opening)
+        for index, entity_id in enumerate(entity_ids):
+            if index:
+                f.write(separator)
+            value = json.dumps(
+                states[entity_id],
+                indent=self.indent,
+                separators=separators,
+                sort_keys=self.sort_keys,
+            )
+            if nested_indent:
+                value = value.replace("\n", "\n" + nested_indent)
+            f.write(json.dumps(entity_id) + key_separator + value)
+        f.write(closing)
+
+
+class StateDeltaWriter:
+    """
+    Appends the entities that changed since the last write to a JSON lines file.
+
+    A state listener on every entity tracks which entities changed.  Each `write()`
+    appends one line per changed entity holding the time of the write, the
+    entity_id and its latest full state, which is null for a removed entity.
+    Replaying the lines over the last full snapshot gives the current states.
+    """
+
+    def __init__(self, h: hass.Hass, path: Path, compress: Optional[bool] = None):
+        self.h = h
+        self.path = path
+        self.compress = path.suffix == ".gz" if compress is None else compress
+        self.changed: Dict[str, Optional[Mapping[str, Any]]] = {}
+        self._handle: Optional[int] = None
+
+    def start(self) -> None:
+        self._handle = self.h.listen_state(self.state_listener, attribute="all")
+
+    def stop(self) -> None:
+        if self._handle is not None:
+            self.h.cancel_listen_state(self._handle)
+            self._handle = None
+
+    def state_listener(self, entity, attribute, old, new, kwargs):
+        self.changed[entity] = new
+
+    def write(self, kwargs=None) -> int:
+        """
+        Append the changed entities.  Also usable as a timer callback.
+
+        Returns the number of entities written.
+        """
+        if not self.changed:
+            return 0
+
+        changed, self.changed = self.changed, {}
+        now = self.h.get_now_ts()
+        opener = gzip.open if self.compress else open
+        # Each gzipped write adds a gzip member, which readers handle transparently.
+        with opener(str(self.path), "at") as f:
+            for entity_id, state in changed.items():
+                f.write(
+                    json.dumps({"t": now, "entity_id": entity_id, "state": state})
+                    + "\n"
+                )
+        return len(changed)
+
+
+def write_state_to_file(
+    h: hass.Hass, path: Optional[Path] = None, compact: bool = False
+) -> None:
+    """
+    Write the state of every entity to `path`, `state.json` next to this module by
+    default.
+
+    By default the file is pretty printed with sorted keys.  `compact` writes it
+    without whitespace, and a `path` ending in `.gz` is gzipped.  See
+    `SnapshotWriter`.
+    """
+    if path is None:
+        path = Path(__file__).resolve().parent / "state.json"
+    if compact:
+        writer = SnapshotWriter(path)
+    else:
+        writer = SnapshotWriter(path, indent=4, sort_keys=True)
+    writer.write(h.get_state())
@@ -0,0 +1,15 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from harness import fake_hass  # noqa: E402
+
+fake_hass.install()
+
+
+@pytest.fixture
+def home() -> fake_hass.SimHome:
+    return fake_hass.SimHome()
@@ -0,0 +1,400 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import percent_scheduler as ps
+from harness import fake_hass
+
+DAY = 24 * 60 * 60
+HOUR = 60 * 60
+
+
+def start(home, cls=ps.PercentScheduler, **args):
+    args.setdefault("verify_interval", 0)
+    app = cls(home, args=args, name="scheduler")
+    app.initialize()
+    return app
+
+
+def switched(home, entity_id="switch.fan"):
+    """The `(seconds since the start, "on" or "off")` of each switch of `entity_id`."""
+    return [
+        (when - fake_hass.DEFAULT_START, service.rsplit("_", 1)[-1])
+        for when, service, data in home.service_calls
+        if data.get("entity_id") == entity_id
+    ]
+
+
+@pytest.fixture
+def fan(home):
+    home.set_state("switch.fan", "off")
+    return home
+
+
+@pytest.fixture
+def numpy():
+    return pytest.importorskip("numpy")
+
+
+@pytest.fixture
+def new_york():
+    zoneinfo = pytest.importorskip("zoneinfo")
+    try:
+        return zoneinfo.ZoneInfo("America/New_York")
+    except zoneinfo.ZoneInfoNotFoundError:
+        pytest.skip("No time zone database.")
+
+
+@pytest.mark.parametrize("mode", [ps.RELATIVE, ps.ABSOLUTE])
+def test_duty_cycle_over_a_day(fan, mode):
+    app = start(
+        fan, device="switch.fan", percent=0.25, min_on_seconds=100, schedule_mode=mode
+    )
+    fan.advance(DAY)
+
+    assert app.achieved_duty_cycle == pytest.approx(0.25, abs=0.001)
+    assert switched(fan)[:4] == [(0, "on"), (100, "off"), (400, "on"), (500, "off")]
+
+
+def test_absolute_edges_stay_on_the_timeline(fan):
+    app = start(
+        fan,
+        device="switch.fan",
+        percent=0.25,
+        min_on_seconds=100,
+        schedule_mode=ps.ABSOLUTE,
+    )
+    fan.advance(DAY)
+
+    assert all(
+        when % 400 == (0 if state == "on" else 100) for when, state in switched(fan)
+    )
+    assert app.lateness == 0
+
+
+@pytest.mark.parametrize("mode", [ps.RELATIVE, ps.ABSOLUTE])
+def test_always_on_is_switched_once(fan, mode):
+    start(fan, device="switch.fan", percent=1, min_on_seconds=100, schedule_mode=mode)
+    fan.advance(DAY)
+
+    assert switched(fan) == [(0, "on")]
+    assert fan.states["switch.fan"]["state"] == "on"
+
+
+def test_absolute_edges_follow_the_clock_in_another_time_zone():
+    # AppDaemon's time zone needn't be the system's.
+    home = fake_hass.SimHome(time_zone=timezone(timedelta(hours=5, minutes=30)))
+    home.set_state("switch.fan", "off")
+    start(
+        home,
+        device="switch.fan",
+        percent=0.25,
+        min_on_seconds=100,
+        schedule_mode=ps.ABSOLUTE,
+    )
+    home.advance(1000)
+
+    assert switched(home) == [
+        (0, "on"),
+        (100, "off"),
+        (400, "on"),
+        (500, "off"),
+        (800, "on"),
+        (900, "off"),
+    ]
+
+
+def test_relative_config_burst_reschedules_once_keeping_the_cycle(fan):
+    logs = []
+    fan.log_sink = lambda app, msg, level: logs.append(msg)
+    fan.set_state("input_number.percent", "25")
+    start(
+        fan,
+        device="switch.fan",
+        percent_state="input_number.percent",
+        min_on_seconds=100,
+        schedule_mode=ps.RELATIVE,
+    )
+    fan.advance(150)
+    # Dragging a slider, all within the 5 second debounce.
+    for percent in ("30", "40", "50"):
+        fan.set_state("input_number.percent", percent)
+        fan.advance(1)
+    fan.advance(440)
+
+    assert logs.count("Rescheduling with new config.") == 1
+    # The cycle that started at 0 carries on with the new 200 second period.
+    assert switched(fan) == [
+        (0, "on"),
+        (100, "off"),
+        (200, "on"),
+        (300, "off"),
+        (400, "on"),
+        (500, "off"),
+    ]
+
+
+def test_absolute_config_change_starts_the_next_cycle_on_the_new_timeline(fan):
+    fan.set_state("input_number.percent", "25")
+    app = start(
+        fan,
+        device="switch.fan",
+        percent_state="input_number.percent",
+        min_on_seconds=100,
+        schedule_mode=ps.ABSOLUTE,
+    )
+    fan.advance(345)
+    fan.set_state("input_number.percent", "50")
+    fan.advance(1000)
+
+    # A 200 second period from the same anchor, without an on and off at once.
+    assert switched(fan) == [
+        (0, "on"),
+        (100, "off"),
+        (400, "on"),
+        (500, "off"),
+        (600, "on"),
+        (700, "off"),
+        (800, "on"),
+        (900, "off"),
+        (1000, "on"),
+        (1100, "off"),
+        (1200, "on"),
+        (1300, "off"),
+    ]
+    assert app.lateness == 0
+
+
+def test_shadow_skips_switching_a_device_that_already_is(fan):
+    shadow = ps.DeviceShadow(fake_hass.FakeHass(fan), verify_interval=0)
+    shadow.track("switch.fan")
+
+    assert shadow.switch("switch.fan", False) is False
+    assert switched(fan) == []
+    assert shadow.switch("switch.fan", True) is True
+    assert shadow.switch("switch.fan", True) is False
+    assert switched(fan) == [(0, "on")]
+
+    # Switched off by someone else, which the listener tells the shadow about.
+    fan.set_state("switch.fan", "off")
+    assert shadow.switch("switch.fan", False) is False
+    assert shadow.switch("switch.fan", True) is True
+    assert switched(fan) == [(0, "on"), (0, "on")]
+    assert fan.pending_timers == 0
+
+
+def test_device_switched_behind_our_back_is_switched_back(fan):
+    start(
+        fan,
+        device="switch.fan",
+        percent=1,
+        min_on_seconds=100,
+        schedule_mode=ps.ABSOLUTE,
+        verify_interval=300,
+    )
+    fan.advance(10)
+    # Switched off without a state change event reaching us.
+    fan.states["switch.fan"] = dict(fan.states["switch.fan"], state="off")
+    fan.advance(300)
+
+    assert switched(fan) == [(0, "on"), (300, "on")]
+    assert fan.states["switch.fan"]["state"] == "on"
+
+
+# MultiPercentScheduler
+
+
+def test_multi_runs_each_device_on_its_own_timeline(home):
+    for device in ("switch.a", "switch.b"):
+        home.set_state(device, "off")
+    devices = [
+        {"device": "switch.a", "percent": 1, "min_on_seconds": 100},
+        {"device": "switch.b", "percent": 0.5, "min_on_seconds": 100},
+    ]
+    start(home, ps.MultiPercentScheduler, devices=devices)
+    home.advance(DAY - 1)
+
+    assert switched(home, "switch.a") == [(0, "on")]
+    b = switched(home, "switch.b")
+    assert len(b) == DAY // 100
+    assert all(when % 200 == (0 if state == "on" else 100) for when, state in b)
+
+
+def test_multi_staggers_devices_on_a_circuit(home):
+    for device in ("switch.a", "switch.b"):
+        home.set_state(device, "off")
+    devices = [
+        {"device": d, "percent": 0.5, "min_on_seconds": 100, "circuit": "basement"}
+        for d in ("switch.a", "switch.b")
+    ]
+    start(home, ps.MultiPercentScheduler, devices=devices)
+    home.advance(1000)
+
+    assert switched(home, "switch.a")[:2] == [(0, "on"), (100, "off")]
+    assert switched(home, "switch.b")[:2] == [(100, "on"), (200, "off")]
+
+
+def test_multi_ticks_follow_the_clock_in_another_time_zone():
+    home = fake_hass.SimHome(time_zone=timezone(timedelta(hours=-7)))
+    home.set_state("switch.a", "off")
+    devices = [{"device": "switch.a", "percent": 0.5, "min_on_seconds": 100}]
+    start(home, ps.MultiPercentScheduler, devices=devices)
+    home.advance(999)
+
+    assert [when for when, _ in switched(home, "switch.a")] == list(range(0, 1000, 100))
+
+
+def test_multi_late_tick_skips_the_missed_cycles(home):
+    for device in ("switch.a", "switch.b"):
+        home.set_state(device, "off")
+    devices = [
+        {"device": "switch.a", "percent": 0.5, "min_on_seconds": 100},
+        {"device": "switch.b", "percent": 0.25, "min_on_seconds": 100},
+    ]
+    app = start(home, ps.MultiPercentScheduler, devices=devices)
+    home.advance(50)
+
+    # AppDaemon stalls for two hours and then runs the tick that was due at 100.
+    home.cancel(app._timer)
+    home.now += 2 * HOUR + 100
+    app.tick({})
+    home.advance(300)
+
+    # Each device is switched straight to where its timeline is by now.
+    assert switched(home, "switch.a") == [
+        (0, "on"),
+        (7350, "off"),
+        (7400, "on"),
+        (7500, "off"),
+        (7600, "on"),
+    ]
+    assert switched(home, "switch.b") == [(0, "on"), (7350, "off"), (7600, "on")]
+
+
+# Planning
+
+
+def test_day_of_knows_daylight_saving_days(new_york):
+    def midnight(day):
+        return datetime(2019, 11, day, tzinfo=new_york).timestamp()
+
+    assert ps.day_of(datetime(2019, 11, 3, 12, tzinfo=new_york)) == (
+        midnight(3),
+        25 * HOUR,
+    )
+    assert ps.day_of(datetime(2019, 11, 4, 0, 30, tzinfo=new_york)) == (
+        midnight(4),
+        DAY,
+    )
+    assert ps.day_of(datetime(2019, 11, 4, 0, 30, tzinfo=timezone.utc)) == (
+        datetime(2019, 11, 4, tzinfo=timezone.utc).timestamp(),
+        DAY,
+    )
+
+
+def test_plan_follows_the_time_zone_through_a_daylight_saving_change(numpy, new_york):
+    day_start = datetime(2019, 11, 3, tzinfo=new_york).timestamp()
+    home = fake_hass.SimHome(start=day_start + 1, time_zone=new_york)
+    home.set_state("switch.fan", "off")
+    # Only the last of 24 slots is cheap, and the day needs exactly one slot.
+    app = start(
+        home,
+        device="switch.fan",
+        percent=1 / 24,
+        min_on_seconds=100,
+        cost_curve=[1] * 23 + [0],
+    )
+    home.advance(25 * HOUR - 2)
+
+    assert (app._plan.day_start, app._plan.day_seconds) == (day_start, 25 * HOUR)
+    # The last slot of a 25 hour day is 25 / 24 hours long.
+    ons = [when for when, service, _ in home.service_calls if service.endswith("_on")]
+    assert ons[0] == day_start + 23 * 3750
+    assert app.achieved_duty_cycle == pytest.approx(3750 / (25 * HOUR - 1), abs=1e-3)
+
+
+def test_plan_fills_the_cheapest_slots_first(numpy):
+    plan = ps.plan_duty_cycle([3, 1, 2, 1], percent=0.375, min_on_seconds=100)
+
+    # 1.5 slots of on time: both cheapest slots half full, the rest empty.
+    assert plan.fractions.tolist() == [0, 0.75, 0, 0.75]
+    assert plan.on_seconds.tolist() == [0, 100, 0, 100]
+    assert plan.off_seconds[1] == pytest.approx(100 / 3)
+    assert numpy.isinf(plan.off_seconds[0])
+    assert plan.slot_seconds == DAY / 4
+
+
+def test_plan_of_all_day_fills_every_slot(numpy):
+    plan = ps.plan_duty_cycle([5, 1, 3], percent=1, min_on_seconds=100)
+
+    assert plan.fractions.tolist() == [1, 1, 1]
+    assert plan.off_seconds.tolist() == [0, 0, 0]
+
+
+def test_planned_cycle_wakes_up_when_the_slot_changes(fan, numpy):
+    app = start(
+        fan,
+        device="switch.fan",
+        percent=0.125,
+        min_on_seconds=100,
+        cost_curve=[1, 0, 1, 1],
+    )
+    plan = app.get_plan()
+
+    # Off for the whole of the first slot, and on half of the second.
+    assert app._planned_on_off(plan) == (0, DAY / 4)
+    fan.advance(DAY / 4)
+    assert app._planned_on_off(plan) == (100, 100)
+    # A cycle running into the third slot only stays off until it starts.
+    fan.advance(DAY / 4 - 150)
+    assert app._planned_on_off(plan) == (100, 50)
+    # The last slot is off, until the next day's plan.
+    fan.advance(DAY / 4 + 160)
+    assert app._planned_on_off(plan) == (0, DAY / 4 - 10)
+
+    fan.advance(DAY / 4 - 20)
+    assert switched(fan)[0] == (DAY / 4, "on")
+    assert all(DAY / 4 <= when <= DAY / 2 for when, _ in switched(fan))
+    assert app.achieved_duty_cycle == pytest.approx(0.125, abs=0.001)
+
+
+def test_plan_is_made_once_a_day(fan, numpy, monkeypatch):
+    plans = []
+
+    def plan_duty_cycle(*args):
+        plans.append(args)
+        return make_plan(*args)
+
+    make_plan = ps.plan_duty_cycle
+    monkeypatch.setattr(ps, "plan_duty_cycle", plan_duty_cycle)
+    start(
+        fan,
+        device="switch.fan",
+        percent=0.5,
+        min_on_seconds=100,
+        cost_curve=[2, 1],
+    )
+    fan.advance(DAY - 1)
+    assert len(plans) == 1
+
+    fan.advance(2)
+    assert len(plans) == 2
+    assert plans[1][3] == plans[0][3] + DAY
+
+
+def test_cost_curve_without_numpy_cycles_all_day(fan, monkeypatch):
+    monkeypatch.setattr(ps, "np", None)
+    logs = []
+    fan.log_sink = lambda app, msg, level: logs.append(level)
+    app = start(
+        fan,
+        device="switch.fan",
+        percent=0.25,
+        min_on_seconds=100,
+        cost_curve=[1, 0],
+    )
+    fan.advance(1000)
+
+    assert "WARNING" in logs
+    assert app.get_plan() is None
+    assert switched(fan)[:4] == [(0, "on"), (100, "off"), (400, "on"), (500, "off")]
@@ -0,0 +1,169 @@
+import gzip
+import json
+
+import pytest
+
+import state_monitor as sm
+from harness import fake_hass, replay
+
+START = fake_hass.DEFAULT_START
+BATTERY = {"entity": "sensor.*_battery", "it_is": ["gt", 20], "convert_with": "int"}
+
+
+@pytest.fixture(autouse=True)
+def forget_retained():
+    sm._RETAINED.clear()
+    yield
+    sm._RETAINED.clear()
+
+
+def state(entity_id, value, at, attributes=None):
+    when = replay._iso(START + at)
+    return {
+        "entity_id": entity_id,
+        "state": value,
+        "attributes": attributes or {},
+        "last_changed": when,
+        "last_updated": when,
+    }
+
+
+def write_json(path, data):
+    path.write_text(json.dumps(data))
+    return path
+
+
+# Sources
+
+
+def test_parse_time_reads_naive_times_as_utc():
+    assert replay.parse_time("2019-07-01T00:00:00") == START
+    assert replay.parse_time("2019-07-01T00:00:00Z") == START
+    assert replay.parse_time("2019-07-01T02:00:00+02:00") == START
+
+
+def test_read_snapshots_yields_the_changes_between_them(tmp_path):
+    a, b, c = (state(f"sensor.{n}", "1", 0) for n in "abc")
+    first = write_json(tmp_path / "1.json", {"sensor.a": a, "sensor.b": b})
+    second = write_json(
+        tmp_path / "2.json",
+        {
+            "sensor.a": state("sensor.a", "2", 30),
+            "sensor.c": state("sensor.c", "1", 20),
+        },
+    )
+
+    events = list(replay.read_snapshots([first, second]))
+
+    assert [(when - START, entity_id) for when, entity_id, _ in events] == [
+        (20, "sensor.c"),
+        (30, "sensor.a"),
+        # Removed, at the time the second snapshot was taken.
+        (30, "sensor.b"),
+    ]
+    assert events[1][2]["state"] == "2"
+    assert events[2][2] is None
+
+
+def test_read_deltas_times_changes_by_last_updated(tmp_path):
+    path = tmp_path / "deltas.jsonl.gz"
+    records = [
+        {"t": START + 60, "entity_id": "sensor.a", "state": state("sensor.a", "5", 45)},
+        {"t": START + 120, "entity_id": "sensor.b", "state": None},
+    ]
+    with gzip.open(str(path), "wt") as f:
+        f.write(json.dumps(records[0]) + "\n\n" + json.dumps(records[1]) + "\n")
+
+    events = list(replay.read_deltas(path))
+
+    assert [(when - START, entity_id) for when, entity_id, _ in events] == [
+        (45, "sensor.a"),
+        (120, "sensor.b"),
+    ]
+    assert events[1][2] is None
+
+
+def test_read_recorder_csv_sorts_by_time(tmp_path):
+    path = tmp_path / "history.csv"
+    path.write_text(
+        "entity_id,state,last_changed\n"
+        "sensor.a,1,2019-07-01T00:02:00Z\n"
+        "sensor.a,2,2019-07-01T00:03:00Z\n"
+        "sensor.b,on,2019-07-01T00:01:00Z\n"
+    )
+
+    events = list(replay.read_recorder_csv(path))
+
+    assert [(when - START, e, s["state"]) for when, e, s in events] == [
+        (60, "sensor.b", "on"),
+        (120, "sensor.a", "1"),
+        (180, "sensor.a", "2"),
+    ]
+
+
+def test_merge_interleaves_sources_by_time():
+    first = [(1.0, "a", None), (3.0, "a", None)]
+    second = [(2.0, "b", None), (4.0, "b", None)]
+
+    assert [when for when, _, _ in replay.merge(first, second)] == [1, 2, 3, 4]
+
+
+# Running
+
+
+@pytest.mark.parametrize(
+    "cls", [sm.StateMonitor, sm.AsyncStateMonitor], ids=["sync", "async"]
+)
+def test_pending_notifications_are_sent_when_the_run_ends(cls):
+    run = replay.Replay()
+    run.add_app(cls, {"entity_states": [BATTERY], "notify_window": 600}, "monitor")
+    initial = {"sensor.a_battery": state("sensor.a_battery", "80", 0)}
+    events = [(START + 60, "sensor.a_battery", state("sensor.a_battery", "5", 60))]
+
+    # Past the fail delay, but not the notification window.
+    report = run.run(events, initial=initial, settle=60)
+
+    assert report["events"] == 1
+    assert report["notifications"] == 1
+    ((_, _, data),) = run.actions("notify/")
+    assert data["title"] == "Abnormal State"
+    assert data["message"] == (
+        "sensor.a_battery failed check with a current value of `5`."
+    )
+
+
+@pytest.mark.parametrize(
+    "cls", [sm.StateMonitor, sm.AsyncStateMonitor], ids=["sync", "async"]
+)
+def test_removed_entity_fails_as_not_found(cls):
+    run = replay.Replay()
+    rule = {"entity": "sensor.a_battery", "it_is": ["gt", 20], "convert_with": "int"}
+    run.add_app(cls, {"entity_states": [rule], "notify_window": 0}, "monitor")
+    initial = {"sensor.a_battery": state("sensor.a_battery", "80", 0)}
+    events = [(START + 60, "sensor.a_battery", None)]
+
+    run.run(events, initial=initial, settle=60)
+
+    ((when, _, data),) = run.actions("notify/")
+    assert when - START == 70
+    assert "Cannot find `sensor.a_battery.state`" in data["message"]
+    assert "sensor.a_battery" not in run.home.states
+
+
+def test_events_up_to_the_start_set_the_starting_states():
+    run = replay.Replay()
+    app = run.add_app(sm.StateMonitor, {"entity_states": [BATTERY]}, "monitor")
+    events = [
+        (START, "sensor.a_battery", state("sensor.a_battery", "80", 0)),
+        (START, "sensor.b_battery", state("sensor.b_battery", "90", 0)),
+        (START + 10, "sensor.b_battery", None),
+    ]
+
+    report = run.run(events, settle=0)
+
+    assert report["events"] == 1
+    assert report["virtual_start"] == replay._iso(START)
+    assert sorted(es.entity for es in app.entity_states) == [
+        "sensor.a_battery",
+        "sensor.b_battery",
+    ]
@@ -0,0 +1,943 @@
+import asyncio
+import gzip
+import json
+import math
+import random
+
+import pytest
+
+import state_monitor as sm
+from harness import fake_hass
+
+BATTERY = {"entity": "sensor.*_battery", "it_is": ["gt", 20], "convert_with": "int"}
+
+
+@pytest.fixture(autouse=True)
+def forget_retained():
+    sm._RETAINED.clear()
+    yield
+    sm._RETAINED.clear()
+
+
+@pytest.fixture(params=[sm.StateMonitor, sm.AsyncStateMonitor], ids=["sync", "async"])
+def monitor_cls(request):
+    return request.param
+
+
+def start(home, cls=sm.StateMonitor, name="monitor", **args):
+    args.setdefault("entity_states", [BATTERY])
+    args.setdefault("failure_journal", "")
+    args.setdefault("notify_window", 0)
+    app = cls(home, args=args, name=name)
+    app.initialize()
+    # AsyncStateMonitor finishes starting up from the event loop.
+    home.advance(0)
+    return app
+
+
+def terminate(home, app):
+    result = app.terminate()
+    if asyncio.iscoroutine(result):
+        home.run(result)
+
+
+def restart(home, app):
+    """Stop `app` and return a fresh AppDaemon, with the same states, to start in."""
+    terminate(home, app)
+    sm._RETAINED.clear()
+    new_home = fake_hass.SimHome(start=home.now)
+    new_home.states = home.states
+    return new_home
+
+
+def notified(home):
+    """The `(seconds since the start, title, message)` of each notification."""
+    return [
+        (when - fake_hass.DEFAULT_START, data["title"], data["message"])
+        for when, service, data in home.service_calls
+        if service.startswith("notify/")
+    ]
+
+
+def titles(home):
+    return [title for _, title, _ in notified(home)]
+
+
+# Failing and recovering
+
+
+def test_failure_is_notified_after_fail_delay(home, monitor_cls):
+    home.set_state("sensor.a_battery", "80")
+    app = start(home, monitor_cls)
+
+    home.set_state("sensor.a_battery", "5")
+    home.advance(9)
+    assert notified(home) == []
+
+    home.advance(2)
+    assert notified(home) == [
+        (
+            10,
+            "Abnormal State",
+            "sensor.a_battery failed check with a current value of `5`.",
+        )
+    ]
+    assert len(app.current_failures) == 1
+
+
+def test_brief_failure_is_not_notified(home, monitor_cls):
+    home.set_state("sensor.a_battery", "80")
+    app = start(home, monitor_cls)
+
+    home.set_state("sensor.a_battery", "5")
+    home.advance(5)
+    home.set_state("sensor.a_battery", "80")
+    home.advance(60)
+
+    assert notified(home) == []
+    assert app.current_failures == {}
+    assert app.scheduled_re_checks == {}
+
+
+def test_recovery_is_notified(home, monitor_cls):
+    home.set_state("sensor.a_battery", "80")
+    app = start(home, monitor_cls)
+
+    home.set_state("sensor.a_battery", "5")
+    home.advance(100)
+    home.set_state("sensor.a_battery", "90")
+    home.advance(1)
+
+    ((_, title, message),) = notified(home)[1:]
+    assert title == "Re-Enter Normal State"
+    assert message.endswith("(Failed for: 0:01:30)")
+    assert app.current_failures == {}
+
+
+def test_failing_at_startup_is_summed_up(home, monitor_cls):
+    home.set_state("sensor.a_battery", "5")
+    home.set_state("sensor.b_battery", "80")
+    home.advance(600)
+    start(home, monitor_cls)
+
+    assert titles(home) == ["1 Startup Failures"]
+
+
+def test_attribute_failing_just_before_startup_is_re_checked(home, monitor_cls):
+    rule = {"entity": "sensor.door", "entity_attr": "attributes.battery"}
+    rule.update(it_is=["gt", 20], fail_delay=60)
+    home.set_state("sensor.door", "closed", {"battery": 80})
+    home.advance(3600)
+    # The state itself doesn't change, so neither does `last_changed`.
+    home.set_state("sensor.door", "closed", {"battery": 3})
+    home.advance(1)
+    app = start(home, monitor_cls, entity_states=[rule])
+
+    assert notified(home) == []
+    assert len(app.scheduled_re_checks) == 1
+    home.set_state("sensor.door", "closed", {"battery": 90})
+    home.advance(120)
+    assert notified(home) == []
+
+
+def test_new_entities_matching_a_rule_are_monitored(home, monitor_cls):
+    app = start(home, monitor_cls)
+
+    home.set_state("sensor.new_battery", "5")
+    home.advance(20)
+
+    assert [es.entity for es in app.entity_states] == ["sensor.new_battery"]
+    assert titles(home) == ["Abnormal State"]
+
+
+def test_methods_called_without_actions_act_right_away(home, monitor_cls):
+    home.set_state("sensor.a_battery", "80")
+    app = start(home, monitor_cls)
+    (es,) = app.entity_states
+
+    def call(method, *args):
+        result = method(*args)
+        if asyncio.iscoroutine(result):
+            home.run(result)
+
+    # Changed without a state change event reaching the app.
+    home.states["sensor.a_battery"] = dict(home.states["sensor.a_battery"], state="5")
+    call(app.do_entity_check, es)
+    home.advance(10)
+    call(app.do_fail_notify, es, "Still failing.")
+    call(app.schedule_re_check, es)
+    home.advance(10)
+
+    assert [(when, message) for when, _, message in notified(home)] == [
+        (10, "sensor.a_battery failed check with a current value of `5`."),
+        (10, "Still failing."),
+    ]
+    assert app.scheduled_re_checks == {}
+
+
+# Rules
+
+
+def test_rules_are_loaded_from_a_yaml_file(home, tmp_path):
+    rules_file = tmp_path / "rules.yaml"
+    rules_file.write_text(
+        "- entity: light.*\n"
+        '  it_is_one_of: ["on", "off"]\n'
+        "- entity: sensor.door\n"
+        "  entity_attr: attributes.battery\n"
+        "  it_is: {comparison: gt, to: 20}\n"
+        "  fail_delay: 60\n"
+    )
+    home.set_state("light.a", "on")
+    home.set_state("sensor.door", "closed", {"battery": 80})
+    home.set_state("sensor.a_battery", "80")
+    app = start(home, entity_states_file=str(rules_file))
+
+    assert sorted(es.entity_accessor for es in app.entity_states) == [
+        "light.a.state",
+        "sensor.a_battery.state",
+        "sensor.door.attributes.battery",
+    ]
+    home.set_state("light.a", "unavailable")
+    home.set_state("sensor.door", "closed", {"battery": 5})
+    home.advance(20)
+    assert [message for _, _, message in notified(home)] == [
+        "light.a failed check with a current value of `unavailable`."
+    ]
+    home.advance(60)
+    assert len(notified(home)) == 2
+
+
+def test_rule_with_an_unknown_checker_is_refused():
+    with pytest.raises(AssertionError, match="must have exactly one of"):
+        sm.EntityRule.from_config({"entity": "light.a", "it_was": ["eq", "on"]})
+
+
+def test_reload_carries_unchanged_rules_and_re_checks_changed_ones(home, monitor_cls):
+    door = {"entity": "sensor.door", "it_is": ["eq", "closed"]}
+    home.set_state("sensor.a_battery", "80")
+    home.set_state("sensor.door", "closed")
+    app = start(home, monitor_cls, entity_states=[BATTERY, door])
+    home.set_state("sensor.a_battery", "5")
+    home.set_state("sensor.door", "open")
+    home.advance(20)
+    battery_es = next(es for es in app.entity_states if es.entity.endswith("battery"))
+    assert len(notified(home)) == 2
+
+    terminate(home, app)
+    changed_door = dict(door, fail_delay=30)
+    app = start(home, monitor_cls, entity_states=[BATTERY, changed_door])
+
+    # The unchanged rule carries on, still failing and already notified about.
+    assert battery_es in app.entity_states
+    assert battery_es.id in app.current_failures
+    # The changed one starts over, and waits out its new fail delay.
+    door_es = next(es for es in app.entity_states if es.entity == "sensor.door")
+    assert door_es.fail_delay == 30
+    assert door_es.id in app.scheduled_re_checks
+    assert len(notified(home)) == 2
+    home.advance(30)
+    ((_, title, message),) = notified(home)[2:]
+    assert (title, message) == (
+        "Abnormal State",
+        "sensor.door failed check with a current value of `open`.",
+    )
+
+
+def test_reload_drops_rules_and_entity_states_nobody_uses(home):
+    door = {"entity": "sensor.door", "it_is": ["eq", "closed"]}
+    window = {"entity": "sensor.window", "it_is": ["eq", "closed"]}
+    start(home, entity_states=[window], name="other")
+    app = start(home, entity_states=[BATTERY, door, window])
+
+    terminate(home, app)
+    start(home, entity_states=[BATTERY])
+
+    assert sm.rule_key(BATTERY) in sm._COMPILED_RULES
+    assert sm.rule_key(door) not in sm._COMPILED_RULES
+    # Still used by the other app.
+    assert sm.rule_key(window) in sm._COMPILED_RULES
+    assert sm._RETAINED == {}
+
+
+def test_default_entity_states_are_not_shared(home):
+    first = start(home, entity_states=[], name="first")
+    second = start(home, entity_states=[], name="second")
+
+    assert len(first.entity_states) == len(sm.default_entity_rules())
+    for a, b in zip(first.entity_states, second.entity_states):
+        assert a is not b
+        assert (a.entity, a.id) == (b.entity, b.id)
+        assert a.checker is b.checker
+        assert a.key == a.entity_accessor
+
+
+# Checkers
+
+
+class Lowered(sm.it_is_one_of):
+    """A subclass written for the old API."""
+
+    def get_is_ok(self):
+        return self.actual_val.lower() in self.expected_values
+
+    def get_fail_msg(self):
+        return f"{self.es.entity} is {self.actual_val}, not {self.expected_values}."
+
+
+class IsEven(sm.Checker):
+    def get_is_ok(self):
+        return int(self.actual_val) % 2 == 0
+
+
+def check(home, is_ok_when, value):
+    """The `(is_ok, msg)` of checking `sensor.x` when its state is `value`."""
+    home.set_state("sensor.x", value)
+    app = start(home, entity_states=[])
+    es = sm.EntityState("sensor.x", is_ok_when)
+    es.id = 0
+    result = app.is_ok(es)
+    return result.is_ok, result.msg
+
+
+def test_subclass_of_a_built_in_checker_with_the_old_api(home):
+    assert check(home, Lowered("on", "off"), "ON") == (
+        True,
+        "sensor.x passed check with a current value of `ON`.",
+    )
+    assert check(home, Lowered("on", "off"), "Dim") == (
+        False,
+        "sensor.x is Dim, not ('on', 'off').",
+    )
+
+
+def test_subclass_of_it_is_with_the_old_api(home):
+    class AboveOrServiced(sm.it_is):
+        def get_is_ok(self):
+            return self.actual_val == "serviced" or super().get_is_ok()
+
+    checker = AboveOrServiced("gt", 20, convert_with=int)
+    assert check(home, checker, "21")[0] is True
+    assert check(home, checker, "serviced")[0] is True
+    assert check(home, checker, "9") == (
+        False,
+        "sensor.x failed check with a current value of `9`.",
+    )
+
+
+def test_checker_subclass_and_plain_callables_are_adapted(home):
+    assert check(home, IsEven(), "4") == (
+        True,
+        "sensor.x passed check with a current value of `4`.",
+    )
+    assert check(home, IsEven(fail_msg="Odd!"), "5") == (False, "Odd!")
+
+    def is_on(es, value, ha):
+        return value == "on", f"{es.entity} is {value}"
+
+    assert check(home, is_on, "off") == (False, "sensor.x is off")
+    assert isinstance(sm.as_value_checker(is_on), sm.CallableChecker)
+
+
+def test_check_many_checks_against_one_snapshot(home):
+    home.set_state("sensor.a_battery", "80")
+    home.set_state("sensor.b_battery", "5")
+    app = start(home)
+    home.set_state("sensor.a_battery", "3")
+    calls, re_checks = len(home.service_calls), dict(app.scheduled_re_checks)
+
+    snapshot = {"sensor.a_battery": {"state": "90"}}
+    entity_states = sorted(app.entity_states, key=lambda es: es.entity)
+    results = app.check_many(entity_states, snapshot)
+    assert [(r.es.entity, r.value, r.is_ok) for r in results] == [
+        ("sensor.a_battery", "90", True),
+        ("sensor.b_battery", sm.StateMonitor.NOT_FOUND, False),
+    ]
+    assert results[1].msg == "Cannot find `sensor.b_battery.state`"
+
+    # Without a snapshot, one is fetched.
+    assert [r.is_ok for r in app.check_many(entity_states)] == [False, False]
+    assert len(home.service_calls) == calls
+    assert app.scheduled_re_checks == re_checks
+
+
+def test_built_in_checkers_keep_no_state(home):
+    checker = sm.it_is_one_of("on", "off")
+    assert not hasattr(checker, "__dict__")
+    assert check(home, checker, "on")[0] is True
+    assert check(home, sm.it_is_not("unavailable"), "unavailable")[0] is False
+
+
+# Re-check buckets
+
+
+def test_re_checks_due_together_share_a_timer(home):
+    for i in range(50):
+        home.set_state(f"sensor.b{i}_battery", "80")
+    app = start(home, notify_window=1)
+
+    for i in range(50):
+        home.set_state(f"sensor.b{i}_battery", "5")
+    assert len(app.re_check_buckets) == 1
+    assert home.pending_timers == 1
+
+    home.advance(20)
+    assert len(app.current_failures) == 50
+    assert titles(home) == ["50 State Changes"]
+
+
+class Boom(sm.ValueChecker):
+    """Passes "ok", fails anything else, and raises for "boom"."""
+
+    def check(self, value):
+        if value == "boom":
+            raise RuntimeError("boom")
+        return value == "ok"
+
+
+def test_re_check_that_raises_does_not_hold_up_the_others(home, monkeypatch):
+    monkeypatch.setitem(sm.CHECKERS, "boom", Boom)
+    logs = []
+    home.log_sink = lambda app, msg, level: logs.append((level, msg))
+    for entity in ("x.a", "x.b", "x.c"):
+        home.set_state(entity, "ok")
+    app = start(home, entity_states=[{"entity": "x.*", "boom": []}])
+
+    home.set_state("x.a", "bad")
+    home.set_state("x.b", "bad")
+    home.advance(2)
+    # Changes to "boom" without telling the monitor.
+    home.states["x.a"] = dict(home.states["x.a"], state="boom")
+    home.advance(10)
+
+    assert [message for _, _, message in notified(home)] == [
+        "x.b failed check with a current value of `bad`."
+    ]
+    assert ("ERROR", "Re-checking x.a.state failed: RuntimeError('boom')") in logs
+
+    # The re-check timer still works.
+    home.set_state("x.c", "bad")
+    home.advance(20)
+    assert len(notified(home)) == 2
+
+
+def test_unconvertible_value_fails_instead_of_raising(home, monitor_cls):
+    rule = dict(BATTERY, entity="sensor.*", entity_attr="attributes.level")
+    home.set_state("sensor.a", "on", {"level": "80"})
+    home.set_state("sensor.b", "on", {"level": "80"})
+    start(home, monitor_cls, entity_states=[rule])
+
+    home.set_state("sensor.a", "on", {"level": None})
+    home.set_state("sensor.b", "on", {"level": "5"})
+    home.advance(20)
+
+    assert sorted(message for _, _, message in notified(home)) == [
+        "sensor.a failed check with a current value of `None`.",
+        "sensor.b failed check with a current value of `5`.",
+    ]
+
+
+# Notifications
+
+
+def test_rate_limited_notifications_are_held_not_dropped(home, monitor_cls):
+    home.set_state("sensor.a_battery", "80")
+    app = start(home, monitor_cls, notify_window=5, notify_entity_burst=1)
+
+    for _ in range(4):
+        home.set_state("sensor.a_battery", "5")
+        home.advance(15)
+        home.set_state("sensor.a_battery", "80")
+        home.advance(1)
+    assert titles(home) == ["Abnormal State"]
+
+    # The entity's token comes back after a minute, and the latest news goes out.
+    home.advance(600)
+    assert [(when, title) for when, title, _ in notified(home)] == [
+        (15, "Abnormal State"),
+        (75, "Re-Enter Normal State"),
+    ]
+    assert app.notifier.counters["deduplicated"] == 6
+
+
+def test_pending_notifications_are_sent_on_terminate(home, monitor_cls):
+    home.set_state("sensor.a_battery", "80")
+    app = start(home, monitor_cls, notify_window=60)
+
+    home.set_state("sensor.a_battery", "5")
+    home.advance(20)
+    assert notified(home) == []
+
+    terminate(home, app)
+    assert titles(home) == ["Abnormal State"]
+
+
+# Metrics
+
+
+def test_metrics_are_published_to_a_sensor_and_prometheus(home, tmp_path):
+    prometheus_file = tmp_path / "state_monitor.prom"
+    home.set_state("sensor.a_battery", "80")
+    home.set_state("sensor.b_battery", "80")
+    start(home, metrics=True, metrics_prometheus_file=str(prometheus_file))
+
+    home.set_state("sensor.a_battery", "5")
+    home.advance(60)
+
+    sensor = home.states["sensor.state_monitor"]
+    assert sensor["state"] == 1
+    attributes = sensor["attributes"]
+    assert attributes["monitored_entities"] == 2
+    assert attributes["current_failures"] == 1
+    # Two startup checks, the change, and its re-check.
+    assert attributes["is_ok_count"] == 4
+    assert attributes["do_entity_check_count"] == 1
+    assert attributes["re_check_count"] == 1
+    assert attributes["call_service_count"] == 1
+    assert attributes["notify_error_rate"] == 0
+    assert attributes["notify"] == {"submitted": 1, "sent": 1}
+    assert list(attributes["slowest_entities_ms"]) == ["sensor.a_battery"]
+
+    lines = prometheus_file.read_text().splitlines()
+    assert "state_monitor_current_failures 1" in lines
+    assert 'state_monitor_seconds_count{op="re_check"} 1' in lines
+    assert 'state_monitor_seconds_bucket{op="is_ok",le="+Inf"} 4' in lines
+    assert (
+        'state_monitor_entity_check_seconds_count{entity="sensor.a_battery"} 1'
+        in lines
+    )
+    assert 'state_monitor_service_calls_total{service="notify/main_html"} 1' in lines
+    assert 'state_monitor_notifications_total{result="sent"} 1' in lines
+
+
+def test_unwritable_prometheus_file_is_logged_once(home, tmp_path):
+    logs = []
+    home.log_sink = lambda app, msg, level: logs.append(level)
+    prometheus_file = tmp_path / "missing" / "state_monitor.prom"
+    home.set_state("sensor.a_battery", "80")
+    start(home, metrics=True, metrics_prometheus_file=str(prometheus_file))
+
+    home.set_state("sensor.a_battery", "5")
+    home.advance(180)
+
+    assert logs.count("WARNING") == 2  # The failure, and the metrics file.
+    assert home.states["sensor.state_monitor"]["state"] == 1
+    assert titles(home) == ["Abnormal State"]
+
+
+def test_metrics_cost_nothing_when_off(home):
+    app = start(home)
+    assert app.metrics is None
+    assert "do_entity_check" not in vars(app)
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = sm.Histogram()
+    for seconds in (0.00001, 0.003, 0.004, 5):
+        histogram.observe(seconds)
+
+    lines = histogram.prometheus_lines("t", 'op="x"')
+    assert 't_bucket{op="x",le="1e-05"} 1' in lines
+    assert 't_bucket{op="x",le="0.001"} 1' in lines
+    assert 't_bucket{op="x",le="0.005"} 3' in lines
+    assert 't_bucket{op="x",le="0.1"} 3' in lines
+    assert 't_bucket{op="x",le="+Inf"} 4' in lines
+    assert lines[-1] == 't_count{op="x"} 4'
+    assert histogram.mean == pytest.approx(5.00701 / 4)
+
+
+# Failure journal
+
+
+def test_failure_survives_a_restart(home, monitor_cls, tmp_path):
+    journal = str(tmp_path / "failures.jsonl")
+    home.set_state("sensor.a_battery", "80")
+    app = start(home, monitor_cls, failure_journal=journal)
+    home.set_state("sensor.a_battery", "5")
+    home.advance(20)
+
+    home = restart(home, app)
+    app = start(home, monitor_cls, failure_journal=journal)
+    home.advance(60)
+    assert notified(home) == []
+    assert len(app.current_failures) == 1
+
+    home.set_state("sensor.a_battery", "90")
+    home.advance(1)
+    assert titles(home) == ["Re-Enter Normal State"]
+
+
+def test_recovery_while_down_is_notified_after_a_restart(home, tmp_path):
+    journal = str(tmp_path / "failures.jsonl")
+    home.set_state("sensor.a_battery", "80")
+    app = start(home, failure_journal=journal)
+    home.set_state("sensor.a_battery", "5")
+    home.advance(20)
+
+    home = restart(home, app)
+    home.set_state("sensor.a_battery", "90")
+    app = start(home, failure_journal=journal)
+
+    assert titles(home) == ["1 Recovered Since Restart"]
+    assert app.current_failures == {}
+
+
+def test_journal_tells_rules_on_the_same_entity_apart(home, tmp_path):
+    journal = str(tmp_path / "failures.jsonl")
+    rules = [BATTERY, dict(BATTERY, it_is=["lt", 50])]
+    home.set_state("sensor.a_battery", "80")
+    app = start(home, entity_states=rules, failure_journal=journal)
+    home.set_state("sensor.a_battery", "10")
+    home.advance(20)
+    home.set_state("sensor.a_battery", "60")
+    home.advance(20)
+    assert len(app.current_failures) == 1
+
+    home = restart(home, app)
+    app = start(home, entity_states=rules, failure_journal=journal)
+    home.advance(60)
+    assert notified(home) == []
+    assert len(app.current_failures) == 1
+
+
+def test_malformed_journal_lines_are_skipped(home, tmp_path):
+    journal = tmp_path / "failures.jsonl"
+    key = "sensor.a_battery.state#" + sm.rule_key(BATTERY)
+    journal.write_text(
+        "\n".join(
+            [
+                '{"op": "fail", "key": "%s", "since": "2019-07-01T00:00:00"}' % key,
+                '{"op": "fail", "since": "2019-07-01T00:00:00"}',
+                '{"key": "x"}',
+                '{"op": "fail", "key": "x", "since": "yesterday"}',
+                '{"op": "fail", "key": "y", "since": null}',
+                "[1, 2]",
+                '{"op": "ok", "ke',
+            ]
+        )
+    )
+    home.set_state("sensor.a_battery", "5")
+    app = start(home, failure_journal=str(journal))
+
+    assert len(app.current_failures) == 1
+    assert notified(home) == []
+
+
+def test_unwritable_journal_does_not_block_notifications(home, tmp_path):
+    logs = []
+    home.log_sink = lambda app, msg, level: logs.append(level)
+    home.set_state("sensor.a_battery", "80")
+    start(home, failure_journal=str(tmp_path / "missing" / "failures.jsonl"))
+
+    home.set_state("sensor.a_battery", "5")
+    home.advance(20)
+
+    assert titles(home) == ["Abnormal State"]
+    assert "WARNING" in logs
+
+
+# Flapping and dependencies
+
+
+def test_flapping_is_notified_once_it_settles(home, monitor_cls):
+    rule = dict(BATTERY, flap_transitions=4, flap_window=60)
+    home.set_state("sensor.a_battery", "80")
+    app = start(home, monitor_cls, entity_states=[rule])
+
+    for _ in range(10):
+        home.set_state("sensor.a_battery", "5")
+        home.advance(3)
+        home.set_state("sensor.a_battery", "80")
+        home.advance(3)
+    home.set_state("sensor.a_battery", "5")
+    home.advance(30)
+    assert notified(home) == []
+
+    home.advance(60)
+    assert titles(home) == ["Abnormal State"]
+    assert len(app.current_failures) == 1
+
+
+def test_failure_settling_from_flapping_still_waits_fail_delay(home, monitor_cls):
+    rule = dict(BATTERY, fail_delay=30, flap_transitions=4, flap_window=60)
+    home.set_state("sensor.a_battery", "80")
+    home.set_state("sensor.b_battery", "80")
+    start(home, monitor_cls, entity_states=[rule])
+
+    def set_both(value):
+        home.set_state("sensor.a_battery", value)
+        home.set_state("sensor.b_battery", value)
+
+    for wait, value in [(0, "5"), (3, "80"), (3, "5"), (3, "80"), (49, "5")]:
+        home.advance(wait)
+        set_both(value)
+    # Settles down at 63, failing since 58.  Only sensor.b keeps failing past 88.
+    home.advance(8)
+    home.set_state("sensor.a_battery", "80")
+    home.advance(60)
+
+    assert [(when, message) for when, _, message in notified(home)] == [
+        (88, "sensor.b_battery failed check with a current value of `5`.")
+    ]
+
+
+def test_hysteresis_widens_the_threshold_both_ways(home, monitor_cls):
+    rule = dict(BATTERY, it_is=["gt", 30], hysteresis=2)
+    home.set_state("sensor.a_battery", "80")
+    app = start(home, monitor_cls, entity_states=[rule])
+
+    def settle_at(value):
+        home.set_state("sensor.a_battery", value)
+        home.advance(20)
+        return len(app.current_failures)
+
+    assert settle_at("29") == 0
+    assert settle_at("28") == 1
+    assert settle_at("31") == 1
+    assert settle_at("32") == 1
+    assert settle_at("33") == 0
+    # A failing value is notified again when it changes.
+    assert titles(home) == ["Abnormal State"] * 3 + ["Re-Enter Normal State"]
+
+
+def test_hysteresis_needs_an_ordering():
+    with pytest.raises(AssertionError, match="hysteresis"):
+        sm.it_is("eq", 30, hysteresis=2)
+
+
+def test_failing_dependency_suppresses_dependents(home, monitor_cls):
+    rules = [
+        {
+            "entity": "camera.door",
+            "it_is": ["eq", "recording"],
+            "depends_on": "sensor.hub",
+        },
+        {"entity": "sensor.hub", "it_is": ["eq", "on"]},
+    ]
+    home.set_state("camera.door", "recording")
+    home.set_state("sensor.hub", "on")
+    start(home, monitor_cls, entity_states=rules)
+
+    home.set_state("sensor.hub", "off")
+    home.set_state("camera.door", "idle")
+    home.advance(20)
+    assert [message for _, _, message in notified(home)] == [
+        "sensor.hub failed check with a current value of `off`."
+    ]
+
+    # The camera is still failing once the hub is back.
+    home.set_state("sensor.hub", "on")
+    home.advance(20)
+    assert titles(home)[1:] == ["Re-Enter Normal State", "Abnormal State"]
+
+
+def test_dependency_cycle_doesnt_renotify_a_notified_failure(home, monitor_cls):
+    rules = [
+        {
+            "entity": "camera.door",
+            "it_is": ["eq", "recording"],
+            "depends_on": "sensor.hub",
+        },
+        {"entity": "sensor.hub", "it_is": ["eq", "on"]},
+    ]
+    home.set_state("camera.door", "recording")
+    home.set_state("sensor.hub", "on")
+    start(home, monitor_cls, entity_states=rules)
+    home.set_state("camera.door", "idle")
+    home.advance(20)
+
+    home.set_state("sensor.hub", "off")
+    home.advance(20)
+    home.set_state("sensor.hub", "on")
+    home.advance(20)
+
+    camera = [message for _, _, message in notified(home) if "camera" in message]
+    assert camera == ["camera.door failed check with a current value of `idle`."]
+
+
+def test_depends_on_takes_a_single_entity():
+    es = sm.EntityState("camera.door", sm.it_is("eq", "on"), depends_on="sensor.hub")
+    assert es.depends_on == ("sensor.hub",)
+    es = sm.EntityState("camera.door", sm.it_is("eq", "on"), depends_on=["a.b", "c.d"])
+    assert es.depends_on == ("a.b", "c.d")
+
+
+# Sharding
+
+
+def test_shards_split_the_entities_and_notify_through_the_aggregator(home):
+    for i in range(20):
+        home.set_state(f"sensor.b{i}_battery", "80")
+    aggregator = sm.NotifyAggregator(home, args={"notify_window": 0}, name="agg")
+    aggregator.initialize()
+    shards = [
+        start(home, name=f"shard{i}", shard_count=2, shard_index=i) for i in range(2)
+    ]
+
+    monitored = [{es.entity for es in shard.entity_states} for shard in shards]
+    assert monitored[0].isdisjoint(monitored[1])
+    assert len(monitored[0] | monitored[1]) == 20
+    assert monitored[0] and monitored[1]
+
+    failing = [min(entities) for entities in monitored]
+    for entity in failing:
+        home.set_state(entity, "5")
+    home.advance(20)
+    assert sorted(message.split()[0] for _, _, message in notified(home)) == sorted(
+        failing
+    )
+
+
+# Windowed checks
+
+
+def test_mean_follows_time_not_changes(home, monitor_cls):
+    rule = {"entity": "sensor.a_battery", "mean_is": [3600, "ge", 20]}
+    home.set_state("sensor.a_battery", "90")
+    app = start(home, monitor_cls, entity_states=[rule])
+
+    home.advance(3600)
+    home.set_state("sensor.a_battery", "5")
+    home.advance(6 * 3600)
+
+    assert titles(home) == ["Abnormal State"]
+    ((when, _, message),) = notified(home)
+    # The mean drops below 20 after 2965 of the 3600 seconds.
+    assert 3600 + 2965 <= when <= 3600 + 2965 + 400
+    assert len(app.current_failures) == 1
+
+
+def reference_aggregates(samples, now, window, q):
+    """Time weighted mean, min, max and `q`th percentile, the slow way."""
+    cutoff = now - window
+    spans = []
+    for i, (ts, value) in enumerate(samples):
+        end = samples[i + 1][0] if i + 1 < len(samples) else now
+        spans.append((value, max(0.0, min(end, now) - max(ts, cutoff))))
+    spans = [(value, seconds) for value, seconds in spans if seconds > 0]
+    latest = samples[-1][1]
+    if not spans:
+        return latest, latest, latest, latest
+
+    total = sum(seconds for _, seconds in spans)
+    mean = sum(value * seconds for value, seconds in spans) / total
+    values = [value for value, _ in spans] + [latest]
+    so_far = 0.0
+    for value, seconds in sorted(spans):
+        so_far += seconds
+        if so_far >= q / 100 * total - 1e-9:
+            return mean, min(values), max(values), value
+
+
+def test_value_history_matches_a_reference():
+    rng = random.Random(1)
+    for _ in range(200):
+        window = rng.choice([10, 60, 300])
+        history = sm.ValueHistory(window, capacity=1000)
+        samples = []
+        now = 0.0
+        for _ in range(rng.randint(1, 60)):
+            now += rng.choice([0, 0.5, 1, 5, 20, 100])
+            value = rng.choice([rng.randint(0, 5), rng.random() * 100])
+            history.add(now, value)
+            samples.append((now, float(value)))
+            if rng.random() < 0.3:
+                now += rng.random() * 50
+                history.advance(now)
+                q = rng.choice([0, 10, 50, 90, 100])
+                expected = reference_aggregates(samples, now, window, q)
+                actual = (
+                    history.mean(),
+                    history.min(),
+                    history.max(),
+                    history.percentile(q),
+                )
+                assert actual == pytest.approx(expected)
+
+
+def test_value_history_keeps_at_most_capacity():
+    history = sm.ValueHistory(math.inf, capacity=8)
+    for ts in range(100):
+        history.add(ts, ts)
+    history.advance(100)
+    assert len(history) == 8
+    assert (history.min(), history.max()) == (92, 99)
+    assert history.mean() == pytest.approx(sum(range(92, 100)) / 8)
+
+
+# State files
+
+STATES = {
+    "sensor.b": {"state": "5", "attributes": {"unit": "%", "names": ["x", "y"]}},
+    "light.a": {"state": "on", "attributes": {"nested": {"z": 1, "a": None}}},
+    "sensor.empty": {"state": "", "attributes": {}},
+}
+
+
+@pytest.mark.parametrize(
+    "kwargs, dump_kwargs",
+    [
+        ({}, {"separators": (",", ":")}),
+        ({"indent": 4, "sort_keys": True}, {"indent": 4, "sort_keys": True}),
+        ({"indent": 2}, {"indent": 2}),
+    ],
+    ids=["compact", "pretty", "indent"],
+)
+@pytest.mark.parametrize("states", [STATES, {}], ids=["states", "empty"])
+def test_snapshot_matches_json_dump(tmp_path, kwargs, dump_kwargs, states):
+    path = tmp_path / "state.json"
+    sm.SnapshotWriter(path, **kwargs).write(states)
+
+    assert path.read_text() == json.dumps(states, **dump_kwargs)
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_failed_snapshot_leaves_no_temporary_file(tmp_path):
+    path = tmp_path / "state.json"
+    path.write_text("{}")
+
+    with pytest.raises(TypeError):
+        sm.SnapshotWriter(path).write({"sensor.a": {"state": object()}})
+
+    assert list(tmp_path.iterdir()) == [path]
+    assert path.read_text() == "{}"
+
+
+def test_snapshot_is_gzipped_by_suffix(home, tmp_path):
+    for entity_id, state in STATES.items():
+        home.set_state(entity_id, state["state"], state["attributes"])
+    app = fake_hass.FakeHass(home)
+    path = tmp_path / "state.json.gz"
+    sm.write_state_to_file(app, path, compact=True)
+
+    with gzip.open(str(path), "rt") as f:
+        assert json.load(f) == home.states
+
+
+def test_state_deltas_are_appended_for_changed_entities(home, tmp_path):
+    home.set_state("sensor.a", "1")
+    home.set_state("sensor.b", "1")
+    path = tmp_path / "deltas.jsonl.gz"
+    writer = sm.StateDeltaWriter(fake_hass.FakeHass(home), path)
+    writer.start()
+
+    home.set_state("sensor.a", "2")
+    home.set_state("sensor.a", "3")
+    home.remove_state("sensor.b")
+    home.advance(60)
+    assert writer.write() == 2
+    assert writer.write() == 0
+    home.set_state("sensor.c", "1")
+    assert writer.write() == 1
+    writer.stop()
+    home.set_state("sensor.c", "2")
+    assert writer.write() == 0
+
+    with gzip.open(str(path), "rt") as f:
+        records = [json.loads(line) for line in f]
+    assert [(r["entity_id"], r["state"] and r["state"]["state"]) for r in records] == [
+        ("sensor.a", "3"),
+        ("sensor.b", None),
+        ("sensor.c", "1"),
+    ]
+    assert records[0]["t"] == fake_hass.DEFAULT_START + 60